@@ -36,7 +36,7 @@
 #
 
 # Code:
-from os import path
+from os import path, environ
 from random import choice
 from string import letters
 from sys import path as pythonpath
@@ -146,7 +146,7 @@ class AllChannelClient(DispersyExperimentScriptClient):
                 self.joined_community._disp_create_comment(text, int(time()), None, None, None, None)
 
 if __name__ == '__main__':
-    AllChannelClient.scenario_file = 'allchannel_1000.scenario'
+    AllChannelClient.scenario_file = environ.get('SCENARIO_FILE', 'allchannel_1000.scenario')
     main(AllChannelClient)
 
 #
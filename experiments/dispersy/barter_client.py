@@ -37,7 +37,7 @@
 
 # Code:
 
-from os import path
+from os import path, environ
 from sys import path as pythonpath
 
 from gumby.experiments.dispersyclient import main
@@ -99,5 +99,5 @@ class BarterClient(AllChannelClient):
             self.joined_community.unload_community()
 
 if __name__ == '__main__':
-    BarterClient.scenario_file = "barter10.scenario"
+    BarterClient.scenario_file = environ.get('SCENARIO_FILE', "barter10.scenario")
     main(BarterClient)
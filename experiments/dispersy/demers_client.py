@@ -37,7 +37,7 @@
 
 # Code:
 
-from os import path
+from os import path, environ
 from random import choice
 from string import letters
 from sys import path as pythonpath
@@ -68,7 +68,7 @@ class DemersClient(DispersyExperimentScriptClient):
             self._community.create_text(text)
 
 if __name__ == '__main__':
-    DemersClient.scenario_file = "demers.scenario"
+    DemersClient.scenario_file = environ.get('SCENARIO_FILE', "demers.scenario")
     main(DemersClient)
 
 #
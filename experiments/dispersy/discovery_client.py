@@ -50,6 +50,7 @@ class DiscoveryClient(DispersyExperimentScriptClient):
         self.scenario_runner.register(self.download, 'download')
         self.scenario_runner.register(self.download, 'testset')
         self.scenario_runner.register(self.add_friend, 'taste_buddy')
+        self.peer_actions.update(('add_friend', 'taste_buddy'))
         self.scenario_runner.register(self.ignore_call, 'connect_to_taste_buddies')
         self.scenario_runner.register(self.ignore_call, 'set_manual_connect')
         self.scenario_runner.register(self.ignore_call, 'set_random_connect')
@@ -705,6 +705,81 @@ class AnnotateMessages(AbstractHandler):
                 print >> h_annotations, node_dict.get(node, '?'),
             print >> h_annotations, ''
 
+class ClockAlignment(AbstractHandler):
+
+    def __init__(self):
+        AbstractHandler.__init__(self)
+
+        self.clock_offsets = {}
+
+    def filter_line(self, node_nr, line_nr, timestamp, timeoffset, key):
+        return key == "community-env"
+
+    def handle_line(self, node_nr, line_nr, timestamp, timeoffset, key, json):
+        if 'time_offset' in json:
+            self.clock_offsets[node_nr] = (json['time_offset'], json.get('time_offset_error'))
+
+    def all_files_done(self, extract_statistics):
+        if not self.clock_offsets:
+            return
+
+        h_alignment = open(os.path.join(extract_statistics.node_directory, "clock-alignment.txt"), "w+")
+        print >> h_alignment, "# node_nr time_offset time_offset_error"
+        for node_nr in sorted(self.clock_offsets):
+            time_offset, time_offset_error = self.clock_offsets[node_nr]
+            print >> h_alignment, node_nr, time_offset, '?' if time_offset_error is None else time_offset_error
+        h_alignment.close()
+
+        errors = [error for _, error in self.clock_offsets.itervalues() if error is not None]
+        if errors:
+            print >> sys.stderr, "Clock offset error bound of %d nodes: mean %.6f max %.6f secs" % (len(errors), sum(errors) / len(errors), max(errors))
+
+class ScenarioLag(AbstractHandler):
+
+    percentiles = (50, 90, 99)
+
+    def __init__(self):
+        AbstractHandler.__init__(self)
+
+        self.lags = defaultdict(list)
+        self.durations = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def filter_line(self, node_nr, line_nr, timestamp, timeoffset, key):
+        return key == "scenario-timing"
+
+    def handle_line(self, node_nr, line_nr, timestamp, timeoffset, key, json):
+        for action, scheduled, started, duration, error in json:
+            for name in (action, "all"):
+                self.lags[name].append(started - scheduled)
+                self.durations[name].append(duration)
+                if error:
+                    self.errors[name] += 1
+
+    def percentile(self, values, p):
+        # nearest-rank on the sorted values
+        return values[max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))]
+
+    def all_files_done(self, extract_statistics):
+        if not self.lags:
+            return
+
+        h_lag = open(os.path.join(extract_statistics.node_directory, "scenario-lag.txt"), "w+")
+        print >> h_lag, "# action count", " ".join("lag_p%d" % p for p in self.percentiles), "lag_max", \
+            " ".join("duration_p%d" % p for p in self.percentiles), "duration_max errors"
+        for action in sorted(self.lags, key=lambda action: (action == "all", action)):
+            lags = sorted(self.lags[action])
+            durations = sorted(self.durations[action])
+            print >> h_lag, action, len(lags), \
+                " ".join("%f" % self.percentile(lags, p) for p in self.percentiles), "%f" % lags[-1], \
+                " ".join("%f" % self.percentile(durations, p) for p in self.percentiles), "%f" % durations[-1], \
+                self.errors[action]
+        h_lag.close()
+
+        lags = sorted(self.lags["all"])
+        print >> sys.stderr, "Scenario actions started with a lag of p50 %.3f p99 %.3f max %.3f secs" % (
+            self.percentile(lags, 50), self.percentile(lags, 99), lags[-1])
+
 def get_parser(argv):
     e = ExtractStatistics(argv[1])
     e.add_handler(BasicExtractor())
@@ -714,6 +789,8 @@ def get_parser(argv):
     e.add_handler(BootstrapMessages())
     e.add_handler(DebugMessages())
     e.add_handler(AnnotateMessages())
+    e.add_handler(ClockAlignment())
+    e.add_handler(ScenarioLag())
     return e
 
 if __name__ == "__main__":
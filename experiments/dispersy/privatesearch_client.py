@@ -39,7 +39,7 @@
 
 import sys
 
-from os import path
+from os import path, environ
 from random import choice, randint, sample
 from string import letters
 from sys import path as pythonpath
@@ -354,7 +354,7 @@ class PrivateSearchClient(DispersyExperimentScriptClient):
             log("dispersy.log", "no results", recall=recall, paths_found=paths_found, sources_found=sources_found, keywords=keywords, candidate=str(candidate), unique_sources=unique_sources)
 
 if __name__ == '__main__':
-    PrivateSearchClient.scenario_file = 'privatesearch_1000.scenario'
+    PrivateSearchClient.scenario_file = environ.get('SCENARIO_FILE', 'privatesearch_1000.scenario')
     main(PrivateSearchClient)
 
 #
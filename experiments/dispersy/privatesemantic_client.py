@@ -3,7 +3,7 @@
 
 import sys
 
-from os import path
+from os import path, environ
 from random import choice, randint, sample, random
 from string import letters
 from sys import path as pythonpath
@@ -213,7 +213,7 @@ class PrivateSemanticClient(DispersyExperimentScriptClient):
         self.print_on_change("scenario-debug", self.prev_scenario_debug, {'not_connected':list(self.not_connected_taste_buddies), 'create_time_encryption':self._community.create_time_encryption, 'create_time_decryption':self._community.create_time_decryption, 'receive_time_encryption':self._community.receive_time_encryption, 'send_packet_size':self._community.send_packet_size, 'reply_packet_size':self._community.reply_packet_size, 'forward_packet_size':self._community.forward_packet_size})
 
 if __name__ == '__main__':
-    PrivateSemanticClient.scenario_file = 'privatesemantic_1000.scenario'
+    PrivateSemanticClient.scenario_file = environ.get('SCENARIO_FILE', 'privatesemantic_1000.scenario')
     main(PrivateSemanticClient)
 
 #
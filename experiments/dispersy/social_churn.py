@@ -26,9 +26,10 @@ class ChurnAnalyzer(ScenarioRunner):
         sorted_scenario = defaultdict(list)
 
         prev_tstmp = -1
-        for (tstmp, lineno, clb, args) in self._parse_scenario(filename):
-            if clb in self._callables and tstmp < max_tstmp:
-                sorted_scenario[tstmp].append((self.yes_peers, clb, args))
+        for (tstmp, lineno, clb, args, repeat) in self._parse_scenario(filename):
+            for tstmp in repeat.times() if repeat else (tstmp,):
+                if clb in self._callables and tstmp < max_tstmp:
+                    sorted_scenario[tstmp].append((self.yes_peers, clb, args))
 
         tstmps = sorted_scenario.keys()
         tstmps.sort()
@@ -45,11 +46,7 @@ class ChurnAnalyzer(ScenarioRunner):
         self.print_averages(outputfile, tstmps[-1])
 
     def _parse_for_this_peer(self, peerspec):
-        if peerspec:
-            self.yes_peers, self.no_peers = self._parse_peerspec(peerspec)
-        else:
-            self.yes_peers = set()
-            self.no_peers = set()
+        self.yes_peers, self.no_peers = self._parse_peerspec(peerspec)
         return True
 
     def online(self, tstmp, peer):
@@ -85,8 +85,9 @@ class SocialClient(DispersyExperimentScriptClient):
 
     def registerCallbacks(self):
         self.scenario_runner.register(self.insert_my_key, 'insert_my_key')
-        self.scenario_runner.register(self.add_friend, 'add_friend')
+        self.scenario_runner.register(self.add_friends, 'add_friend', batch=True)
         self.scenario_runner.register(self.add_foaf, 'add_foaf')
+        self.peer_actions.update(('add_friend', 'add_foaf'))
         self.scenario_runner.register(self.connect_to_friends, 'connect_to_friends')
         self.scenario_runner.register(self.set_community_class, 'set_community_class')
         self.scenario_runner.register(self.send_post, 'send_post')
@@ -161,6 +162,17 @@ class SocialClient(DispersyExperimentScriptClient):
 
     @buffer_online
     def add_friend(self, peer_id):
+        self._add_friend(peer_id)
+        self._start_monitor_friends()
+
+    @buffer_online
+    def add_friends(self, args_list):
+        # all the add_friend lines of a timestamp at once, see ScenarioRunner.register(batch=True)
+        for args in args_list:
+            self._add_friend(*args)
+        self._start_monitor_friends()
+
+    def _add_friend(self, peer_id):
         if peer_id != self.my_id:
             peer_id = int(peer_id)
 
@@ -179,13 +191,14 @@ class SocialClient(DispersyExperimentScriptClient):
                 self.friendhashes[peer_id] = keyhash_as_long
                 self.friendiphashes[ipport] = keyhash_as_long
 
-                if not self.monitor_friends_lc:
-                    self.monitor_friends_lc = lc = LoopingCall(self.monitor_friends)
-                    lc.start(5.0, now=True)
-
             elif ipport:
                 print >> sys.stderr, "Got ip/port, but not key?", peer_id
 
+    def _start_monitor_friends(self):
+        if self.friends and not self.monitor_friends_lc:
+            self.monitor_friends_lc = lc = LoopingCall(self.monitor_friends)
+            lc.start(5.0, now=True)
+
     @buffer_online
     def add_foaf(self, peer_id, his_friends):
         if peer_id != self.my_id:
@@ -8,7 +8,7 @@ import yappi
 import os
 import logging
 
-from os import path
+from os import path, environ
 from random import choice
 from string import letters
 from struct import pack
@@ -242,5 +242,5 @@ class TunnelClient(HiddenServicesClient):
         self.outputfile.close()
 
 if __name__ == '__main__':
-    TunnelClient.scenario_file = 'tunnel_performance.scenario'
+    TunnelClient.scenario_file = environ.get('SCENARIO_FILE', 'tunnel_performance.scenario')
     main(TunnelClient)
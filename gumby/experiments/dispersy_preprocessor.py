@@ -1,7 +1,7 @@
 import os
 import sys
 from random import expovariate, random, randint
-from gumby.scenario import ScenarioRunner
+from gumby.scenario import PeerSet, ScenarioRunner
 
 class ScenarioPreProcessor(ScenarioRunner):
 
@@ -15,34 +15,33 @@ class ScenarioPreProcessor(ScenarioRunner):
         print >> sys.stderr, "Looking for max_timestamp, max_peer... in %s" % filename,
 
         self.max_peer = 0
-        for (tstmp, lineno, clb, args) in self._parse_scenario(filename):
-            max_tstmp = max(tstmp, max_tstmp)
+        for (tstmp, lineno, clb, args, repeat) in self._parse_scenario(filename):
+            max_tstmp = max(repeat.end if repeat else tstmp, max_tstmp)
 
         print >> sys.stderr, "\tfound %d and %d" % (max_tstmp, self.max_peer)
 
         _max_peer = self.max_peer
         print >> sys.stderr, "Preprocessing file...",
-        for (tstmp, lineno, clb, args) in self._parse_scenario(filename):
+        for lineno, line in self._read_scenario(filename):
+            cmd = self._parse_scenario_line(lineno, *self._split_peerspec(line))
+            if cmd is None:
+                continue
+            tstmp, lineno, clb, args, repeat = cmd
 
-            print >> outputfile, self.file_buffer[1][lineno - 1][1]
+            print >> outputfile, line
             if clb in self._callables:
                 for peer in self.yes_peers:
-                    for line in self._callables[clb](tstmp, max_tstmp, *args):
-                        print >> outputfile, line, '{%s}' % peer
+                    for tstmp in repeat.times() if repeat else (tstmp,):
+                        for line in self._callables[clb](tstmp, max_tstmp, *args):
+                            print >> outputfile, line, '{%s}' % peer
         print >> sys.stderr, "\tdone"
 
     def _parse_for_this_peer(self, peerspec):
-        if peerspec:
-            self.yes_peers, self.no_peers = self._parse_peerspec(peerspec)
-            self.max_peer = max(self.max_peer, max(self.yes_peers))
+        self.yes_peers, self.no_peers = self._parse_peerspec(peerspec)
+        if self.yes_peers:
+            self.max_peer = max(self.max_peer, self.yes_peers.last)
         else:
-            self.yes_peers = set()
-            self.no_peers = set()
-
-        if not self.yes_peers:
-            self.yes_peers = set(range(1, self.max_peer + 1))
-        for peer in self.no_peers:
-            self.yes_peers.discard(peer)
+            self.yes_peers = PeerSet([(1, self.max_peer)]).difference(self.no_peers)
 
         return True
 
@@ -40,7 +40,7 @@
 import base64
 import json
 import logging
-from collections import Iterable, defaultdict
+from collections import Iterable, OrderedDict, defaultdict
 from os import chdir, environ, getpid, makedirs, path, symlink
 from random import random
 from sys import exit, stderr, stdout
@@ -48,12 +48,12 @@ from time import time
 from traceback import print_exc
 
 from gumby.log import setupLogging
-from gumby.scenario import ScenarioRunner
+from gumby.scenario import RateMeter, ScenarioRunner
 from gumby.sync import ExperimentClient, ExperimentClientFactory
 
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks
-from twisted.internet.task import deferLater
+from twisted.internet.task import LoopingCall, deferLater
 from twisted.internet.threads import deferToThread
 
 
@@ -66,6 +66,8 @@ def buffer_online(func):
 
 class DispersyExperimentScriptClient(ExperimentClient):
     scenario_file = None
+    # Max. amount of decoded peer keys to keep around.
+    decoded_keys_cache_size = 1024
 
     def __init__(self, vars):
         ExperimentClient.__init__(self, vars)
@@ -79,6 +81,14 @@ class DispersyExperimentScriptClient(ExperimentClient):
         self.community_kwargs = {}
         self._stats_file = None
         self._online_buffer = []
+        self._peertype = None
+        # @CONF_OPTION SYNC_QUERY_MODE: Look up the vars of other peers on demand instead of getting all of them from the experiment server. (default is False)
+        self.query_mode = self.str2bool(environ.get('SYNC_QUERY_MODE', 'False'))
+        # Names of the scenario actions that take a peer id as first argument, those peers will be looked up before
+        # starting the experiment when running in query mode.
+        self.peer_actions = set()
+        # LRU of the already decoded private keys of the other peers
+        self._decoded_keys = OrderedDict()
 
         self._crypto = self.initializeCrypto()
         self.generateMyMember()
@@ -87,10 +97,13 @@ class DispersyExperimentScriptClient(ExperimentClient):
     def onVarsSend(self):
         scenario_file_path = path.join(environ['EXPERIMENT_DIR'], self.scenario_file)
         self.scenario_runner = ScenarioRunner(scenario_file_path)
+        self.scenario_runner.load_reporter = self.write_load_report
 
         t1 = time()
-        self.scenario_runner._read_scenario(scenario_file_path)
-        self._logger.debug('Took %.2f to read scenario file', time() - t1)
+        # With a compiled scenario only the lines of this peer will be read once we know our id, otherwise the
+        # scenario is streamed then.
+        self.scenario_runner.load_index()
+        self._logger.debug('Took %.2f to open the scenario index', time() - t1)
 
     def onIdReceived(self):
         self._logger.debug('Got ID %s assigned', self.my_id)
@@ -112,6 +125,8 @@ class DispersyExperimentScriptClient(ExperimentClient):
         self.scenario_runner.register(self.reset_dispersy_statistics, 'reset_dispersy_statistics')
         self.scenario_runner.register(self.annotate)
         self.scenario_runner.register(self.peertype)
+        self.scenario_runner.register(self.barrier, suspend=True)
+        self.scenario_runner.register(self.measure_rates)
 
         self.registerCallbacks()
 
@@ -138,11 +153,47 @@ class DispersyExperimentScriptClient(ExperimentClient):
         except OSError:
             pass
 
+        # @CONF_OPTION SCENARIO_TIMING: Record how late every scenario action starts and how long it blocks the reactor, written as "scenario-timing" lines to statistics.log. (default is False)
+        if self.str2bool(environ.get('SCENARIO_TIMING', 'False')):
+            self.scenario_runner.enable_timing()
+            LoopingCall(self.write_scenario_timings).start(5.0, now=False)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.write_scenario_timings)
+
         self.scenario_runner.run()
 
     def registerCallbacks(self):
         pass
 
+    def measure_rates(self, interval=5):
+        """
+        Logs the achieved vs requested rate of the repeated scenario lines as "scenario-rates" every interval seconds.
+        """
+        meter = RateMeter(self.scenario_runner)
+
+        def write_rates():
+            rates = dict((clb, {'requested': round(requested, 3), 'achieved': round(achieved, 3)})
+                         for clb, (requested, achieved) in meter.sample().iteritems())
+            if rates:
+                self._stats_file.write('%.1f %s %s %s\n' % (time(), self.my_id, "scenario-rates", json.dumps(rates)))
+                self._stats_file.flush()
+
+        LoopingCall(write_rates).start(float(interval), now=False)
+
+    def write_load_report(self, stats):
+        # offered vs completed load of the "load" scenario lines
+        self._stats_file.write('%.1f %s %s %s\n' % (time(), self.my_id, "scenario-load", json.dumps(stats)))
+        self._stats_file.flush()
+
+    def write_scenario_timings(self):
+        timings = [(clb, round(scheduled, 3), round(started, 3), round(duration, 6), error)
+                   for clb, scheduled, started, duration, error in self.scenario_runner.pop_timings()]
+        if timings:
+            self._stats_file.write('%.1f %s %s %s\n' % (time(), self.my_id, "scenario-timing", json.dumps(timings)))
+            self._stats_file.flush()
+
+    def get_required_peers(self):
+        return set(args[0] for _, clb, args in self.scenario_runner.iter_actions() if clb in self.peer_actions and args)
+
     def initializeCrypto(self):
         try:
             from Tribler.dispersy.crypto import ECCrypto, NoCrypto
@@ -236,7 +287,10 @@ class DispersyExperimentScriptClient(ExperimentClient):
         self._do_log()
 
         self.print_on_change('community-kwargs', {}, self.community_kwargs)
-        self.print_on_change('community-env', {}, {'pid':getpid()})
+        env = {'pid': getpid(), 'time_offset': self.time_offset}
+        if self.time_offset_error is not None:
+            env['time_offset_error'] = self.time_offset_error
+        self.print_on_change('community-env', {}, env)
 
         self._logger.debug("Finished starting dispersy")
 
@@ -327,6 +381,7 @@ class DispersyExperimentScriptClient(ExperimentClient):
     def annotate(self, message):
         self._stats_file.write('%.1f %s %s %s\n' % (time(), self.my_id, "annotate", message))
     def peertype(self, peertype):
+        self._peertype = peertype
         self._stats_file.write('%.1f %s %s %s\n' % (time(), self.my_id, "peertype", peertype))
 
     #
@@ -335,22 +390,26 @@ class DispersyExperimentScriptClient(ExperimentClient):
 
 
     def get_private_keypair_by_id(self, peer_id):
-        if str(peer_id) in self.all_vars:
-            key = self.all_vars[str(peer_id)]['private_keypair']
-            if isinstance(key, basestring):
-                key = self.all_vars[str(peer_id)]['private_keypair'] = self._crypto.key_from_private_bin(base64.decodestring(key))
-            return key
+        peer_id = str(peer_id)
+        key = self._decoded_keys.pop(peer_id, None)
+        if key is None:
+            if peer_id not in self.all_vars:
+                return None
+
+            key = self._crypto.key_from_private_bin(base64.decodestring(self.all_vars[peer_id]['private_keypair']))
+            if len(self._decoded_keys) >= self.decoded_keys_cache_size:
+                self._decoded_keys.popitem(last=False)
+
+        # (Re)insert it as the most recently used one
+        self._decoded_keys[peer_id] = key
+        return key
 
     def get_private_keypair(self, ip, port):
-        port = int(port)
-        for peer_dict in self.all_vars.itervalues():
-            if peer_dict['host'] == ip and int(peer_dict['port']) == port:
-                key = peer_dict['private_keypair']
-                if isinstance(key, basestring):
-                    key = peer_dict['private_keypair'] = self._crypto.key_from_private_bin(base64.decodestring(key))
-                return key
+        peer_id = self.get_peer_id(ip, port, log_missing=False)
+        if peer_id is not None:
+            return self.get_private_keypair_by_id(peer_id)
 
-        err("Could not get_private_keypair for", ip, port)
+        self._logger.error("Could not get_private_keypair for %s:%s", ip, port)
 
     def str2bool(self, v):
         return v.lower() in ("yes", "true", "t", "1")
@@ -499,6 +558,13 @@ class DispersyExperimentScriptClient(ExperimentClient):
             prev_endpoint_recv = self.print_on_change("statistics-endpoint-recv", prev_endpoint_recv, self._dispersy.statistics.endpoint_recv)
             prev_endpoint_send = self.print_on_change("statistics-endpoint-send", prev_endpoint_send, self._dispersy.statistics.endpoint_send)
 
+            # Booleans are reported as 0/1 so the server can count them.
+            live_metrics = dict((key, int(value) if isinstance(value, bool) else value)
+                                for key, value in statistics_dict.iteritems() if isinstance(value, (int, long, float)))
+            if self._peertype:
+                live_metrics['peertype'] = self._peertype
+            self.report_metrics(live_metrics)
+
             yield deferLater(reactor, 5.0, lambda : None)
 
 
@@ -509,9 +575,13 @@ def main(client_class):
     factory = ExperimentClientFactory({}, client_class)
     logger = logging.getLogger()
     logger.debug("Connecting to: %s:%s", environ['SYNC_HOST'], int(environ['SYNC_PORT']))
-    # Wait for a random amount of time before connecting to try to not overload the server when we have a lot of connections
-    reactor.callLater(random() * 10,
-                      lambda: reactor.connectTCP(environ['SYNC_HOST'], int(environ['SYNC_PORT']), factory))
+    if float(environ.get('SYNC_ADMISSION_RATE', 0)):
+        # The sync server tells us when to come back if it is too busy to admit us right now.
+        reactor.connectTCP(environ['SYNC_HOST'], int(environ['SYNC_PORT']), factory)
+    else:
+        # Wait for a random amount of time before connecting to try to not overload the server when we have a lot of connections
+        reactor.callLater(random() * 10,
+                          lambda: reactor.connectTCP(environ['SYNC_HOST'], int(environ['SYNC_PORT']), factory))
     reactor.exitCode = 0
     reactor.run()
     exit(reactor.exitCode)
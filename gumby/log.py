@@ -37,7 +37,9 @@
 # Code:
 
 from os import environ, path, chdir, makedirs
+from re import compile as re_compile
 from sys import stdout, stderr
+from time import time
 import logging
 import logging.config
 import sys
@@ -155,6 +157,135 @@ class PythonLoggingObserver(object):
         removeObserver(self.emit)
 
 
+class LineSplitter(object):
+
+    """
+    Splits a stream of data into lines as it arrives.
+
+    Only the new data is split, never the whole buffer again, and a line is
+    never buffered for more than max_length bytes: longer lines are passed on
+    in pieces. Trailing carriage returns (from PTYs) are stripped.
+    """
+
+    def __init__(self, on_line, max_length=64 * 1024):
+        self._on_line = on_line
+        self._max_length = max_length
+        self._partial = []
+        self._partial_length = 0
+
+    def feed(self, data):
+        lines = data.split('\n')
+        if self._partial:
+            self._partial.append(lines[0])
+            lines[0] = ''.join(self._partial)
+            self._partial = []
+            self._partial_length = 0
+
+        partial = lines.pop()
+        for line in lines:
+            self._on_line(line.rstrip('\r'))
+
+        if partial:
+            self._partial.append(partial)
+            self._partial_length += len(partial)
+            if self._partial_length >= self._max_length:
+                self.flush()
+
+    def flush(self):
+        """
+        Passes on the incomplete line buffered, if any.
+        """
+        if self._partial:
+            line = ''.join(self._partial)
+            self._partial = []
+            self._partial_length = 0
+            self._on_line(line.rstrip('\r'))
+
+
+class OutputStream(object):
+
+    """
+    Logs one output stream (stdout or stderr) of a command, line by line with
+    fmt % (label, line).
+
+    If raw_dir is set (see ExperimentRunner, command_output_dir), the output
+    of every command is written as it is to a file in raw_dir instead, and only
+    one out of every sample lines is logged, together with the byte and line
+    rates every report_interval seconds. on_line is called with every line
+    either way.
+    """
+    raw_dir = None
+    sample = 100
+    report_interval = 60
+    _re_unsafe = re_compile(r'[^\w.-]+')
+    _opened = 0
+
+    def __init__(self, logger, fmt, label, name, on_line=None):
+        self._logger = logger
+        self._fmt = fmt
+        self._label = label
+        self._on_line = on_line
+        self.bytes = 0
+        self.lines = 0
+
+        self._raw_dir = self.raw_dir
+        self._raw = None
+        self.filename = None
+        if self._raw_dir:
+            OutputStream._opened += 1
+            self.filename = path.join(self._raw_dir, "%04d-%s" % (OutputStream._opened,
+                                                                  self._re_unsafe.sub('_', name)[-80:]))
+            self._reported = (time(), 0, 0)
+        # The sampled lines are taken from the splitter too, so they are whole even if split between writes.
+        self._splitter = LineSplitter(self._lineReceived) if not self._raw_dir or on_line or self.sample else None
+
+    def write(self, data):
+        self.bytes += len(data)
+        if not self._raw_dir:
+            self._splitter.feed(data)
+            return
+
+        if self._raw is None:
+            # Only commands with some output get a file.
+            if not path.exists(self._raw_dir):
+                makedirs(self._raw_dir)
+            self._raw = open(self.filename, 'wb')
+        self._raw.write(data)
+        if self._splitter:
+            self._splitter.feed(data)
+        else:
+            self.lines += data.count('\n')
+
+        now = time()
+        if self.report_interval and now - self._reported[0] >= self.report_interval:
+            elapsed = now - self._reported[0]
+            self._logger.info(self._fmt, self._label, "%.1f lines/s, %.1f KB/s to %s" % (
+                (self.lines - self._reported[2]) / elapsed, (self.bytes - self._reported[1]) / elapsed / 1024,
+                self.filename))
+            self._reported = (now, self.bytes, self.lines)
+
+    def _lineReceived(self, line):
+        self.lines += 1
+        if not self._raw_dir or (self.sample and self.lines % self.sample == 0):
+            self._logger.info(self._fmt, self._label, line)
+        if self._on_line:
+            self._on_line(line)
+
+    def flush(self):
+        if self._splitter:
+            self._splitter.flush()
+        if self._raw is not None:
+            self._raw.flush()
+
+    def close(self):
+        self.flush()
+        if self._raw is not None and not self._raw.closed:
+            self._raw.close()
+            if self.bytes:
+                self._logger.info(self._fmt, self._label, "%d lines, %d bytes written to %s" % (
+                    self.lines, self.bytes, self.filename))
+
+
 # TODO(emilon): Document this on the user manual
 def setupLogging():
     config_file = path.join(environ['EXPERIMENT_DIR'], "logger.conf")
@@ -0,0 +1,141 @@
+# packing.py ---
+#
+# Filename: packing.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 14:21:09 2026 (+0200)
+
+# Commentary:
+#
+# Compact msgpack-like binary serialization for the sync protocol.
+#
+# Unlike JSON, byte strings are stored as they are, so arbitrary binary blobs (keys, bloom
+# filter seeds, torrents...) can be shared between the experiment instances without having
+# to base64 them first. Supported types: None, bool, int, long (64 bits), float, str,
+# unicode, list, tuple (unpacked as list) and dict.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from struct import Struct
+
+_INT = Struct('!q')
+_FLOAT = Struct('!d')
+_LENGTH = Struct('!I')
+
+
+def pack(obj):
+    """
+    Serializes obj into a byte string.
+    """
+    chunks = []
+    _pack(obj, chunks.append)
+    return ''.join(chunks)
+
+
+def _pack(obj, write):
+    if obj is None:
+        write('N')
+    elif obj is True:
+        write('T')
+    elif obj is False:
+        write('F')
+    elif isinstance(obj, (int, long)):
+        write('i')
+        write(_INT.pack(obj))
+    elif isinstance(obj, float):
+        write('f')
+        write(_FLOAT.pack(obj))
+    elif isinstance(obj, str):
+        write('s')
+        write(_LENGTH.pack(len(obj)))
+        write(obj)
+    elif isinstance(obj, unicode):
+        obj = obj.encode('utf-8')
+        write('u')
+        write(_LENGTH.pack(len(obj)))
+        write(obj)
+    elif isinstance(obj, (list, tuple)):
+        write('l')
+        write(_LENGTH.pack(len(obj)))
+        for item in obj:
+            _pack(item, write)
+    elif isinstance(obj, dict):
+        write('d')
+        write(_LENGTH.pack(len(obj)))
+        for key, value in obj.iteritems():
+            _pack(key, write)
+            _pack(value, write)
+    else:
+        raise TypeError("Can't pack objects of type %s" % type(obj).__name__)
+
+
+def unpack(data):
+    """
+    Deserializes a byte string created with pack().
+    """
+    obj, offset = _unpack(data, 0)
+    if offset != len(data):
+        raise ValueError("%d bytes of trailing data" % (len(data) - offset))
+    return obj
+
+
+def _unpack(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag == 'N':
+        return None, offset
+    elif tag == 'T':
+        return True, offset
+    elif tag == 'F':
+        return False, offset
+    elif tag == 'i':
+        return _INT.unpack_from(data, offset)[0], offset + _INT.size
+    elif tag == 'f':
+        return _FLOAT.unpack_from(data, offset)[0], offset + _FLOAT.size
+
+    length = _LENGTH.unpack_from(data, offset)[0]
+    offset += _LENGTH.size
+    if tag == 's':
+        return data[offset:offset + length], offset + length
+    elif tag == 'u':
+        return data[offset:offset + length].decode('utf-8'), offset + length
+    elif tag == 'l':
+        items = []
+        for _ in xrange(length):
+            item, offset = _unpack(data, offset)
+            items.append(item)
+        return items, offset
+    elif tag == 'd':
+        items = {}
+        for _ in xrange(length):
+            key, offset = _unpack(data, offset)
+            items[key], offset = _unpack(data, offset)
+        return items, offset
+    raise ValueError("Unknown type tag %r at offset %d" % (tag, offset - _LENGTH.size - 1))
+
+#
+# packing.py ends here
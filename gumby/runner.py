@@ -37,6 +37,7 @@
 
 # Code:
 
+from functools import partial
 from os import path, chdir, environ, makedirs
 from shutil import rmtree
 import logging
@@ -45,10 +46,28 @@ import sys
 from twisted.internet import reactor
 from twisted.internet.defer import Deferred, setDebugging, gatherResults, succeed
 from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.protocols.basic import FileSender
 
 
+from .log import OutputStream
+from .scenario import ScenarioIndex
 from .settings import configToEnv, loadConfig
 from .sshclient import runRemoteCMD
+from .steps import StepGraph
+from .workspace import STALE_EXIT_CODE, WorkspaceSync, content_digest, scan_workspace
+
+# Records the completed steps in the output dir, see ExperimentRunner.buildStepGraph().
+CHECKPOINT_FILE = '.gumby_steps.json'
+# Options that don't change the data of the experiment, changing them doesn't prevent resuming it.
+POST_EXPERIMENT_OPTIONS = ('post_process_cmd', 'command_output_dir', 'command_output_sample',
+                           'command_output_report_interval')
+# Printed by scripts/experiment_server.py once it accepts connections.
+EXPERIMENT_SERVER_READY_LINE = "Experiment server listening"
+# Seconds given to the background commands without a ready line to start.
+NO_READY_LINE_DELAY = 1
+
 setDebugging(True)
 
 
@@ -64,12 +83,24 @@ class ExperimentRunner():
         # TODO: check if the experiment dir actually exists
         self._workspace_dir = path.abspath(config['workspace_dir'])
         self._output_dir = path.join(self._workspace_dir, 'output')
+        # Where the instances find their files, see EXPERIMENT_DIR in run_in_env.py.
+        self._experiment_dir = path.dirname(path.abspath(conf_path))
         self._env_runner = "scripts/run_in_env.py"
+        self._output_collector = None
+        self._output_pull_d = None
+        if config['command_output_dir']:
+            # Write the output of the commands to files instead of logging every line.
+            OutputStream.raw_dir = path.join(self._workspace_dir, config['command_output_dir'])
+            OutputStream.sample = config['command_output_sample']
+            OutputStream.report_interval = config['command_output_report_interval']
 
     def logPrefix(self):
         return "ExperimentRunner"
 
     def copyWorkspaceToHeadNodes(self):
+        if self._cfg.as_bool('incremental_workspace_sync'):
+            return self.shipWorkspaceToHeadNodes()
+
         self._logger.info("Syncing workspaces on remote head nodes...")
 
         def onCopySuccess(ignored):
@@ -89,7 +120,7 @@ class ExperimentRunner():
         for host in self._cfg['head_nodes']:
             pp = OneShotProcessProtocol("Rsync to remote %s" % host)
             workspace_dir = self._cfg['workspace_dir']
-            args = ("/usr/bin/rsync", "-az", "--recursive", "--exclude=.git*",
+            args = ("/usr/bin/rsync", "-az", "--recursive", "--exclude=.git*", "--exclude=.gumby_manifests",
                     "--exclude=.svn", "--exclude=local", "--exclude=output", "--delete-excluded", "--delete-during",
                     workspace_dir + '/', ":".join((host, self._remote_workspace_dir + '/')
                                                   ))
@@ -97,11 +128,60 @@ class ExperimentRunner():
             reactor.spawnProcess(pp, args[0], args)
 
             copy_list.append(pp.getDeferred().addErrback(onSingleCopyFailure, host))
+            # The remote workspace isn't the one the incremental synchronization knows about anymore.
+            WorkspaceSync(self._workspace_dir, host, self._remote_workspace_dir).forget()
 
         d = gatherResults(copy_list, consumeErrors=True)
         d.addCallbacks(onCopySuccess, onCopyFailure)
         return d
 
+    def shipWorkspaceToHeadNodes(self):
+        """
+        Ships only what changed in the workspace since the last run to every head node, see gumby.workspace.
+        """
+        self._logger.info("Shipping workspace changes to remote head nodes...")
+
+        def ship(sync):
+            has_archive = sync.prepare(manifest)
+            pp = OneShotProcessProtocol("Ship to remote %s" % sync.host)
+            args = ("/usr/bin/ssh", sync.host, sync.remote_command)
+            self._logger.info("Running: %s ", ' '.join(args))
+            reactor.spawnProcess(pp, args[0], args)
+            if has_archive:
+                FileSender().beginFileTransfer(sync.archive, pp.transport).addBoth(
+                    lambda _, transport: transport.closeStdin(), pp.transport)
+            else:
+                pp.transport.closeStdin()
+            return pp.getDeferred().addCallbacks(onShipSuccess, onShipFailure, (sync,), None, (sync,))
+
+        def onShipSuccess(_, sync):
+            sync.commit()
+
+        def onShipFailure(failure, sync):
+            stale = sync.previous is not None and getattr(failure.value, 'exitCode', None) == STALE_EXIT_CODE
+            sync.forget()
+            if stale:
+                self._logger.warning("The workspace on %s isn't the one shipped last time, shipping all of it.",
+                                     sync.host)
+                return ship(sync)
+            self._logger.error("Failed to ship the workspace to the remote host: %s.", sync.host)
+            return failure
+
+        def onCopyFailure(failure):
+            self._logger.error("Meh, copy fail.")
+            return failure
+
+        syncs = [WorkspaceSync(self._workspace_dir, host, self._remote_workspace_dir)
+                 for host in self._cfg['head_nodes']]
+        if not syncs:
+            return succeed(None)
+        # The tree is only walked once, the files that didn't change since any host was synced aren't read again.
+        manifest = scan_workspace(self._workspace_dir, next((sync.previous for sync in syncs if sync.previous), None))
+
+        d = gatherResults([ship(sync) for sync in syncs], consumeErrors=True)
+        d.addErrback(onCopyFailure)
+        return d
+
     def collectOutputFromHeadNodes(self):
         self._logger.info("Syncing output data back from head nodes...")
 
@@ -123,22 +203,73 @@ class ExperimentRunner():
         except OSError:
             pass
 
-        for host in self._cfg['head_nodes']:
-            pp = OneShotProcessProtocol("Rsync from remote %s" % host)
-            args = ("/usr/bin/rsync", "-az", "--recursive", "--exclude=.git*",
-                    "--exclude=.svn", "--exclude=local", "--delete-excluded", "--delete-during",
-                    ":".join((host, self._remote_workspace_dir + '/output/')),
-                    path.join(self._workspace_dir, "output", host) + "/"
-                    )
-            self._logger.info("Running: %s ", ' '.join(args))
-            reactor.spawnProcess(pp, args[0], args)
-
-            copy_list.append(pp.getDeferred().addErrback(onSingleCopyFailure, host))
+        def collect(_):
+            for host in self._cfg['head_nodes']:
+                d = self._rsyncOutputFromHeadNode(host, "--delete-excluded", "--delete-during")
+                copy_list.append(d.addErrback(onSingleCopyFailure, host))
+            return gatherResults(copy_list, consumeErrors=True)
 
-        d = gatherResults(copy_list, consumeErrors=True)
+        # Don't race with the last pull of the background collector.
+        d = self.stopOutputCollector()
+        d.addCallback(collect)
         d.addCallbacks(onCopySuccess, onCopyFailure)
         return d
 
+    def _rsyncOutputFromHeadNode(self, host, *options):
+        pp = OneShotProcessProtocol("Rsync from remote %s" % host)
+        args = ("/usr/bin/rsync", "-az", "--recursive", "--exclude=.git*", "--exclude=.svn", "--exclude=local") + \
+            options + (":".join((host, self._remote_workspace_dir + '/output/')),
+                       path.join(self._workspace_dir, "output", host) + "/")
+        self._logger.info("Running: %s ", ' '.join(args))
+        reactor.spawnProcess(pp, args[0], args)
+        return pp.getDeferred()
+
+    def startOutputCollector(self):
+        """
+        Pulls the output data from the head nodes every output_collect_interval seconds while the experiment runs, so
+        collectOutputFromHeadNodes() only has a small delta left to transfer.
+        """
+        interval = self._cfg['output_collect_interval']
+        if interval and self._cfg['head_nodes']:
+            self._logger.info("Collecting the output data from the head nodes every %d seconds", interval)
+            try:
+                makedirs(self._output_dir)
+            except OSError:
+                pass
+            self._output_collector = LoopingCall(self.pullOutputFromHeadNodes)
+            self._output_collector.start(interval, now=False)
+
+    def stopOutputCollector(self):
+        """
+        Stops the background collector, the returned Deferred fires once its ongoing pull (if any) finished.
+        """
+        if self._output_collector is not None and self._output_collector.running:
+            self._output_collector.stop()
+        self._output_collector = None
+
+        d = Deferred()
+        if self._output_pull_d is None:
+            d.callback(None)
+        else:
+            self._output_pull_d.addBoth(lambda result: d.callback(None) or result)
+        return d
+
+    def pullOutputFromHeadNodes(self):
+        def onPullFailure(failure, host):
+            # Not fatal, the next pull or the final collection will get it.
+            self._logger.warning("Failed to pull the output data from the remote host %s: %s", host,
+                                 failure.getErrorMessage())
+
+        def onPullDone(_):
+            self._output_pull_d = None
+
+        # Logs only grow, only their new tails are sent. The final collection fixes any file rewritten in between.
+        pulls = [self._rsyncOutputFromHeadNode(host, "--append-verify").addErrback(onPullFailure, host)
+                 for host in self._cfg['head_nodes']]
+        # LoopingCall waits for it, so pulls never overlap.
+        self._output_pull_d = gatherResults(pulls).addCallback(onPullDone)
+        return self._output_pull_d
+
     def spawnTracker(self):
         def onTrackerFailure(failure):
             self._logger.error("Tracked died, stopping experiment.")
@@ -214,23 +345,24 @@ class ExperimentRunner():
         self._logger.info("Running local and remote setup scripts")
         return gatherResults((self.runRemoteSetup(), self.runLocalSetup()), consumeErrors=True)
 
-    def runCommand(self, command, remote=False):
+    def runCommand(self, command, remote=False, on_line=None):
         if remote:
             self._logger.info("Remotely running command %s", command)
-            return self.runCommandOnAllRemotes(command)
+            return self.runCommandOnAllRemotes(command, on_line)
         else:
             self._logger.info("Locally running command %s", command)
-            return self.runLocalCommand(command)
+            return self.runLocalCommand(command, on_line)
 
-    def runLocalCommand(self, command):
+    def runLocalCommand(self, command, on_line=None):
         # use the local _env_runner
         env_runner = path.abspath(path.join(path.dirname(__file__), "..", self._env_runner))
         args = [env_runner, self._cfg_path, command]
-        pp = OneShotProcessProtocol(command)
+        # on_line is called with (HOST, LINE), HOST being None for the local commands.
+        pp = OneShotProcessProtocol(command, on_line=partial(on_line, None) if on_line else None)
         reactor.spawnProcess(pp, env_runner, args, env=self.local_env)  # Inherit env from parent + conf vars
         return pp.getDeferred()
 
-    def runCommandOnAllRemotes(self, command):
+    def runCommandOnAllRemotes(self, command, on_line=None):
         remote_instance_list = []
         # TODO: Allow for other venv dirs to be used by setting the path in the config file.
         # use remote _env_runner
@@ -241,9 +373,45 @@ class ExperimentRunner():
         args = " ".join((python, path.join(self._remote_workspace_dir, 'gumby', self._env_runner), " ", self._cfg_path, " ", command))
         for host in self._cfg['head_nodes']:
             self._logger.info("Executing command in %s: %s", host, args)
-            remote_instance_list.append(runRemoteCMD(host, args))
+            remote_instance_list.append(runRemoteCMD(host, args, partial(on_line, host) if on_line else None))
         return gatherResults(remote_instance_list, consumeErrors=True)
 
+    def runBackgroundCommand(self, command, remote, ready_line):
+        """
+        Runs a command meant to run during the whole experiment (tracker, config server...).
+
+        Returns a (FINISHED, READY) tuple of Deferreds. READY fires once ready_line has been found in the output of
+        every instance of the command (one per head node when running remotely). It also fires if the command exits
+        before, or after ready_timeout seconds (with a warning) for commands that never print it. Without ready_line
+        there's no way to tell, it fires after NO_READY_LINE_DELAY seconds.
+        """
+        ready = Deferred()
+        expected = len(self._cfg['head_nodes']) if remote else 1
+        ready_hosts = set()
+
+        def onLine(host, line):
+            if ready_line in line and not ready.called:
+                ready_hosts.add(host)
+                if len(ready_hosts) >= expected:
+                    ready.callback(None)
+
+        def onTimeout():
+            if ready_line:
+                self._logger.warning("%s didn't print \"%s\" in %d seconds, going on anyway", command, ready_line,
+                                     self._cfg['ready_timeout'])
+            ready.callback(None)
+
+        def onFinished(result):
+            if not ready.called:
+                ready.callback(None)
+            return result
+
+        finished = self.runCommand(command, remote, onLine if ready_line else None)
+        timeout = reactor.callLater(self._cfg['ready_timeout'] if ready_line else NO_READY_LINE_DELAY, onTimeout)
+        ready.addCallback(lambda _: timeout.active() and timeout.cancel())
+        finished.addBoth(onFinished)
+        return finished, ready
+
     def startTracker(self):
         def onTrackerFailure(failure):
             self._logger.error("Tracker has exited with status: %s", failure.getErrorMessage())
@@ -252,11 +420,11 @@ class ExperimentRunner():
             reactor.stop()
 
         if self._cfg['tracker_cmd']:
-            self._tracker_d = self.runCommand(self._cfg['tracker_cmd'], self._cfg.as_bool('tracker_run_remote'))
+            self._tracker_d, ready = self.runBackgroundCommand(self._cfg['tracker_cmd'],
+                                                               self._cfg.as_bool('tracker_run_remote'),
+                                                               self._cfg['tracker_ready_line'])
             self._tracker_d.addErrback(onTrackerFailure)
-            d = Deferred()
-            reactor.callLater(1, d.callback, None)
-            return d
+            return ready
         else:
             return succeed(None)
 
@@ -271,11 +439,16 @@ class ExperimentRunner():
             # TODO: This is not very flexible, refactor it to have a background_commands
             # list instead of experiment_server_cmd, tracker_cmd, etc...
             # Only run it on the DAS head node if we aren't using systemtap.
-            self._config_server_d = self.runCommand(self._cfg['experiment_server_cmd'], self._cfg.as_bool('experiment_server_run_remote'))
+            server_cmd = self._cfg['experiment_server_cmd']
+            ready_line = self._cfg['experiment_server_ready_line']
+            # Only wait for the line of our own server by default, others may never print it.
+            if not ready_line and path.basename(server_cmd.split()[0]) == "experiment_server.py":
+                ready_line = EXPERIMENT_SERVER_READY_LINE
+            self._config_server_d, ready = self.runBackgroundCommand(self._cfg['experiment_server_cmd'],
+                                                                     self._cfg.as_bool('experiment_server_run_remote'),
+                                                                     ready_line)
             self._config_server_d.addErrback(onConfigServerDied)
-            d = Deferred()
-            reactor.callLater(1, d.callback, None)
-            return d
+            return ready
         else:
             return succeed(None)
 
@@ -301,12 +474,20 @@ class ExperimentRunner():
             self._logger.info("Post processing collected data")
             return self.runCommand(self._cfg['post_process_cmd'])
 
-    def run(self):
+    def run(self, resume_from=None, only=None):
+        """
+        Runs all the steps of the experiment, or, to reuse the output of a previous run, only the steps from
+        resume_from on or only the given list of steps. See buildStepGraph() for the step names.
+
+        Raises ValueError if the steps to skip haven't been completed with the current configuration.
+        """
         def onExperimentSucceeded(_):
+            self.logStepReport(graph)
             self._logger.info("experiment suceeded")
             reactor.stop()
 
         def onExperimentFailed(failure):
+            self.logStepReport(graph)
             self._logger.error("Experiment execution failed, exiting with error.")
             self._logger.error(repr(failure))
 
@@ -317,53 +498,117 @@ class ExperimentRunner():
 
         chdir(self._workspace_dir)
 
-        # Step 1:
         # Inject all the config options as env variables to give sub-processes easy acces to them.
         self.local_env = environ.copy()
         self.local_env.update(configToEnv(self._cfg))
         self.local_env['LOCAL_RUN'] = 'True'
 
-        # Step 2:
-        # Clear output dir before starting.
-        if path.exists(self._output_dir):
-            rmtree(self._output_dir)
+        if resume_from or only:
+            # Keep the output and the steps completed by the previous run.
+            graph = self.buildStepGraph()
+            if resume_from:
+                graph.resume_from(resume_from)
+            else:
+                graph.only(only)
+            self._logger.info("Skipping the steps: %s", ", ".join(sorted(graph.skipped)))
+        else:
+            # Clear output dir before starting.
+            if path.exists(self._output_dir):
+                rmtree(self._output_dir)
+            graph = self.buildStepGraph()
 
-        # Step 3:
-        # Sync the working dir with the head nodes
         d = Deferred()
-        d.addCallback(lambda _: self.copyWorkspaceToHeadNodes())
+        d.addCallback(lambda _: graph.run())
+        reactor.callLater(0, d.callback, None)
 
-        # Step 4:
-        # Run the set up script, both locally and in the head nodes
-        d.addCallback(lambda _: self.runSetupScripts())
+        return d.addCallbacks(onExperimentSucceeded, onExperimentFailed)
 
-        # Step 5:
-        # Start the tracker, either locally or on the first head node of the list.
-        d.addCallback(lambda _: self.startTracker())
+    def getScenarioPath(self):
+        """
+        Returns the path of the scenario the instances read, None if the experiment doesn't have one.
+        """
+        if self._cfg.get('scenario_file'):
+            return path.join(self._experiment_dir, self._cfg['scenario_file'])
 
-        # Step 6:
-        # Start the config server, always locally if running instances locally as the head nodes are firewalled and
-        # can only be reached from the outside trough SSH.
-        d.addCallback(lambda _: self.startExperimentServer())
+    def compileScenario(self):
+        def onCompileSuccess(index_filename):
+            self._logger.info("Compiled the scenario index %s.", index_filename)
 
-        # Step 7:
-        # Spawn both local and remote instance runner scripts, which will connect to the config server and wait for all
-        # of them to be ready before starting the experiment.
-        d.addCallback(lambda _: self.startInstances())
-
-        # Step 8:
-        # Collect all the data from the remote head nodes.
-        d.addCallback(lambda _: self.collectOutputFromHeadNodes())
+        def onCompileFailure(failure):
+            self._logger.error("Failed to compile the scenario index: %s", failure.getErrorMessage())
+            return failure
 
-        # Step 9:
-        # Extract the data and graph stuff
-        d.addCallback(lambda _: self.runPostProcess())
+        scenario_path = self.getScenarioPath()
+        if not scenario_path:
+            return succeed(None)
+        index = ScenarioIndex.load(scenario_path)
+        if index:
+            index.close()
+            self._logger.info("The scenario index of %s is up to date.", scenario_path)
+            return succeed(None)
+        d = deferToThread(ScenarioIndex.compile, scenario_path)
+        d.addCallbacks(onCompileSuccess, onCompileFailure)
+        return d
 
-        # TODO: From here onwards
-        reactor.callLater(0, d.callback, None)
-        # reactor.callLater(60, reactor.stop)
+    def workspaceDigest(self):
+        """
+        Returns the digest of the contents of the workspace, without the output and local dirs.
+        """
+        # Reuse the digests of the last synchronization so only the files touched since then are read.
+        previous = next((sync.previous for sync in (WorkspaceSync(self._workspace_dir, host, self._remote_workspace_dir)
+                                                    for host in self._cfg['head_nodes']) if sync.previous), None)
+        manifest = scan_workspace(self._workspace_dir, previous)
+        # The scenario index is derived from the scenario, which is already part of the digest, and is only written
+        # once the graph has been built.
+        scenario_path = self.getScenarioPath()
+        if scenario_path:
+            manifest.pop(path.relpath(ScenarioIndex.path_for(scenario_path), self._workspace_dir), None)
+        return content_digest(manifest)
+
+    def buildStepGraph(self):
+        """
+        Declares the steps of the experiment and what each one has to wait for, the rest runs concurrently.
+
+        The completed steps are recorded in the output dir along with the config options and workspace contents they
+        depend on, so a later run can resume from any step as long as the steps before it ran with the same inputs.
+        """
+        graph = StepGraph(path.join(self._output_dir, CHECKPOINT_FILE))
+        cfg = self._cfg
+        # The tracker and the config server run on the head nodes after setting them up or locally after the local set
+        # up. The config server always runs locally if running instances locally, as the head nodes are firewalled and
+        # can only be reached from the outside trough SSH.
+        tracker_setup = 'remote_setup' if self._cfg.as_bool('tracker_run_remote') else 'local_setup'
+        server_setup = 'remote_setup' if self._cfg.as_bool('experiment_server_run_remote') else 'local_setup'
+
+        # The workspace contents are part of the inputs of the steps that use them first, so changing the code or the
+        # scenario invalidates every step after them through the chain of fingerprints.
+        workspace_digest = self.workspaceDigest()
+        # The scenario is compiled before shipping the workspace, so the index reaches the head nodes too.
+        graph.add('compile_scenario', self.compileScenario, inputs=[cfg.get('scenario_file'), workspace_digest])
+        graph.add('sync_workspace', self.copyWorkspaceToHeadNodes, requires=('compile_scenario',),
+                  inputs=[cfg['workspace_dir'], self._remote_workspace_dir, cfg['head_nodes'], workspace_digest])
+        graph.add('local_setup', self.runLocalSetup, inputs=[cfg['local_setup_cmd'], workspace_digest])
+        graph.add('remote_setup', self.runRemoteSetup, requires=('sync_workspace',), inputs=cfg['remote_setup_cmd'])
+        # The background steps are done once started, but they have to be started again to resume from instances.
+        graph.add('tracker', self.startTracker, requires=(tracker_setup,),
+                  inputs=[cfg['tracker_cmd'], cfg['tracker_run_remote']], background=True)
+        graph.add('experiment_server', self.startExperimentServer, requires=(server_setup,),
+                  inputs=[cfg['experiment_server_cmd'], cfg['experiment_server_run_remote']], background=True)
+        graph.add('output_collector', self.startOutputCollector, requires=('sync_workspace',), background=True)
+        # Spawn both local and remote instance runner scripts, which will connect to the config server and wait for all
+        # of them to be ready before starting the experiment. They get the whole config, so any option but the ones
+        # only used afterwards is an input.
+        graph.add('instances', self.startInstances,
+                  requires=('local_setup', 'remote_setup', 'tracker', 'experiment_server', 'output_collector'),
+                  inputs=dict((key, value) for key, value in cfg.iteritems() if key not in POST_EXPERIMENT_OPTIONS))
+        graph.add('collect_output', self.collectOutputFromHeadNodes, requires=('instances',))
+        graph.add('post_process', self.runPostProcess, requires=('collect_output',), inputs=cfg['post_process_cmd'])
+        return graph
 
-        return d.addCallbacks(onExperimentSucceeded, onExperimentFailed)
+    def logStepReport(self, graph):
+        self._logger.info("Experiment steps (wall time in seconds):")
+        for line in graph.report():
+            self._logger.info(line)
 
 
 class OneShotProcessProtocol(ProcessProtocol):
@@ -372,12 +617,16 @@ class OneShotProcessProtocol(ProcessProtocol):
         self._logger = logging.getLogger(self.__class__.__name__)
 
         self.command = command
-        self._stdout_bytes = ''
-        self._stderr_bytes = ''
+        label = self.command[:20].strip() + "..." if len(self.command) > 20 else ""
+        # on_line is called with every line of output of the command.
+        self._stdout = OutputStream(self._logger, '[%s] OUT: %s', label, command + '.out', w.get('on_line'))
+        self._stderr = OutputStream(self._logger, '[%s] ERR: %s', label, command + '.err', w.get('on_line'))
         self._d = Deferred()
 
     def processExited(self, reason):
-        # TODO(emilon): Process self._stdout_bytes, _sterr_bytes before exiting, to make sure no output is lost.
+        # Don't lose the last line if it didn't end with a newline.
+        self._stdout.flush()
+        self._stderr.flush()
         # self._logger.info('CMD "%s" Process exited with reason: %s', self.command, reason)
         self._logger.info('[%s] exit code %s', self.command, reason.value.exitCode)
         if reason.value.exitCode:
@@ -385,30 +634,15 @@ class OneShotProcessProtocol(ProcessProtocol):
         else:
             self._d.callback(None)
 
+    def processEnded(self, reason):
+        self._stdout.close()
+        self._stderr.close()
+
     def outReceived(self, data):
-        # we could recv more than 1 line and/or a partial line.
-        self._stdout_bytes += data
-        remainder = ""
-        for line in self._stdout_bytes.splitlines(True):
-            if line.endswith('\n'):
-                self._logger.info('[%s] OUT: %s', self.command[:20].strip() + "..." if len(self.command) >20 else "",
-                                  line.rstrip())
-            else:
-                # It's a partial line (part of the last one), save it to the buffer instead
-                remainder = line
-        self._stdout_bytes = remainder
+        self._stdout.write(data)
 
     def errReceived(self, data):
-        self._stderr_bytes += data
-        remainder = ""
-        for line in self._stderr_bytes.splitlines(True):
-            if line.endswith('\n'):
-                self._logger.info('[%s] ERR: %s', self.command[:20].strip() + "..." if len(self.command) >20 else "",
-                                  line.rstrip())
-            else:
-                # It's a partial line (part of the last one), save it to the buffer instead
-                remainder = line
-        self._stderr_bytes = remainder
+        self._stderr.write(data)
 
     def getDeferred(self):
         return self._d
@@ -18,6 +18,10 @@
 #     s = ScenarioRunner("./scenario", int(t.peerid))
 #     s.register(t.test_method)
 #     s.run()
+#
+# Big scenarios can be compiled into an index grouping the lines by peer number
+# (see ScenarioIndex), so every instance only needs to read its own lines:
+#     python -m gumby.scenario --compile ./scenario
 
 # Change Log:
 #
@@ -46,25 +50,189 @@
 """Parses and runs scenarios."""
 
 import logging
+import mmap
 import shlex
 import sys
-from itertools import ifilter
-from os import environ
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+from heapq import heappop, heappush, merge
+from itertools import chain, ifilter, islice, takewhile
+from operator import itemgetter
+from gzip import open as gzip_open
+from os import environ, path, rename, stat
+from random import expovariate as random_expovariate
 from re import compile as re_compile
-from threading import RLock
+from struct import Struct, error as StructError
 from time import time
 
 from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred
+
+from gumby.packing import pack, unpack
+
+
+class PeerSet(object):
+
+    """
+    Immutable set of peer numbers stored as sorted, disjoint [low, high] intervals.
+
+    A PEERSPEC like {1-4000} takes two ints instead of 4000, membership is
+    tested with a binary search over the intervals.
+    """
+
+    def __init__(self, intervals=()):
+        starts = []
+        ends = []
+        for low, high in sorted(intervals):
+            if low > high:
+                continue
+            if ends and low <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], high)
+            else:
+                starts.append(low)
+                ends.append(high)
+        self._starts = tuple(starts)
+        self._ends = tuple(ends)
+
+    @property
+    def intervals(self):
+        return zip(self._starts, self._ends)
+
+    @property
+    def first(self):
+        return self._starts[0] if self._starts else None
+
+    @property
+    def last(self):
+        return self._ends[-1] if self._ends else None
+
+    def __contains__(self, peer):
+        i = bisect_right(self._starts, peer) - 1
+        return i >= 0 and peer <= self._ends[i]
+
+    def __iter__(self):
+        for low, high in self.intervals:
+            for peer in xrange(low, high + 1):
+                yield peer
+
+    def __len__(self):
+        return sum(high - low + 1 for low, high in self.intervals)
+
+    def __nonzero__(self):
+        return bool(self._starts)
+
+    def __eq__(self, other):
+        return isinstance(other, PeerSet) and self.intervals == other.intervals
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "PeerSet(%r)" % self.intervals
+
+    def difference(self, other):
+        """
+        Returns a new PeerSet with the peers of this one not in other.
+        """
+        intervals = []
+        excluded = other.intervals
+        i = 0
+        for low, high in self.intervals:
+            # Skip the excluded intervals completely below this one.
+            while i < len(excluded) and excluded[i][1] < low:
+                i += 1
+            j = i
+            while j < len(excluded) and excluded[j][0] <= high:
+                if excluded[j][0] > low:
+                    intervals.append((low, excluded[j][0] - 1))
+                low = excluded[j][1] + 1
+                j += 1
+            if low <= high:
+                intervals.append((low, high))
+        return PeerSet(intervals)
+
+
+class Repeat(object):
+
+    """
+    Repetitions of a scenario line from begin (included) to end (excluded), every interval seconds or, if poisson is
+    set, as Poisson arrivals averaging one every interval seconds.
+    """
+
+    def __init__(self, begin, end, interval, poisson=False):
+        if interval <= 0:
+            raise ValueError("the interval of a repeated line must be positive")
+        self.begin = begin
+        self.end = end
+        self.interval = interval
+        self.poisson = poisson
+
+    def __repr__(self):
+        return "Repeat(%r, %r, %r, %r)" % (self.begin, self.end, self.interval, self.poisson)
+
+    def times(self, rng=None):
+        """
+        Lazily yields the timestamps of the repetitions. rng is the random.Random used for Poisson arrivals.
+        """
+        if self.poisson:
+            expovariate = rng.expovariate if rng else random_expovariate
+            tstmp = self.begin + expovariate(1.0 / self.interval)
+            while tstmp < self.end:
+                yield tstmp
+                tstmp += expovariate(1.0 / self.interval)
+        else:
+            # Multiply instead of accumulating to not drift with fractional intervals.
+            count = 0
+            tstmp = self.begin
+            while tstmp < self.end:
+                yield tstmp
+                count += 1
+                tstmp = self.begin + count * self.interval
 
 
 class ScenarioParser():
     """
     Scenario line format:
         TIMESPEC CALLABLE [ARGS] [PEERSPEC]
+        TIMESPEC-TIMESPEC every [~]INTERVAL CALLABLE [ARGS] [PEERSPEC]
+        TIMESPEC-TIMESPEC rate [~]RATE CALLABLE [ARGS] [PEERSPEC]
+        include FILENAME
+
+        include FILENAME
+
+            Reads the lines of another scenario file in place, FILENAME is
+            relative to the directory of the including file. Scenario files
+            ending in .gz are read compressed.
+
+            Example: "include friends.scenario.gz" splits a huge friend graph
+            off the main scenario.
 
-        TIMESPEC = [@][H:]M:S[-[H:]M:S]
+        TIMESPEC = [@][H:]M:S[.FRACTION]
 
             Use @ to schedule events based on the synchronized experiment starting timestamp.
+            Example: "@1:30.250" is 90.25 seconds after the start.
+
+        TIMESPEC-TIMESPEC every [~]INTERVAL
+
+            Repeats the line from the first TIMESPEC (included) to the second
+            one (excluded) every INTERVAL seconds. With ~, the repetitions are
+            Poisson arrivals: the time between them is exponentially
+            distributed with a mean of INTERVAL seconds.
+
+            Example: "@0:10-1:00:00 every 5 publish 1" publishes every 5 seconds
+            during the first hour, "@0:10-1:00:00 every ~5 publish 1" publishes
+            at random times, 12 times a minute on average.
+
+            The repetitions are generated while running the scenario, they are
+            never stored.
+
+        TIMESPEC-TIMESPEC rate [~]RATE
+
+            Same as every, but giving the amount of repetitions per second, minute
+            or hour: RATE = NUMBER[/s|/m|/h] (default /s).
+
+            Example: "@0:10-0:20 rate 200/s publish" publishes 2000 times.
 
         CALLABLE = string
 
@@ -87,57 +255,70 @@ class ScenarioParser():
                time stamp, they will be executed in order.
     """
     _re_substitution = re_compile("(\$\w+)")
+    # PEERSPEC -> (YES_PEERS, NO_PEERS), shared by all the parsers.
+    _peerspec_cache = {}
+    _rate_units = {'s': 1.0, 'm': 60.0, 'h': 3600.0}
 
     def __init__(self):
         self._logger = logging.getLogger(self.__class__.__name__)
-        self.file_lock = RLock()
-        self.file_buffer = None
 
-    def _read_scenario(self, filename):
-        """
-        Read the scenario into memory return a list containing the lines.
+    def _read_scenario(self, filename, sources=None):
         """
-        with self.file_lock:
-            if not self.file_buffer or self.file_buffer[0] != filename:
-                f = open(filename, "r")
-                lines = f.readlines()
-                f.close()
-
-                line_buffer = []
-
-                linenr = 1
-                for line in lines:
-                    if not line.startswith('#'):
-                        line = line.strip()
-                        line_buffer.append((linenr, line))
-                    linenr += 1
+        Yields the (LINENO, LINE) tuples of the scenario, without comments and
+        with the included files read in place. Nothing is kept in memory.
 
-                self.file_buffer = (filename, line_buffer)
-        return self.file_buffer[1]
+        LINENO counts the lines of the scenario once the includes have been
+        expanded, so it keeps the lines in order. The path of every file read
+        is appended to sources, if given.
+        """
+        linenr = 0
+        for line in self._read_scenario_file(filename, [], sources):
+            linenr += 1
+            if not line.startswith('#'):
+                yield linenr, line.strip()
+
+    def _read_scenario_file(self, filename, including, sources):
+        if filename in including:
+            raise ValueError("Scenario file %s includes itself" % filename)
+        if sources is not None:
+            sources.append(filename)
+
+        with (gzip_open if filename.endswith('.gz') else open)(filename, "r") as f:
+            for line in f:
+                if line.startswith('include '):
+                    included = path.join(path.dirname(filename), line[8:].strip())
+                    for included_line in self._read_scenario_file(included, including + [filename], sources):
+                        yield included_line
+                else:
+                    yield line
 
     def _parse_scenario(self, filename):
         """
         Returns a list of commands that will be executed.
 
-        A command is a (TIMESTAMP, LINENO, CALLABLE, ARGS, PEERSPEC) tuple. CALLABLE is
+        A command is a (TIMESTAMP, LINENO, CALLABLE, ARGS, REPEAT) tuple. CALLABLE is
         the name of a function, method, etc. registered with this scenario using
-        the register() method.
+        the register() method. REPEAT is a Repeat for repeated lines (starting at
+        TIMESTAMP) or None.
         """
         try:
             for lineno, line in self._read_scenario(filename):
-                if line.endswith('}'):
-                    start = line.rfind('{') + 1
-                    peerspec = line[start:-1]
-                    line = line[:start - 1]
-                else:
-                    peerspec = ''
-
+                line, peerspec = self._split_peerspec(line)
                 cmd = self._parse_scenario_line(lineno, line, peerspec)
                 if cmd is not None:
                     yield cmd
 
-        except EnvironmentError:
-            print >> sys.stderr, "Scenario file open/read error", filename
+        except (EnvironmentError, ValueError), e:
+            print >> sys.stderr, "Scenario file open/read error", filename, str(e)
+
+    def _split_peerspec(self, line):
+        """
+        Splits the PEERSPEC off a scenario line, returns a (LINE, PEERSPEC) tuple.
+        """
+        if line.endswith('}'):
+            start = line.rfind('{') + 1
+            return line[:start - 1], line[start:-1]
+        return line, ''
 
     def _parse_scenario_line(self, lineno, line, peerspec):
         """
@@ -150,23 +331,7 @@ class ScenarioParser():
         if self._parse_for_this_peer(peerspec):
             line = self._preprocess_line(line)
             try:
-                parts = line.split(' ', 2)
-                if len(parts) == 3:
-                    timespec, callable, args = parts
-                else:
-                    timespec, callable = parts
-                    args = ''
-
-                if timespec[0] == '@':
-                    timespec = timespec[1:]
-                timespec = timespec.split(':')
-                begin = int(timespec[-1])
-                if len(timespec) > 1:
-                    begin += int(timespec[-2]) * 60
-                if len(timespec) > 2:
-                    begin += int(timespec[-3]) * 3600
-
-                return (begin, lineno, callable, shlex.split(args))
+                return self._parse_command(lineno, line)
 
             except Exception, e:
                 print >> sys.stderr, "Ignoring invalid scenario line", lineno, line, str(e)
@@ -174,37 +339,116 @@ class ScenarioParser():
         # line not for this peer or a parse error occurred
         return None
 
+    def _parse_command(self, lineno, line):
+        """
+        Parses a preprocessed scenario line without PEERSPEC into a command tuple.
+        """
+        parts = line.split(' ', 2)
+        if len(parts) == 3:
+            timespec, callable, args = parts
+        else:
+            timespec, callable = parts
+            args = ''
+
+        repeat = None
+        if '-' in timespec:
+            begin, end = timespec.split('-')
+            begin = self._parse_timespec(begin)
+            kind = callable
+            if kind not in ('every', 'rate'):
+                raise ValueError("a time range needs an 'every [~]INTERVAL' or 'rate [~]RATE' clause")
+
+            parts = args.split(' ', 2)
+            if len(parts) == 3:
+                frequency, callable, args = parts
+            else:
+                frequency, callable = parts
+                args = ''
+            poisson = frequency[0] == '~'
+            frequency = frequency.lstrip('~')
+            interval = float(frequency) if kind == 'every' else 1.0 / self._parse_rate(frequency)
+            repeat = Repeat(begin, self._parse_timespec(end), interval, poisson)
+        else:
+            begin = self._parse_timespec(timespec)
+
+        return (begin, lineno, callable, shlex.split(args), repeat)
+
+    def _parse_timespec(self, timespec):
+        if timespec[0] == '@':
+            timespec = timespec[1:]
+        timespec = timespec.split(':')
+        begin = float(timespec[-1]) if '.' in timespec[-1] else int(timespec[-1])
+        if len(timespec) > 1:
+            begin += int(timespec[-2]) * 60
+        if len(timespec) > 2:
+            begin += int(timespec[-3]) * 3600
+        return begin
+
+    def _parse_rate(self, rate):
+        """
+        Parses NUMBER[/s|/m|/h] into events per second.
+        """
+        rate, _, unit = rate.partition('/')
+        rate = float(rate) / self._rate_units[unit or 's']
+        if rate <= 0:
+            raise ValueError("the rate of a repeated line must be positive")
+        return rate
+
+    def _parse_load_options(self, args):
+        """
+        Splits the OPTION=VALUE args of a load line (see ScenarioRunner.load()) from the args of its callable, returns
+        an (OPTIONS, ARGS) tuple.
+        """
+        options = {}
+        args = list(args)
+        while args and args[0].split('=', 1)[0] in ('rate', 'duration', 'dist', 'max_backlog', 'report'):
+            key, value = args.pop(0).split('=', 1)
+            options[key] = value
+        if 'rate' not in options or 'duration' not in options:
+            raise ValueError("load needs the rate and duration options")
+        if options.get('dist', 'fixed') not in ('fixed', 'poisson'):
+            raise ValueError("unknown load distribution %r" % options['dist'])
+
+        return {'rate': self._parse_rate(options['rate']),
+                'duration': self._parse_timespec(options['duration']),
+                'poisson': options.get('dist') == 'poisson',
+                'max_backlog': int(options['max_backlog']) if 'max_backlog' in options else None,
+                'report': float(options.get('report', 10))}, args
+
     def _parse_peerspec(self, peerspec):
         """
-        Checks if current peernumber matches a peer specification.
+        Parses a peer specification into a (YES_PEERS, NO_PEERS) tuple of PeerSets.
 
         A peer specification if formatted as:
             [{PEERNR1 [, PEERNR2, ...] [, PEERNR3-PEERNR6, ...]}]
 
         Note: An empty peer specification matches everything.
-        """
-        # get individual peers, if any, for a peer spec
-        yes_peers = set()
-        no_peers = set()
 
-        if peerspec:
-            if peerspec[0] == "!":
-                peers = no_peers
-                peerspec = peerspec[1:]
-            else:
-                peers = yes_peers
+        The same PEERSPEC is usually found in many lines, the parsed PeerSets
+        are cached and shared.
+        """
+        try:
+            return self._peerspec_cache[peerspec]
+        except KeyError:
+            pass
 
-            for peer in peerspec.split(","):
-                peer = peer.strip()
-                if peer:
-                    # parse the peer number (or peer number pair)
-                    if "-" in peer:
-                        low, high = peer.split("-")
-                        peers.update(xrange(int(low), int(high) + 1))
-                    else:
-                        peers.add(int(peer))
+        # get individual peers, if any, for a peer spec
+        intervals = []
+        negated = peerspec[:1] == "!"
+        for peer in peerspec[1 if negated else 0:].split(","):
+            peer = peer.strip()
+            if peer:
+                # parse the peer number (or peer number pair)
+                if "-" in peer:
+                    low, high = peer.split("-")
+                    intervals.append((int(low), int(high)))
+                else:
+                    intervals.append((int(peer), int(peer)))
 
-        return yes_peers, no_peers
+        peers = PeerSet(intervals)
+        result = (PeerSet(), peers) if negated else (peers, PeerSet())
+        self._peerspec_cache[peerspec] = result
+        return result
 
     def _parse_for_this_peer(self):
         raise NotImplementedError('override this method please')
@@ -217,6 +461,202 @@ class ScenarioParser():
 
         return line
 
+class ScenarioIndex(object):
+
+    """
+    Precompiled index of a scenario file grouping its lines by peer number.
+
+    Compiling the index once (see compile()) spares every instance of the
+    experiment from reading the whole scenario and matching the PEERSPEC of
+    every line against its own peer number, lines_for_peer() only reads the
+    lines of one peer from the memory mapped index.
+
+    Lines are stored already parsed into (TIMESTAMP, CALLABLE, ARGS[, REPEAT]), except
+    the ones with $VARIABLES (every instance substitutes its own environment)
+    or errors, which are stored as text without PEERSPEC and parsed when
+    loaded. The index is ignored once the scenario file or one of the files
+    it includes changes (size or modification time).
+
+    Layout (all integers are unsigned and big endian):
+        header
+        sources: [FILENAME, SIZE, MTIME] of every file read (relative to the directory of the
+                 scenario), packed with gumby.packing
+        LINENO of every line
+        offset in the blob of every line (+ end of the blob)
+        per peer offsets in the peer entries (+ end)
+        peer entries: line indexes of the lines for specific peers
+        line indexes of the lines for all peers (empty or negated PEERSPEC)
+        per common line offsets in the excluded peers (+ end)
+        excluded peers, sorted for every common line
+        blob: every line packed with gumby.packing
+    """
+    MAGIC = 'GUMBYSI2'
+    # magic, size of the sources, lines, peers (highest peer number + 1), peer entries, common lines, excluded peers
+    _header = Struct('!8sIIIIII')
+    _uint = Struct('!I')
+
+    def __init__(self, index_filename):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        with open(index_filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (self.magic, sources_size, self.line_count, self.peer_count, peer_entry_count, self.common_count,
+         excluded_count) = self._header.unpack_from(self._map)
+        self.sources = unpack(self._map[self._header.size:self._header.size + sources_size]) \
+            if self.magic == self.MAGIC else []
+
+        size = self._uint.size
+        self._linenos = self._header.size + sources_size
+        self._line_offsets = self._linenos + self.line_count * size
+        self._peer_rows = self._line_offsets + (self.line_count + 1) * size
+        self._peer_entries = self._peer_rows + (self.peer_count + 1) * size
+        self._common = self._peer_entries + peer_entry_count * size
+        self._excluded_rows = self._common + self.common_count * size
+        self._excluded = self._excluded_rows + (self.common_count + 1) * size
+        self._blob = self._excluded + excluded_count * size
+
+    @staticmethod
+    def path_for(filename):
+        return filename + '.idx'
+
+    @classmethod
+    def load(cls, filename, index_filename=None):
+        """
+        Returns the index of the scenario file or None if it hasn't been compiled or is stale.
+        """
+        index_filename = index_filename or cls.path_for(filename)
+        try:
+            index = cls(index_filename)
+            sources = cls._stat_sources(filename, [source for source, _, _ in index.sources])
+        except (EnvironmentError, ValueError, StructError):
+            return None
+
+        if index.magic != cls.MAGIC or sources != index.sources:
+            index._logger.warning("Ignoring stale scenario index %s", index_filename)
+            index.close()
+            return None
+        return index
+
+    @classmethod
+    def compile(cls, filename, index_filename=None):
+        """
+        Writes the index of a scenario file, returns the path of the index.
+        """
+        index_filename = index_filename or cls.path_for(filename)
+        parser = ScenarioParser()
+        sources = []
+
+        linenos = array('I')
+        line_offsets = array('I', [0])
+        peer_rows = []
+        common = array('I')
+        excluded_rows = array('I', [0])
+        excluded = array('I')
+        blob = []
+        blob_size = 0
+
+        for index, (lineno, line) in enumerate(parser._read_scenario(filename, sources)):
+            line, peerspec = parser._split_peerspec(line)
+            yes_peers, no_peers = parser._parse_peerspec(peerspec)
+            if not parser._re_substitution.search(line):
+                try:
+                    tstmp, _, clb, args, repeat = parser._parse_command(lineno, line)
+                    line = [tstmp, clb, args]
+                    if repeat is not None:
+                        line.extend([repeat.end, repeat.interval, repeat.poisson])
+                except Exception:
+                    pass
+            line = pack(line)
+            if yes_peers:
+                for peer in yes_peers:
+                    if peer >= len(peer_rows):
+                        peer_rows.extend([] for _ in xrange(peer + 1 - len(peer_rows)))
+                    peer_rows[peer].append(index)
+            else:
+                common.append(index)
+                excluded.extend(no_peers)
+                excluded_rows.append(len(excluded))
+
+            linenos.append(lineno)
+            blob.append(line)
+            blob_size += len(line)
+            line_offsets.append(blob_size)
+
+        peer_offsets = array('I', [0])
+        peer_entries = array('I')
+        for row in peer_rows:
+            peer_entries.extend(row)
+            peer_offsets.append(len(peer_entries))
+
+        directory = path.dirname(filename) or '.'
+        sources = pack(cls._stat_sources(filename, [path.relpath(source, directory) for source in sources]))
+
+        tmp_filename = index_filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(cls._header.pack(cls.MAGIC, len(sources), len(linenos), len(peer_rows), len(peer_entries),
+                                     len(common), len(excluded)))
+            f.write(sources)
+            for table in (linenos, line_offsets, peer_offsets, peer_entries, common, excluded_rows, excluded):
+                if sys.byteorder == 'little':
+                    table.byteswap()
+                f.write(table.tostring())
+            f.writelines(blob)
+        rename(tmp_filename, index_filename)
+        return index_filename
+
+    @staticmethod
+    def _stat_sources(filename, sources):
+        directory = path.dirname(filename)
+        return [[source, stat(path.join(directory, source)).st_size, stat(path.join(directory, source)).st_mtime]
+                for source in sources]
+
+    def close(self):
+        self._map.close()
+
+    def _read_uints(self, offset, begin, end):
+        table = array('I')
+        table.fromstring(self._map[offset + begin * self._uint.size:offset + end * self._uint.size])
+        if sys.byteorder == 'little':
+            table.byteswap()
+        return table
+
+    def _read_uint(self, offset, index):
+        return self._uint.unpack_from(self._map, offset + index * self._uint.size)[0]
+
+    def _is_excluded(self, common_index, peernumber):
+        # Binary search in the sorted excluded peers of the common line.
+        low = self._read_uint(self._excluded_rows, common_index)
+        high = self._read_uint(self._excluded_rows, common_index + 1)
+        while low < high:
+            middle = (low + high) // 2
+            peer = self._read_uint(self._excluded, middle)
+            if peer == peernumber:
+                return True
+            if peer < peernumber:
+                low = middle + 1
+            else:
+                high = middle
+        return False
+
+    def lines_for_peer(self, peernumber):
+        """
+        Yields the (LINENO, LINE) tuples of peernumber in scenario order. LINE is either a
+        [TIMESTAMP, CALLABLE, ARGS] list (+ [END, INTERVAL, POISSON] for repeated lines) or the text
+        of the line without PEERSPEC.
+        """
+        if 0 <= peernumber < self.peer_count:
+            row = self._read_uints(self._peer_rows, peernumber, peernumber + 2)
+            own = self._read_uints(self._peer_entries, row[0], row[1])
+        else:
+            own = ()
+        common = (index for common_index, index in enumerate(self._read_uints(self._common, 0, self.common_count))
+                  if not self._is_excluded(common_index, peernumber))
+
+        for index in merge(own, common):
+            begin, end = self._read_uints(self._line_offsets, index, index + 2)
+            yield self._read_uint(self._linenos, index), unpack(self._map[self._blob + begin:self._blob + end])
+
+
 class ScenarioRunner(ScenarioParser):
 
     """
@@ -229,23 +669,60 @@ class ScenarioRunner(ScenarioParser):
     Users should register callables using register() before calling run(). All
     scenario events (lines) using unregistered callable names will be silently
     ignored. The callables will be executed on the main Twisted thread.
+
+    Callables registered with suspend=True (barriers) can return a Deferred,
+    the rest of the scenario won't be scheduled until it fires. It can fire with
+    the timestamp at which the scenario should continue (defaults to now), all
+    the following events are delayed by the time spent waiting.
+
+    Callables registered with batch=True are called once for consecutive lines
+    with the same timestamp, with the list of the ARGS of every line. E.g. the
+    dozens of "@0:2 add_friend N" lines of a peer become a single call.
+
+    Repeated lines are kept apart from the rest of the actions in
+    _my_repeats, the next repetition of each one is kept in a heap.
+
+    If the scenario has been compiled (see ScenarioIndex), parse_file() only
+    reads the lines of this peer from the index.
+
+    The built-in "load" action generates open-loop load on a registered
+    callable, see load(). Set load_reporter to a callable to get the load
+    statistics instead of logging them.
     """
+    load_reporter = None
 
     def __init__(self, filename, expstartstamp=None):
         ScenarioParser.__init__(self)
         self.filename = filename
 
         self._callables = {}
+        self._suspending = set()
+        self._batched = set()
         self._expstartstamp = expstartstamp
         self._origin = None  # will be set just before run()-ing
         self._my_actions = []
+        # (REPEAT, CALLABLE, ARGS) of the repeated lines.
+        self._my_repeats = []
+        # Heap of the next repetition of every repeated line, see _queue_repetition().
+        self._repeat_queue = []
+        # Accumulated delay caused by the suspending events.
+        self._time_shift = 0
+        self._index = None
+        # Position of the next action to run and the reactor timer armed for it.
+        self._next_action = 0
+        self._timer = None
+        # Timing records of the actions run, if enabled.
+        self._timings = None
+        # Amount of times every callable has been run.
+        self._dispatched = defaultdict(int)
+        self._callables['load'] = self.load
 
         self._is_parsed = False
 
     def set_peernumber(self, peernumber):
         self._peernumber = peernumber
 
-    def register(self, clb, name=None):
+    def register(self, clb, name=None, suspend=False, batch=False):
         """
         Registers callable to be used from a scenario file. An optional
         different name can be assigned.
@@ -253,20 +730,65 @@ class ScenarioRunner(ScenarioParser):
         if name is None:
             name = clb.__name__
         self._callables[name] = clb
+        if suspend:
+            self._suspending.add(name)
+        if batch:
+            self._batched.add(name)
+
+    def load_index(self):
+        """
+        Opens the compiled index of the scenario, returns False if there isn't an up to date one.
+        """
+        if self._index is None:
+            self._index = ScenarioIndex.load(self.filename)
+        return self._index is not None
+
+    def _parse_scenario_index(self):
+        for lineno, line in self._index.lines_for_peer(self._peernumber):
+            if isinstance(line, list):
+                tstmp, clb, args = line[:3]
+                yield (tstmp, lineno, clb, args, Repeat(tstmp, *line[3:]) if len(line) > 3 else None)
+            else:
+                cmd = self._parse_scenario_line(lineno, line, '')
+                if cmd is not None:
+                    yield cmd
 
     def parse_file(self):
-        for (tstmp, _, clb, args) in self._parse_scenario(self.filename):
+        if self.load_index():
+            self._logger.info("Using the compiled index of %s", self.filename)
+            commands = self._parse_scenario_index()
+        else:
+            commands = self._parse_scenario(self.filename)
+
+        for (tstmp, _, clb, args, repeat) in commands:
             if clb not in self._callables:
                 self._logger.error("'%s' is not registered as an action!", clb)
                 continue
 
-            self._my_actions.append((tstmp, clb, args))
+            if repeat is None:
+                self._my_actions.append((tstmp, clb, args))
+            else:
+                self._my_repeats.append((repeat, clb, args))
 
+        if self._index is not None:
+            self._index.close()
+            self._index = None
         self._is_parsed = True
 
+    def iter_actions(self):
+        """
+        Yields the (WHEN, CALLABLE, ARGS) of every action of this peer once parsed, WHEN being the timestamp of the
+        action or the Repeat of a repeated line.
+        """
+        return chain(self._my_actions, self._my_repeats)
+
     def run(self):
         """
-        Schedules calls for each scenario line.
+        Starts running the scenario lines at their scheduled time.
+
+        The actions are kept sorted by time and only one reactor timer is armed
+        at a time, for the next due action. This way the reactor doesn't have to
+        keep track of thousands of delayed calls during the whole experiment.
         """
         self._logger.info("Running scenario from file: %s", self.filename)
 
@@ -276,14 +798,172 @@ class ScenarioRunner(ScenarioParser):
         if self._expstartstamp == None:
             self._expstartstamp = time()
 
-        for tstmp, clb, args in self._my_actions:
-            tstmp = tstmp + self._expstartstamp
-            delay = tstmp - time()
-            reactor.callLater(
-                delay if delay > 0.0 else 0,
-                self._callables[clb],
-                *args
-            )
+        # Stable sort, lines with the same timestamp keep their order.
+        self._my_actions.sort(key=itemgetter(0))
+        for order, (repeat, clb, args) in enumerate(self._my_repeats):
+            self._queue_repetition(order, repeat.times(), clb, args)
+        self._schedule_actions(0)
+
+    def _schedule_actions(self, index):
+        """
+        Continues the scenario at the action at index.
+        """
+        self._next_action = index
+        self._arm_timer()
+
+    def _queue_repetition(self, order, times, clb, args):
+        # order breaks the ties between repeated lines, keeping their order in the scenario.
+        tstmp = next(times, None)
+        if tstmp is not None:
+            heappush(self._repeat_queue, (tstmp, order, times, clb, args))
+
+    def _next_is_repetition(self):
+        # On ties the normal actions go first.
+        return bool(self._repeat_queue) and (self._next_action >= len(self._my_actions) or
+                                             self._repeat_queue[0][0] < self._my_actions[self._next_action][0])
+
+    def _next_tstmp(self):
+        if self._next_is_repetition():
+            return self._repeat_queue[0][0]
+        if self._next_action < len(self._my_actions):
+            return self._my_actions[self._next_action][0]
+        return None
+
+    def _pop_action(self):
+        if self._next_is_repetition():
+            tstmp, order, times, clb, args = heappop(self._repeat_queue)
+            self._queue_repetition(order, times, clb, args)
+            return tstmp, clb, args
+
+        self._next_action += 1
+        return self._my_actions[self._next_action - 1]
+
+    def _arm_timer(self):
+        tstmp = self._next_tstmp()
+        if tstmp is not None:
+            delay = tstmp + self._expstartstamp + self._time_shift - time()
+            self._timer = reactor.callLater(max(delay, 0), self._tick)
+        else:
+            self._timer = None
+
+    def _tick(self):
+        """
+        Runs all the due actions and arms the timer for the next one, unless a suspending action has been reached.
+        """
+        self._timer = None
+        now = time()
+        while True:
+            tstmp = self._next_tstmp()
+            if tstmp is None or tstmp + self._expstartstamp + self._time_shift > now:
+                break
+
+            tstmp, clb, args = self._pop_action()
+            self._dispatched[clb] += 1
+            if clb in self._suspending:
+                # _resume() will continue with the rest of the actions.
+                self._suspend(tstmp, clb, args)
+                return
+
+            if clb in self._batched:
+                batch = [args]
+                for _, _, more_args in takewhile(lambda action: action[:2] == (tstmp, clb),
+                                                 islice(self._my_actions, self._next_action, None)):
+                    batch.append(more_args)
+                self._next_action += len(batch) - 1
+                self._dispatched[clb] += len(batch) - 1
+                args = (batch,)
+
+            started = time()
+            try:
+                self._callables[clb](*args)
+            except Exception, e:
+                self._logger.exception("Scenario action %s failed", clb)
+                self._record_timing(tstmp, clb, started, e)
+            else:
+                self._record_timing(tstmp, clb, started)
+
+        self._arm_timer()
+
+    def load(self, clb, *args):
+        """
+        Calls clb with the rest of args at the given rate, regardless of the previous calls having completed:
+            load CALLABLE [OPTION=VALUE ...] [ARGS]
+
+        Options:
+            rate=NUMBER[/s|/m|/h]   arrival rate (required)
+            duration=[H:]M:S        how long to generate load (required)
+            dist=fixed|poisson      regular or Poisson arrivals (default fixed)
+            max_backlog=N           drop the arrivals while N calls are outstanding (default unlimited)
+            report=SECS             interval between statistics reports (default 10)
+
+        Example: "@0:30 load publish rate=50/s dist=poisson duration=600"
+        """
+        if clb not in self._callables or clb in self._suspending:
+            raise ValueError("can't generate load on %r, it's not registered or it suspends the scenario" % clb)
+
+        options, args = self._parse_load_options(args)
+
+        func = self._callables[clb]
+        if clb in self._batched:
+            func = lambda *call_args: self._callables[clb]([list(call_args)])
+        generator = LoadGenerator(clb, func, args, options['rate'], options['duration'], options['poisson'],
+                                  options['max_backlog'], self.load_reporter, options['report'])
+        generator.start()
+        return generator
+
+    def get_dispatched(self):
+        """
+        Returns how many times every callable has been run, {CALLABLE: COUNT}.
+        """
+        return dict(self._dispatched)
+
+    def get_requested_count(self, clb, begin, end):
+        """
+        Returns how many times clb should run between the begin and end timestamps according to its repeated lines
+        (on average for the Poisson ones).
+        """
+        begin -= self._expstartstamp + self._time_shift
+        end -= self._expstartstamp + self._time_shift
+        return sum(max(0, min(end, repeat.end) - max(begin, repeat.begin)) / repeat.interval
+                   for repeat, repeat_clb, _ in self._my_repeats if repeat_clb == clb)
+
+    def enable_timing(self):
+        """
+        Records the scheduled time, actual start time, duration and exception (if any) of every action run from now
+        on. Collect them with pop_timings().
+        """
+        self._timings = []
+
+    def pop_timings(self):
+        """
+        Returns the (CALLABLE, SCHEDULED, STARTED, DURATION, ERROR) tuples recorded since the last call.
+
+        The times are timestamps and DURATION is the time the callable blocked the reactor. For suspending actions it
+        doesn't include the time spent waiting for the Deferred.
+        """
+        timings = self._timings or []
+        if timings:
+            self._timings = []
+        return timings
+
+    def _record_timing(self, tstmp, clb, started, error=None):
+        if self._timings is not None:
+            self._timings.append((clb, tstmp + self._expstartstamp + self._time_shift, started, time() - started,
+                                  None if error is None else repr(error)))
+
+    def _suspend(self, tstmp, clb, args):
+        self._logger.info("Scenario suspended by %s %s", clb, ' '.join(args))
+        started = time()
+        d = maybeDeferred(self._callables[clb], *args)
+        self._record_timing(tstmp, clb, started)
+        d.addErrback(lambda failure: self._logger.error("%s failed, resuming the scenario: %s", clb,
+                                                        failure.getErrorMessage()))
+        d.addCallback(self._resume, tstmp)
+
+    def _resume(self, resume_time, tstmp):
+        self._time_shift = max(self._time_shift, (resume_time or time()) - (tstmp + self._expstartstamp))
+        self._logger.info("Scenario resumed, following events are delayed by %f secs", self._time_shift)
+        self._arm_timer()
 
     def _parse_for_this_peer(self, peerspec):
         if peerspec:
@@ -295,16 +975,146 @@ class ScenarioRunner(ScenarioParser):
             )
         return True
 
+class LoadGenerator(object):
+
+    """
+    Open-loop load: calls func at the arrival times of a rate, whether the previous calls have completed or not.
+
+    func can return a Deferred, the call is outstanding until it fires. When func can't keep up with the arrival rate
+    the outstanding calls (the backlog) grow, with max_backlog set the arrivals exceeding it are dropped instead.
+    Synchronous calls block the reactor, so they show up as lag: the arrivals are started late, all at once.
+
+    report is called every report_interval seconds and when done with a dict of statistics: offered, started,
+    completed, failed and dropped calls, the current and maximum backlog and the mean lag of the started calls.
+    """
+
+    def __init__(self, name, func, args, rate, duration, poisson=False, max_backlog=None, report=None,
+                 report_interval=10.0):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.name = name
+        self._func = func
+        self._args = args
+        self._repeat = Repeat(0, duration, 1.0 / rate, poisson)
+        self.rate = rate
+        self.max_backlog = max_backlog
+        self._report = report
+        self._report_interval = report_interval
+
+        self.stats = dict.fromkeys(('offered', 'started', 'completed', 'failed', 'dropped', 'backlog', 'max_backlog'),
+                                   0)
+        self._lag = 0.0
+        self._times = None
+        self._next_time = None
+        self._start_time = None
+        self._last_report = None
+
+    def start(self):
+        self._start_time = self._last_report = time()
+        self._times = self._repeat.times()
+        self._next_time = next(self._times, None)
+        self._logger.info("Generating %s load: %.2f calls/s for %.1f secs", self.name, self.rate, self._repeat.end)
+        self._arm_timer()
+
+    def _arm_timer(self):
+        if self._next_time is not None:
+            reactor.callLater(max(self._start_time + self._next_time - time(), 0), self._tick)
+        else:
+            self._report_stats(done=True)
+
+    def _tick(self):
+        now = time()
+        while self._next_time is not None and self._start_time + self._next_time <= now:
+            self._arrival(now - self._start_time - self._next_time)
+            self._next_time = next(self._times, None)
+
+        if now - self._last_report >= self._report_interval:
+            self._report_stats()
+        self._arm_timer()
+
+    def _arrival(self, lag):
+        self.stats['offered'] += 1
+        if self.max_backlog is not None and self.stats['backlog'] >= self.max_backlog:
+            self.stats['dropped'] += 1
+            return
+
+        self.stats['started'] += 1
+        self.stats['backlog'] += 1
+        self.stats['max_backlog'] = max(self.stats['max_backlog'], self.stats['backlog'])
+        self._lag += lag
+        d = maybeDeferred(self._func, *self._args)
+        d.addCallbacks(self._completed, self._failed)
+
+    def _completed(self, _):
+        self.stats['backlog'] -= 1
+        self.stats['completed'] += 1
+
+    def _failed(self, failure):
+        self.stats['backlog'] -= 1
+        self.stats['failed'] += 1
+        if self.stats['failed'] == 1:
+            self._logger.error("%s load call failed: %s", self.name, failure.getErrorMessage())
+
+    def _report_stats(self, done=False):
+        self._last_report = now = time()
+        stats = dict(self.stats, name=self.name, done=done, elapsed=round(now - self._start_time, 3),
+                     offered_rate=round(self.stats['offered'] / max(now - self._start_time, 1e-9), 3),
+                     mean_lag=round(self._lag / self.stats['started'], 6) if self.stats['started'] else 0.0)
+        if self._report:
+            self._report(stats)
+        else:
+            self._logger.info("%s load: %s", self.name, stats)
+
+
+class RateMeter(object):
+
+    """
+    Measures the rate at which a ScenarioRunner runs the repeated callables against the rate the scenario requested.
+
+    Call sample() periodically, e.g. from a LoopingCall. An achieved rate below the requested one means the peer can't
+    keep up with the load (the reactor is busy), the statistics of such a run are suspicious.
+    """
+
+    def __init__(self, runner):
+        self._runner = runner
+        self._last_time = time()
+        self._last_dispatched = runner.get_dispatched()
+
+    def sample(self):
+        """
+        Returns {CALLABLE: (REQUESTED, ACHIEVED)} rates in runs per second since the previous sample, for the
+        callables with repeated lines.
+        """
+        now = time()
+        dispatched = self._runner.get_dispatched()
+        elapsed = now - self._last_time
+        rates = {}
+        if elapsed > 0:
+            for clb in set(clb for _, clb, _ in self._runner._my_repeats):
+                requested = self._runner.get_requested_count(clb, self._last_time, now) / elapsed
+                achieved = (dispatched.get(clb, 0) - self._last_dispatched.get(clb, 0)) / elapsed
+                rates[clb] = (requested, achieved)
+
+        self._last_time = now
+        self._last_dispatched = dispatched
+        return rates
+
 #
 # scenario.py ends here
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print >> sys.stderr, "Usage: %s <inputfile> [<peer-id>]" % (sys.argv[0])
+        print >> sys.stderr, "       %s --compile <inputfile> [<indexfile>]" % (sys.argv[0])
         print >> sys.stderr, "Got:", sys.argv
 
         exit(1)
 
+    if sys.argv[1] == '--compile':
+        t1 = time()
+        index_filename = ScenarioIndex.compile(*sys.argv[2:4])
+        print >> sys.stderr, "Took %.2f to compile %s into %s" % (time() - t1, sys.argv[2], index_filename)
+        exit(0)
+
     if len(sys.argv) == 3:
         peer_id = int(sys.argv[2])
     else:
@@ -316,5 +1126,5 @@ if __name__ == '__main__':
     sr.parse_file()
 
     print >> sys.stderr, "Took %.2f to parse %s" % (time() - t1, sys.argv[1])
-    for tstmp, clb, args in sr._my_actions:
-        print >> sys.stderr, tstmp, clb, args
+    for when, clb, args in sr.iter_actions():
+        print >> sys.stderr, when, clb, args
@@ -49,13 +49,21 @@ workspace_dir = string(default="./")
 remote_workspace_dir = string(default="./")
 output_dir = string(default="output")
 head_nodes = list(default=[])
+incremental_workspace_sync = boolean(default=True)
+output_collect_interval = integer(min=0, default=0)
+command_output_dir = string(default="")
+command_output_sample = integer(min=0, default=100)
+command_output_report_interval = integer(min=0, default=60)
 
 tracker_cmd = string(default="")
 tracker_run_remote = boolean(default=False)
 tracker_port = integer(min=1025, max=65535, default=7788)
+tracker_ready_line = string(default="")
 
 experiment_server_run_remote = boolean(default=False)
 experiment_server_cmd = string(default="")
+experiment_server_ready_line = string(default="")
+ready_timeout = integer(min=0, default=30)
 
 local_setup_cmd = string(default="")
 remote_setup_cmd = string(default="das4_setup.sh")
@@ -56,6 +56,8 @@ from twisted.conch.ssh.session import packRequest_pty_req
 
 from struct import unpack, pack
 
+from .log import OutputStream
+
 # setDebugging(True)
 
 _ERROR_REASONS = (
@@ -76,7 +78,7 @@ class _CommandTransport(SSHClientTransport):
 
     def connectionSecure(self):
         self._secured = True
-        connection = _CommandConnection(self.factory.command)
+        connection = _CommandConnection(self.factory.command, self.factory.on_line)
         self.connection = connection
         userauth = SSHUserAuthClient(
             self.factory.user,
@@ -104,13 +106,14 @@ class _CommandTransport(SSHClientTransport):
 
 class _CommandConnection(SSHConnection):
 
-    def __init__(self, command):
+    def __init__(self, command, on_line=None):
         SSHConnection.__init__(self)
         self.command_str = command
+        self.on_line = on_line
         self.reason = None
 
     def serviceStarted(self):
-        channel = _CommandChannel(self.command_str, conn=self)
+        channel = _CommandChannel(self.command_str, self.on_line, conn=self)
         self.openChannel(channel)
 
     def channelClosed(self, channel):
@@ -122,14 +125,15 @@ class _CommandConnection(SSHConnection):
 class _CommandChannel(SSHChannel):
     name = 'session'
 
-    def __init__(self, command, **k):
+    def __init__(self, command, on_line=None, **k):
         SSHChannel.__init__(self, **k)
 
         self._logger = logging.getLogger(self.__class__.__name__)
 
-        self._databytes = ''
-        self._extbytes = ''
         self.command = command
+        # on_line is called with every line of output of the command.
+        self._stdout = OutputStream(self._logger, 'SSH "%s" STDOUT: %s', command, command + '.out', on_line)
+        self._stderr = OutputStream(self._logger, 'SSH "%s" STDERR: %s', command, command + '.err', on_line)
         self.reason = None
 
     # def openFailed(self, reason):
@@ -158,32 +162,15 @@ class _CommandChannel(SSHChannel):
             lambda _: self.conn.sendRequest(self, 'exec', NS(self.command))
         )
 
-    # TODO(emilon): Refactor this to a generic function to be used by dataReceived, extReceived and the OneshotProcessProtocol.
     def dataReceived(self, bytes_):
-        # we could recv more than 1 line and or a partial line.
-        self._databytes += bytes_.replace('\r\n', '\n')
-        remainder = ""
-        for line in self._databytes.splitlines(True):
-            if line.endswith('\n'):
-                self._logger.info('SSH "%s" STDOUT: %s', self.command, line.rstrip())
-            else:
-                # It's a partial line (part of the last one), save it to the buffer instead
-                remainder = line
-        self._databytes = remainder
+        self._stdout.write(bytes_)
 
     def extReceived(self, _, bytes_):
-        # we could recv more than 1 line and or a partial line.
-        self._extbytes += bytes_.replace('\r\n', '\n')
-        remainder = ""
-        for line in self._extbytes.splitlines(True):
-            if line.endswith('\n'):
-                self._logger.info('SSH "%s" STDERR: %s', self.command, line.rstrip())
-            else:
-                # It's a partial line (part of the last one), save it to the buffer instead
-                remainder = line
-        self._extbytes = remainder
+        self._stderr.write(bytes_)
 
     def closed(self):
+        self._stdout.close()
+        self._stderr.close()
         self._logger.info("SSH command channel closed")
         if not self.reason:
             # No command failure
@@ -217,11 +204,12 @@ class _CommandChannel(SSHChannel):
 
 class CommandFactory(ClientFactory):
 
-    def __init__(self, command, user):
+    def __init__(self, command, user, on_line=None):
         self._logger = logging.getLogger(self.__class__.__name__)
 
         self.command = command
         self.user = user
+        self.on_line = on_line
         self.protocol = _CommandTransport
         self.finished = Deferred()
 
@@ -234,7 +222,7 @@ class CommandFactory(ClientFactory):
                 self.finished.errback(reason)
 
 
-def runRemoteCMD(host, command):
+def runRemoteCMD(host, command, on_line=None):
     if '@' in host:
         user, host = host.split('@')
     else:
@@ -245,7 +233,7 @@ def runRemoteCMD(host, command):
     else:
         port = 22
 
-    factory = CommandFactory(command, user)
+    factory = CommandFactory(command, user, on_line)
     reactor.connectTCP(host, port, factory)
 
     return factory.finished
@@ -0,0 +1,285 @@
+# steps.py ---
+#
+# Filename: steps.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 23:18:37 2026 (+0200)
+
+# Commentary:
+#
+# Runs the steps of an experiment as a dependency graph.
+#
+# Every step is a callable returning a value or a Deferred, and the names of the steps it requires. A step starts
+# as soon as all its requirements are done, so the independent ones run concurrently. Once finished, report() tells
+# the wall time of every step and the critical path: the chain of steps that made the whole run last as long as it
+# did (every step on it started as soon as the previous one finished).
+#
+# With a checkpoint file, every completed step is recorded there with the fingerprint of its inputs (and of the
+# inputs of the steps it requires). resume_from() and only() use it to skip the steps whose results are still there,
+# so e.g. the post-processing can be run again on the data of a previous run. Background steps (the tracker, the
+# experiment server...) are only done while running, so they are never recorded: they are run again whenever a step
+# requiring them runs.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import json
+import logging
+from collections import OrderedDict
+from hashlib import sha1
+from os import makedirs, path, rename
+from time import time
+
+from twisted.internet.defer import Deferred, maybeDeferred
+
+
+class StepGraph(object):
+
+    """
+    A set of named steps with dependencies between them.
+
+    Usage:
+        graph = StepGraph()
+        graph.add('sync', self.copyWorkspaceToHeadNodes)
+        graph.add('setup', self.runRemoteSetup, requires=('sync',))
+        d = graph.run()
+
+    run() returns a Deferred firing once all the steps are done, or failing with the failure of the first step that
+    fails. No steps are started after a failure, but the ones already running are not interrupted.
+
+    inputs is anything JSON serializable the result of the step depends on (commands, config options...). A background
+    step is one that is done once ready but keeps running for the steps requiring it, it is never skipped if any of
+    them runs.
+    """
+
+    def __init__(self, checkpoint_file=None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        # name -> (CALLABLE, REQUIRES, INPUTS, BACKGROUND)
+        self._steps = OrderedDict()
+        # name -> [STARTED, FINISHED], FINISHED being None while it runs
+        self.timings = OrderedDict()
+        # Steps considered done without running them, see resume_from() and only().
+        self.skipped = set()
+        self.failed = None
+        self._started = None
+        self._d = None
+
+        self.checkpoint_file = checkpoint_file
+        # name -> {'fingerprint': FINGERPRINT, 'finished': TIMESTAMP} of the completed steps
+        self.checkpoints = {}
+        if checkpoint_file and path.exists(checkpoint_file):
+            with open(checkpoint_file) as f:
+                self.checkpoints = json.load(f)
+
+    def add(self, name, func, requires=(), inputs=None, background=False):
+        if name in self._steps:
+            raise ValueError("Step %s already added" % name)
+        for required in requires:
+            if required not in self._steps:
+                raise ValueError("Step %s requires the unknown step %s" % (name, required))
+        self._steps[name] = (func, tuple(requires), inputs, background)
+
+    def fingerprint(self, name):
+        """
+        Returns the fingerprint of the inputs of a step and of all the steps it requires.
+        """
+        _, requires, inputs, _ = self._steps[name]
+        checksum = sha1(json.dumps(inputs, sort_keys=True))
+        for required in requires:
+            checksum.update(self.fingerprint(required))
+        return checksum.hexdigest()
+
+    def is_checkpointed(self, name):
+        """
+        Returns whether the step has been completed with the current inputs.
+        """
+        checkpoint = self.checkpoints.get(name)
+        return checkpoint is not None and checkpoint['fingerprint'] == self.fingerprint(name)
+
+    def requirements(self, name):
+        """
+        Returns the names of all the steps a step requires, directly or not.
+        """
+        required = set()
+        pending = list(self._steps[name][1])
+        while pending:
+            step = pending.pop()
+            if step not in required:
+                required.add(step)
+                pending.extend(self._steps[step][1])
+        return required
+
+    def resume_from(self, name):
+        """
+        Skips all the steps name requires, which need to have been completed with the same inputs.
+        """
+        if name not in self._steps:
+            raise ValueError("Unknown step %s, the steps are: %s" % (name, ", ".join(self._steps)))
+        missing = [step for step in self._steps if step in self.requirements(name) and not self._steps[step][3] and
+                   not self.is_checkpointed(step)]
+        if missing:
+            raise ValueError("Can't resume from %s, these steps haven't been completed with the current inputs: %s" %
+                             (name, ", ".join(missing)))
+        self._skip(self.requirements(name))
+
+    def only(self, names):
+        """
+        Skips all the steps but the given ones (and the background steps they require), whatever the state of the
+        steps they require.
+        """
+        for name in names:
+            if name not in self._steps:
+                raise ValueError("Unknown step %s, the steps are: %s" % (name, ", ".join(self._steps)))
+        self._skip(set(self._steps) - set(names))
+        for name in names:
+            for required in self._steps[name][1]:
+                if required in self.skipped and not self.is_checkpointed(required):
+                    self._logger.warning("Running %s without %s having been completed with the current inputs",
+                                         name, required)
+
+    def _skip(self, skipped):
+        # The background steps required by a step that runs have to run too, along with the ones they require.
+        skipped = set(skipped)
+        changed = True
+        while changed:
+            changed = False
+            for name, (_, requires, _, _) in self._steps.iteritems():
+                if name not in skipped:
+                    for required in requires:
+                        if required in skipped and self._steps[required][3]:
+                            skipped.remove(required)
+                            changed = True
+        self.skipped = skipped
+
+    def _is_done(self, name):
+        return name in self.skipped or (name in self.timings and self.timings[name][1] is not None and
+                                        name != self.failed)
+
+    def _checkpoint(self, name):
+        if self._steps[name][3]:
+            return
+        self.checkpoints[name] = {'fingerprint': self.fingerprint(name), 'finished': self.timings[name][1]}
+        self._writeCheckpoints()
+
+    def _invalidate(self, name):
+        # A step being run again invalidates the results of the steps requiring it, even if it fails.
+        if self._steps[name][3]:
+            return
+        stale = [step for step in self.checkpoints
+                 if step == name or (step in self._steps and name in self.requirements(step))]
+        if stale:
+            for step in stale:
+                del self.checkpoints[step]
+            self._writeCheckpoints()
+
+    def _writeCheckpoints(self):
+        if not self.checkpoint_file:
+            return
+        directory = path.dirname(self.checkpoint_file)
+        if directory and not path.exists(directory):
+            makedirs(directory)
+        tmp_filename = self.checkpoint_file + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.checkpoints, f, indent=1, sort_keys=True)
+        rename(tmp_filename, self.checkpoint_file)
+
+    def run(self):
+        self._started = time()
+        self._d = Deferred()
+        self._startReadySteps()
+        return self._d
+
+    def _startReadySteps(self):
+        if self._d.called:
+            return
+
+        if all(self._is_done(name) for name in self._steps):
+            self._d.callback(None)
+            return
+
+        for name, (func, requires, _, _) in self._steps.iteritems():
+            if name not in self.timings and name not in self.skipped and all(self._is_done(required)
+                                                                              for required in requires):
+                self._logger.info("Starting step %s", name)
+                self.timings[name] = [time(), None]
+                self._invalidate(name)
+                maybeDeferred(func).addCallbacks(self._onStepDone, self._onStepFailed, (name,), None, (name,))
+
+    def _onStepDone(self, _, name):
+        self.timings[name][1] = time()
+        self._logger.info("Step %s done in %.2f s", name, self.timings[name][1] - self.timings[name][0])
+        self._checkpoint(name)
+        self._startReadySteps()
+
+    def _onStepFailed(self, failure, name):
+        self.timings[name][1] = time()
+        self._logger.error("Step %s failed after %.2f s", name, self.timings[name][1] - self.timings[name][0])
+        if not self._d.called:
+            self.failed = name
+            self._d.errback(failure)
+
+    def critical_path(self):
+        """
+        Returns the names of the steps on the critical path, in execution order.
+
+        Walks back from the step that finished last, through the requirement that finished last (the one its start
+        waited for).
+        """
+        finished = dict((name, end) for name, (_, end) in self.timings.iteritems() if end is not None)
+        if not finished:
+            return []
+
+        path = [max(finished, key=finished.get)]
+        while True:
+            requires = [required for required in self._steps[path[-1]][1] if required in finished]
+            if not requires:
+                break
+            path.append(max(requires, key=finished.get))
+        path.reverse()
+        return path
+
+    def report(self):
+        """
+        Returns the lines of a report with the wall time of every step and the critical path.
+        """
+        critical = self.critical_path()
+        lines = ["%-20s %10s %10s" % ("step", "start", "duration")]
+        for name, (started, finished) in self.timings.iteritems():
+            duration = "%10.2f" % (finished - started) if finished is not None else "%10s" % "running"
+            lines.append("%-20s %10.2f %s%s%s" % (name, started - self._started, duration,
+                                                 " *" if name in critical else "",
+                                                 " FAILED" if name == self.failed else ""))
+        for name in self._steps:
+            if name not in self.timings:
+                lines.append("%-20s %10s %10s" % (name, "-", "skipped" if name in self.skipped else "not run"))
+
+        if critical:
+            end = self.timings[critical[-1]][1]
+            lines.append("Critical path (*, %.2f s): %s" % (end - self._started, " -> ".join(critical)))
+        return lines
+
+#
+# steps.py ends here
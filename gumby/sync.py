@@ -11,6 +11,10 @@
 #
 # Experiment metainfo and time synchronization server.
 #
+# As soon as a client connects, the service announces the optional features it supports with a
+# "hello:<feature1>[,<feature2>...]" line (see SERVER_FEATURES). Servers older than this line
+# don't say anything until they send the id, clients stick to the plain line protocol then.
+#
 # It receives 3 types of commands:
 # * time:<float>  -> Tells the service the local time for the subprocess for sync reasons.
 # * set:key:value -> Sets an arbitrary variable associated with this connection to the
@@ -19,12 +23,77 @@
 # * ready         -> Indicates that this specific instance has ending sending its info
 #                    and its ready to start.
 #
+# Admission control:
+#
+# The service can limit the rate at which it admits new subscribers (see admission_rate in
+# ExperimentServiceFactory). A subscriber arriving when there is no capacity left gets its
+# first line answered with "retry:<secs>:<ticket>" and the connection is closed. The ticket
+# reserves an admission slot, the subscriber should reconnect after <secs> and send
+# "ticket:<ticket>" as its first line to get admitted right away.
+#
+# Sync relays (see ExperimentRelayFactory) aggregate the instances running on a node and
+# present them to this server as a single subscriber. They use 2 extra commands:
+# * relay:<n>           -> Tells the service that this connection represents n instances, the
+#                          id sent back to it will be the first one of a block of n ids.
+# * peer:<id>:<json>    -> Sets all the variables of one of the instances behind the relay.
+#
+# Clients can announce the optional protocol features they support, among the ones announced
+# in the hello line of the service, before sending ready:
+# * caps:<cap1>[,<cap2>...]
+#
+# Currently supported capabilities:
+# * zvars -> Instead of a JSON line, the vars document is sent as a "zvars:<size>" line followed
+#            by <size> bytes of zlib compressed JSON. This frame has no length limit and is
+#            encoded only once for all the subscribers.
+# * query -> The subscriber doesn't want the vars of everybody. It gets a "peers:<n>" line
+#            followed by a vars document only containing its own vars instead and the
+#            connection is kept open after the go signal to look up peers on demand:
+#            * get:<id>           -> Answered with peer:<id>:<json vars> (null if unknown).
+#            * who:<host>:<port>  -> Answered with the peer line of the matching peer, if any,
+#                                    followed by addr:<host>:<port>:<id> (empty id if unknown).
+#            The go signal is sent as "go:<float>:persistent" to these subscribers.
+# * ntp   -> The service estimates the clock offset of the subscriber NTP style instead of
+#            trusting the time line. It sends NTP_SAMPLES "ping:<service time>" commands,
+#            one after the other, which are answered right away with
+#            "pong:<service time>:<subscriber time>". The sample with the smallest round trip
+#            time is used and half of it is exported as time_offset_error with the vars.
+# * barrier -> If the service offers barriers, the go signal is sent as "go:<float>:persistent"
+#            and the subscriber can keep synchronizing with the others during the experiment:
+#            * barrier:<name>  -> This subscriber reached the named barrier, once all of them
+#                                 have, every one of them gets release:<name>:<float> with the
+#                                 time at which they should continue.
+# * metrics -> If the service aggregates live metrics, the go signal is sent as
+#            "go:<float>:persistent" too and the subscriber can report its metrics:
+#            * metrics:<json>      -> Changes since the last report, {"name": delta, ...} for
+#                                     counters, or {"name": "value", ...} for labels like the
+#                                     peer type.
+#            * peermetrics:<json>  -> Sent by relays, {"<id>": {"name": delta, ...}, ...}.
+#            The service periodically writes cluster wide aggregates to a summary file.
+#
+# The go signal for persistent subscribers includes the features offered after the start,
+# i.e. "go:<float>:persistent:barrier:metrics".
+#
+# Binary protocol:
+#
+# If the service announced the "binary" feature, the client can send "binary:1" as its first
+# line. The service answers with the same line and both ends switch to length prefixed binary
+# frames. Every frame
+# consists of a 4 byte payload length and a 1 byte frame type followed by the payload:
+# * 0 (command) -> Any of the commands described above, without the line terminator.
+# * 1 (set)     -> Packed [key, value] pair, replaces set:key:value. The value can be any
+#                  packable object, including binary strings or strings containing newlines.
+# * 2 (vars)    -> zlib compressed packed vars document.
+# * 3 (peer)    -> Packed [id, vars], replaces peer:<id>:<json> both when sent by a relay and
+#                  when answering a lookup.
+# See gumby/packing.py for the serialization format.
+#
 # When the all of the instances we are waiting for are all ready, all the information will
 # be sent back to them in the form of a JSON document. After this, a "go" command will
 # be sent to indicate that they should start running the experiment with the absolute time at which the experiment should start.
 #
 # Example of an expected exchange:
 # [connection is opened by the client]
+# <- hello:binary,zvars,query,ntp,barrier,metrics
 # <- id:0
 # -> time:1378479678.11
 # -> set:asdf:ooooo
@@ -60,70 +129,408 @@
 # Code:
 import json
 import logging
+import zlib
+from os import rename
+from struct import Struct
 from time import time
 
 from twisted.internet import reactor, task
-from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.internet.defer import Deferred, DeferredSemaphore, gatherResults, succeed
 from twisted.internet.protocol import (Factory, ReconnectingClientFactory, connectionDone)
 from twisted.internet.threads import deferToThread
 from twisted.protocols.basic import LineReceiver
 
+from .packing import pack, unpack
+
 
 EXPERIMENT_SYNC_TIMEOUT = 30
 
+SERVER_HELLO = "hello"
+# Optional features announced by the service in its hello line.
+SERVER_FEATURES = ('binary', 'zvars', 'query', 'ntp', 'barrier', 'metrics')
+BINARY_HELLO = "binary:1"
+
+NTP_SAMPLES = 8
+
+FRAME_HEADER = Struct('!IB')
+FRAME_COMMAND, FRAME_SET, FRAME_VARS, FRAME_PEER = range(4)
+FRAME_NAMES = {FRAME_SET: 'set', FRAME_VARS: 'vars', FRAME_PEER: 'peer'}
+
 logger = logging.getLogger()
 
 #
-# Server side
+# Common stuff
 #
 
 
-class ExperimentServiceProto(LineReceiver):
+class SyncProtocol(LineReceiver):
+
+    """
+    Base of all the sync protocol ends. Dispatches every received line or command frame to the handler of the current
+    state (proto_<state>) and every other binary frame to frame_<frame type>.
+    """
     # Allow for 4MB long lines (for the json stuff)
     MAX_LENGTH = 2 ** 22
 
-    def __init__(self, factory, id):
+    state = None
+    binary = False
+
+    def lineReceived(self, line):
+        try:
+            pto = 'proto_' + self.state
+            statehandler = getattr(self, pto)
+        except AttributeError:
+            self._logger.error('Callback %s not found', self.state)
+            stopReactor()
+        else:
+            self.setState(statehandler(line))
+
+    def setState(self, state):
+        self.state = state
+        if self.state == 'done':
+            self.transport.loseConnection()
+
+    def startBinaryMode(self):
+        self.binary = True
+        self._binary_chunks = []
+        self._binary_received = 0
+        self._binary_header = None
+        self.setRawMode()
+
+    def sendCommand(self, command):
+        if self.binary:
+            self.sendFrame(FRAME_COMMAND, command)
+        else:
+            self.sendLine(command)
+
+    def sendFrame(self, frame_type, payload):
+        self.transport.writeSequence((FRAME_HEADER.pack(len(payload), frame_type), payload))
+
+    def frameReceived(self, frame_type, payload):
+        if frame_type == FRAME_COMMAND:
+            self.lineReceived(payload)
+            return
+
+        handler = getattr(self, 'frame_' + FRAME_NAMES.get(frame_type, 'unknown'), None)
+        if handler:
+            self.setState(handler(payload))
+        else:
+            self._logger.error('Unexpected frame of type %d received in state %s, closing connection', frame_type,
+                               self.state)
+            self.setState('done')
+
+    def sendTicket(self):
+        if self.factory.admission_ticket:
+            self.sendLine("ticket:%d" % self.factory.admission_ticket)
+            self.factory.admission_ticket = None
+
+    def handleRetry(self, line):
+        _, delay, ticket = line.strip().split(':')
+        self.factory.retryLater(float(delay), int(ticket))
+        self.setState('done')
+
+    def receiveFrame(self, size, callback):
+        """
+        Receive the next size bytes as a single binary frame and pass them to callback, its return value will be the
+        new state. Line mode is resumed afterwards.
+        """
+        self._frame_size = size
+        self._frame_chunks = []
+        self._frame_received = 0
+        self._frame_callback = callback
+        self.setRawMode()
+
+    def rawDataReceived(self, data):
+        if self.binary:
+            self._binaryDataReceived(data)
+            return
+
+        missing = self._frame_size - self._frame_received
+        if len(data) < missing:
+            self._frame_chunks.append(data)
+            self._frame_received += len(data)
+            return
+
+        self._frame_chunks.append(data[:missing])
+        frame = ''.join(self._frame_chunks)
+        self._frame_chunks = []
+
+        self.setState(self._frame_callback(frame))
+        if self.state != 'done':
+            self.setLineMode(data[missing:])
+
+    def _binaryDataReceived(self, data):
+        # Only join the received chunks once a header or a complete frame is available.
+        self._binary_chunks.append(data)
+        self._binary_received += len(data)
+        while self.state != 'done':
+            if self._binary_header is None:
+                if self._binary_received < FRAME_HEADER.size:
+                    return
+                buf = ''.join(self._binary_chunks)
+                self._binary_chunks = [buf]
+                self._binary_header = FRAME_HEADER.unpack_from(buf)
+
+            size, frame_type = self._binary_header
+            frame_end = FRAME_HEADER.size + size
+            if self._binary_received < frame_end:
+                return
+
+            buf = ''.join(self._binary_chunks)
+            payload, rest = buf[FRAME_HEADER.size:frame_end], buf[frame_end:]
+            self._binary_chunks = [rest]
+            self._binary_received = len(rest)
+            self._binary_header = None
+
+            self.frameReceived(frame_type, payload)
+
+    def lineLengthExceeded(self, line):
+        self._logger.error("Line length exceeded, %d bytes remain.", len(line))
+
+
+class VarsDocument(object):
+
+    """
+    Holds the vars of all the experiment instances and encodes them lazily, only once per format, so the same buffer
+    can be written to all the transports.
+    """
+
+    def __init__(self, vars=None, json_vars=None, compressed=None, packed=None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self._vars = vars
+        self._json = json_vars
+        self._compressed = compressed
+        self._packed = packed
+
+    @property
+    def vars(self):
+        if self._vars is None:
+            if self._packed is None:
+                self._vars = json.loads(self.json)
+            else:
+                self._vars = unpack(zlib.decompress(self._packed))
+        return self._vars
+
+    @property
+    def json(self):
+        if self._json is None:
+            if self._vars is None and self._packed is None:
+                self._json = zlib.decompress(self._compressed)
+            else:
+                try:
+                    self._json = json.dumps(self.vars)
+                except UnicodeDecodeError:
+                    self._logger.error("The vars contain binary values, only binary protocol clients can receive them.")
+                    raise
+        return self._json
+
+    @property
+    def packed(self):
+        if self._packed is None:
+            self._packed = zlib.compress(pack(self.vars))
+            self._logger.info("Packed the vars doc into %d bytes.", len(self._packed))
+        return self._packed
+
+    @property
+    def compressed(self):
+        if self._compressed is None:
+            self._compressed = zlib.compress(self.json)
+            self._logger.info("Compressed the json doc to %d bytes.", len(self._compressed))
+        return self._compressed
+
+
+class SyncClientFactory(ReconnectingClientFactory):
+
+    """
+    Base of the factories connecting to an experiment service, takes care of coming back when the service tells us to.
+    """
+    maxDelay = 10
+
+    admission_ticket = None
+    _retry_delay = None
+
+    def retryLater(self, delay, ticket):
+        self._logger.info("The experiment server is busy, reconnecting in %f secs.", delay)
+        self._retry_delay = delay
+        self.admission_ticket = ticket
+
+    def reconnectIfAsked(self, connector):
+        if self._retry_delay is None:
+            return False
+
+        reactor.callLater(self._retry_delay, connector.connect)
+        self._retry_delay = None
+        return True
+
+#
+# Server side
+#
+
+
+class ExperimentServiceProto(SyncProtocol):
+
+    def __init__(self, factory):
         self._logger = logging.getLogger(self.__class__.__name__)
 
-        self.id = id
+        self.id = None
         self.factory = factory
         self.ready = False
         self.state = 'init'
         self.vars = {}
+        self.caps = set()
         self.ready_d = None
+        # Number of instances this connection stands for and their vars, only used by sync relays.
+        self.weight = 1
+        self.peers = None
+        # (round trip time, clock offset) pairs, see sendPing
+        self.clock_samples = []
 
     def connectionMade(self):
         self._logger.debug("New connection from: %s", str(self.transport.getPeer()))
-        self.factory.setConnectionMade(self)
-
-    def lineReceived(self, line):
-        try:
-            pto = 'proto_' + self.state
-            statehandler = getattr(self, pto)
-        except AttributeError:
-            self._logger.error('Callback %s not found', self.state)
-            stopReactor()
+        # Always the first line, before any retry or id.
+        self.sendLine("%s:%s" % (SERVER_HELLO, ','.join(SERVER_FEATURES)))
+        if self.factory.admission_rate:
+            self.state = 'admission'
         else:
-            self.state = statehandler(line)
-            if self.state == 'done':
-                self.transport.loseConnection()
+            self.factory.setConnectionMade(self)
 
     def sendAndWaitForReady(self):
         self.ready_d = Deferred()
-        self.sendLine("id:%s" % self.id)
+        self.sendCommand("id:%s" % self.id)
         return self.ready_d
 
+    def sendVars(self, document):
+        if self.binary:
+            self.sendFrame(FRAME_VARS, document.packed)
+        elif 'zvars' in self.caps:
+            compressed = document.compressed
+            self.sendLine("zvars:%d" % len(compressed))
+            self.transport.write(compressed)
+        else:
+            self.sendLine(document.json)
+
+    def sendPing(self):
+        self.sendCommand("ping:%f" % time())
+
+    def handlePong(self, line):
+        received = time()
+        _, sent, peer_time = line.strip().split(':')
+        sent = float(sent)
+        # Assume the pong was sent halfway the round trip, the real offset is within +/- rtt/2 of the estimate.
+        self.clock_samples.append((received - sent, float(peer_time) - (sent + received) / 2))
+
+        rtt, offset = min(self.clock_samples)
+        self.vars['time_offset'] = offset
+        self.vars['time_offset_error'] = rtt / 2
+
+        if len(self.clock_samples) < NTP_SAMPLES:
+            self.sendPing()
+        else:
+            self._logger.debug("Time offset is %f +/- %f", offset, rtt / 2)
+            if self.state == 'vars_received' and not self.ready:
+                self.setReady()
+
+    @property
+    def sampling_clock(self):
+        return 'ntp' in self.caps and len(self.clock_samples) < NTP_SAMPLES
+
+    def setReady(self):
+        self._logger.debug("This subscriber is ready now.")
+        self.ready = True
+        self.factory.setConnectionReady(self)
+        self.ready_d.callback(self)
+
+    @property
+    def features(self):
+        # The features used by this subscriber after the experiment has started.
+        features = []
+        if 'query' in self.caps:
+            features.append('query')
+        if 'barrier' in self.caps and self.factory.barriers:
+            features.append('barrier')
+        if 'metrics' in self.caps and self.factory.metrics:
+            features.append('metrics')
+        return features
+
+    @property
+    def persistent(self):
+        # Subscribers that keep the connection open after the experiment has started.
+        return bool(self.features)
+
+    def handleLookup(self, line):
+        if 'query' not in self.caps:
+            return False
+
+        if line.startswith('get:'):
+            self.sendPeer(line.strip().split(':', 1)[1])
+            return True
+
+        elif line.startswith('who:'):
+            _, host, port = line.strip().split(':')
+            peer_id = self.factory.getPeerIdByAddress(host, int(port))
+            if peer_id:
+                self.sendPeer(peer_id)
+            self.sendCommand("addr:%s:%s:%s" % (host, port, str(peer_id or '')))
+            return True
+
+        return False
+
+    def sendPeer(self, peer_id):
+        peer_vars = self.factory.peer_vars.get(peer_id)
+        if self.binary:
+            self.sendFrame(FRAME_PEER, pack([str(peer_id), peer_vars]))
+        else:
+            self.sendLine("peer:%s:%s" % (str(peer_id), json.dumps(peer_vars)))
+
+    def lineReceived(self, line):
+        # Pongs can arrive in any state.
+        if line.startswith('pong:'):
+            self.handlePong(line)
+        else:
+            SyncProtocol.lineReceived(self, line)
+
     def connectionLost(self, reason=connectionDone):
         self._logger.debug("Lost connection with: %s with ID %s", str(self.transport.getPeer()), self.id)
         self.factory.unregisterConnection(self)
-        LineReceiver.connectionLost(self, reason)
+        SyncProtocol.connectionLost(self, reason)
 
     #
     # Protocol state handlers
     #
 
+    def proto_admission(self, line):
+        if line.startswith('ticket:'):
+            if self.factory.redeemTicket(int(line.strip().split(':')[1])):
+                self.factory.setConnectionMade(self)
+                return 'init'
+            self._logger.warning("Unknown admission ticket %s, treating it as a new subscriber", line)
+            line = None
+
+        reservation = self.factory.reserveAdmission()
+        if reservation:
+            self.sendLine("retry:%f:%d" % reservation)
+            return 'done'
+
+        self.factory.setConnectionMade(self)
+        return self.proto_init(line) if line else 'init'
+
     def proto_init(self, line):
-        if line.startswith("time"):
+        if line.startswith('ticket:'):
+            # Admission control is disabled.
+            return 'init'
+
+        elif line == BINARY_HELLO and not self.binary:
+            self._logger.debug("This subscriber speaks the binary protocol.")
+            self.sendLine(BINARY_HELLO)
+            self.startBinaryMode()
+            return 'init'
+
+        elif line.startswith("time"):
+            if self.clock_samples:
+                # We already have a better estimation.
+                return 'init'
+
             self.vars["time_offset"] = float(line.strip().split(':')[1]) - time()
             if abs(self.vars['time_offset']) < 0.5:  # ignore time_offset if smaller than +0.5/-0.5
                 self.vars['time_offset'] = 0
@@ -137,11 +544,31 @@ class ExperimentServiceProto(LineReceiver):
             self.vars[key] = value
             return 'init'
 
+        elif line.startswith('caps:'):
+            self.caps.update(line.strip().split(':', 1)[1].split(','))
+            self._logger.debug("This subscriber supports: %s", ', '.join(self.caps))
+            if 'ntp' in self.caps and not self.clock_samples:
+                self.sendPing()
+            return 'init'
+
+        elif line.startswith('relay:'):
+            self.weight = int(line.strip().split(':')[1])
+            self.peers = {}
+            self._logger.debug("This subscriber is a relay for %d instances", self.weight)
+            self.factory.setConnectionWeight(self)
+            return 'init'
+
+        elif line.startswith('peer:') and self.peers is not None:
+            # Only relays set the vars of other instances.
+            _, peer_id, json_vars = line.strip().split(':', 2)
+            self.peers[int(peer_id)] = json.loads(json_vars)
+            return 'init'
+
         elif line.strip() == 'ready':
-            self._logger.debug("This subscriber is ready now.")
-            self.ready = True
-            self.factory.setConnectionReady(self)
-            self.ready_d.callback(self)
+            if self.sampling_clock:
+                self._logger.debug("This subscriber is ready, waiting for the clock offset estimation to finish.")
+            else:
+                self.setReady()
             return 'vars_received'
 
         else:
@@ -149,54 +576,160 @@ class ExperimentServiceProto(LineReceiver):
             self._logger.error('closing connection.')
             return 'done'
 
+    def frame_set(self, payload):
+        if self.state != 'init':
+            self._logger.error('Unexpected set frame received in state %s, closing connection', self.state)
+            return 'done'
+
+        key, value = unpack(payload)
+        self._logger.debug("This subscriber sets %s (%d bytes)", key, len(payload))
+        self.vars[key] = value
+        return 'init'
+
+    def frame_peer(self, payload):
+        if self.state != 'init' or self.peers is None:
+            self._logger.error('Unexpected peer frame received in state %s, closing connection', self.state)
+            return 'done'
+
+        peer_id, peer_vars = unpack(payload)
+        self.peers[int(peer_id)] = peer_vars
+        return 'init'
+
     def proto_vars_received(self, line):
         if line.strip() == 'vars_received':
             self.factory.setConnectionReceived(self)
             return "wait"
+        elif self.handleLookup(line):
+            return 'vars_received'
         self._logger.error('Unexpected command received "%s"', line)
         self._logger.error('closing connection.')
         return 'done'
 
     def proto_wait(self, line):
+        if self.handleLookup(line):
+            return 'wait'
+        elif line.startswith('barrier:') and 'barrier' in self.features:
+            self.factory.reachBarrier(self, line.strip().split(':', 1)[1])
+            return 'wait'
+        elif line.startswith('metrics:') and 'metrics' in self.features:
+            self.factory.addMetrics({str(self.id): json.loads(line.split(':', 1)[1])})
+            return 'wait'
+        elif line.startswith('peermetrics:') and 'metrics' in self.features:
+            self.factory.addMetrics(json.loads(line.split(':', 1)[1]))
+            return 'wait'
         self._logger.error('Unexpected command received "%s" while in ready state. Closing connection', line)
         return 'done'
 
 
 class ExperimentServiceFactory(Factory):
     protocol = ExperimentServiceProto
-
-    def __init__(self, expected_subscribers, experiment_start_delay):
+    # Keep the subscribers supporting barriers connected after the go signal and offer them named barriers.
+    barriers = False
+    # Seconds between the last subscriber reaching a barrier and the synchronized release of all of them.
+    barrier_release_delay = 1.0
+    # Aggregate the live metrics reported by the subscribers and write a summary to metrics_file every
+    # metrics_interval seconds.
+    metrics = False
+    metrics_file = None
+    metrics_interval = 10.0
+
+    def __init__(self, expected_subscribers, experiment_start_delay, admission_rate=0, admission_burst=None):
         self._logger = logging.getLogger(self.__class__.__name__)
 
         self.expected_subscribers = expected_subscribers
         self.experiment_start_delay = experiment_start_delay
+        # Maximum amount of subscribers admitted per second on average (0 means unlimited) and how many of them can
+        # be admitted at once.
+        self.admission_rate = admission_rate
+        self.admission_burst = admission_burst or max(1, int(admission_rate))
+        self._admission_slot = 0
+        self._admission_tickets = set()
+        self._next_ticket = 1
+        # barrier name -> subscribers waiting on it
+        self._barriers = {}
+        self._barriers_reached = set()
+        # peer id -> {metric name -> accumulated value}
+        self._metrics = {}
+        self._metrics_looping_call = None
         self.parsing_semaphore = DeferredSemaphore(500)
-        self.connection_counter = -1
         self.connections_made = []
         self.connections_ready = []
         self.vars_received = []
+        # Directory of all the peer vars, only kept around when serving lookups.
+        self.peer_vars = None
+        self._peer_addresses = None
+        self._experiment_started = False
 
         self._made_looping_call = None
         self._subscriber_looping_call = None
         self._subscriber_received_looping_call = None
         self._timeout_delayed_call = None
+        self._ids_pushed = False
 
     def buildProtocol(self, addr):
-        self.connection_counter += 1
-        return ExperimentServiceProto(self, self.connection_counter + 1)
-
-    def setConnectionMade(self, proto):
-        if not self._timeout_delayed_call:
-            self._timeout_delayed_call = reactor.callLater(EXPERIMENT_SYNC_TIMEOUT, self.onExperimentSetupTimeout)
-        else:
+        return ExperimentServiceProto(self)
+
+    def reserveAdmission(self):
+        """
+        Reserves an admission slot for a new subscriber. Returns None if it can be admitted right away or a
+        (delay, ticket) tuple telling it when to come back otherwise.
+        """
+        if not self.admission_rate:
+            return None
+
+        now = time()
+        interval = 1.0 / self.admission_rate
+        # Generic cell rate algorithm, _admission_slot is the time at which the next slot becomes free.
+        self._admission_slot = max(self._admission_slot, now)
+        delay = self._admission_slot - now - (self.admission_burst - 1) * interval
+        self._admission_slot += interval
+        if delay <= 0:
+            return None
+
+        ticket = self._next_ticket
+        self._next_ticket += 1
+        self._admission_tickets.add(ticket)
+        return delay, ticket
+
+    def redeemTicket(self, ticket):
+        if ticket in self._admission_tickets:
+            self._admission_tickets.remove(ticket)
+            return True
+        return False
+
+    def countSubscribers(self, protos):
+        # Relays count as many subscribers as instances they aggregate.
+        return sum(proto.weight for proto in protos)
+
+    def resetSetupTimeout(self):
+        if self._timeout_delayed_call and self._timeout_delayed_call.active():
             self._timeout_delayed_call.reset(EXPERIMENT_SYNC_TIMEOUT)
+        else:
+            self._timeout_delayed_call = reactor.callLater(EXPERIMENT_SYNC_TIMEOUT, self.onExperimentSetupTimeout)
 
+    def cancelSetupTimeout(self):
+        if self._timeout_delayed_call and self._timeout_delayed_call.active():
+            self._timeout_delayed_call.cancel()
+
+    def setConnectionMade(self, proto):
+        self.resetSetupTimeout()
         self.connections_made.append(proto)
-        if len(self.connections_made) >= self.expected_subscribers:
+        self._checkConnectionsMade()
+
+    def setConnectionWeight(self, proto):
+        self.resetSetupTimeout()
+        self._checkConnectionsMade()
+
+    def _checkConnectionsMade(self):
+        if self._ids_pushed:
+            return
+
+        if self.countSubscribers(self.connections_made) >= self.expected_subscribers:
             self._logger.info("All subscribers connected!")
             if self._made_looping_call and self._made_looping_call.running:
                 self._made_looping_call.stop()
 
+            self._ids_pushed = True
             self.pushIdToSubscribers()
         else:
             if not self._made_looping_call:
@@ -204,18 +737,23 @@ class ExperimentServiceFactory(Factory):
                 self._made_looping_call.start(1.0)
 
     def _print_subscribers_made(self):
-        if len(self.connections_made) < self.expected_subscribers:
-            self._logger.info("%d of %d expected subscribers connected.", len(self.connections_made), self.expected_subscribers)
+        subscribers_made = self.countSubscribers(self.connections_made)
+        if subscribers_made < self.expected_subscribers:
+            self._logger.info("%d of %d expected subscribers connected.", subscribers_made, self.expected_subscribers)
 
-    def pushIdToSubscribers(self):
+    def pushIdToSubscribers(self, first_id=1):
+        # Hand out the ids in connection order, relays get a block of ids starting at the one we send them.
+        next_id = first_id
         for proto in self.connections_made:
+            proto.id = next_id
+            next_id += proto.weight
             self.parsing_semaphore.run(proto.sendAndWaitForReady)
 
     def setConnectionReady(self, proto):
-        self._timeout_delayed_call.reset(EXPERIMENT_SYNC_TIMEOUT)
+        self.resetSetupTimeout()
         self.connections_ready.append(proto)
 
-        if len(self.connections_ready) >= self.expected_subscribers:
+        if self.countSubscribers(self.connections_ready) >= self.expected_subscribers:
             self._logger.info("All subscribers are ready, pushing data!")
             if self._subscriber_looping_call and self._subscriber_looping_call.running:
                 self._subscriber_looping_call.stop()
@@ -227,58 +765,103 @@ class ExperimentServiceFactory(Factory):
                 self._subscriber_looping_call.start(1.0)
 
     def _print_subscribers_ready(self):
-        self._logger.info("%d of %d expected subscribers ready.", len(self.connections_ready),
+        self._logger.info("%d of %d expected subscribers ready.", self.countSubscribers(self.connections_ready),
                           self.expected_subscribers)
 
     def pushInfoToSubscribers(self):
         # Generate the json doc
         vars = {}
         for subscriber in self.connections_ready:
-            subscriber_vars = subscriber.vars.copy()
-            subscriber_vars['port'] = subscriber.id + 12000
-            subscriber_vars['host'] = subscriber.transport.getPeer().host
-            vars[subscriber.id] = subscriber_vars
-
-        json_vars = json.dumps(vars)
+            if subscriber.peers is not None:
+                # The time offsets of the instances behind a relay are relative to the relay's clock.
+                for peer_id, peer_vars in subscriber.peers.iteritems():
+                    peer_vars = peer_vars.copy()
+                    peer_vars['port'] = peer_id + 12000
+                    peer_vars['time_offset'] = peer_vars.get('time_offset', 0) + subscriber.vars['time_offset']
+                    if peer_vars.get('time_offset_error') is not None:
+                        peer_vars['time_offset_error'] += subscriber.vars.get('time_offset_error') or 0
+                    vars[str(peer_id)] = peer_vars
+            else:
+                subscriber_vars = subscriber.vars.copy()
+                subscriber_vars['port'] = subscriber.id + 12000
+                subscriber_vars['host'] = subscriber.transport.getPeer().host
+                vars[str(subscriber.id)] = subscriber_vars
+
+        errors = [peer_vars['time_offset_error'] for peer_vars in vars.itervalues()
+                  if peer_vars.get('time_offset_error') is not None]
+        if errors:
+            self._logger.info("Clock offsets of %d of %d peers estimated, error bound mean %f max %f secs.",
+                              len(errors), len(vars), sum(errors) / len(errors), max(errors))
+
+        if any('query' in subscriber.caps for subscriber in self.connections_ready):
+            self.setPeerVars(vars)
+
+        document = VarsDocument(vars)
         del vars
-        self._logger.info("Pushing a %d bytes long json doc.", len(json_vars))
+        if not all(subscriber.binary for subscriber in self.connections_ready):
+            self._logger.info("Pushing a %d bytes long json doc.", len(document.json))
 
         # Send the json doc to the subscribers
-        task.cooperate(self._sendLineToAllGenerator(json_vars))
+        self.pushVarsToSubscribers(document)
 
-    def _sendLineToAllGenerator(self, line):
+    def pushVarsToSubscribers(self, document):
+        return task.cooperate(self._sendVarsToAllGenerator(document)).whenDone()
+
+    def _sendVarsToAllGenerator(self, document):
         for subscriber in self.connections_ready:
-            yield subscriber.sendLine(line)
+            if 'query' in subscriber.caps:
+                # Peers looking up the vars on demand only get their own.
+                subscriber.sendCommand("peers:%d" % len(self.peer_vars))
+                own_vars = {str(subscriber.id): self.peer_vars[str(subscriber.id)]}
+                yield subscriber.sendVars(VarsDocument(own_vars))
+            else:
+                yield subscriber.sendVars(document)
+
+    def setPeerVars(self, peer_vars):
+        self.peer_vars = peer_vars
+        self._peer_addresses = None
+
+    def getPeerIdByAddress(self, host, port):
+        if self._peer_addresses is None:
+            self._peer_addresses = dict(((peer_vars['host'], int(peer_vars['port'])), peer_id)
+                                        for peer_id, peer_vars in self.peer_vars.iteritems())
+        return self._peer_addresses.get((host, port))
 
     def setConnectionReceived(self, proto):
-        self._timeout_delayed_call.reset(EXPERIMENT_SYNC_TIMEOUT)
+        self.resetSetupTimeout()
         self.vars_received.append(proto)
 
-        if len(self.vars_received) >= self.expected_subscribers:
+        if self.countSubscribers(self.vars_received) >= self.expected_subscribers:
             self._logger.info("Data sent to all subscribers, giving the go signal in %f secs.",
                               self.experiment_start_delay)
             reactor.callLater(0, self.startExperiment)
-            self._timeout_delayed_call.cancel()
+            self.cancelSetupTimeout()
         else:
             if not self._subscriber_received_looping_call:
                 self._subscriber_received_looping_call = task.LoopingCall(self._print_subscribers_received)
                 self._subscriber_received_looping_call.start(1.0)
 
     def _print_subscribers_received(self):
-        self._logger.info("%d of %d expected subscribers received the data.", len(self.vars_received),
+        self._logger.info("%d of %d expected subscribers received the data.", self.countSubscribers(self.vars_received),
                           self.expected_subscribers)
 
     def startExperiment(self):
+        self.giveGoSignal(time() + self.experiment_start_delay)
+
+    def giveGoSignal(self, start_time):
         # Give the go signal and disconnect
         self._logger.info("Starting the experiment!")
 
         if self._subscriber_received_looping_call and self._subscriber_received_looping_call.running:
             self._subscriber_received_looping_call.stop()
 
-        start_time = time() + self.experiment_start_delay
         for subscriber in self.connections_ready:
             # Sync the experiment start time among instances
-            subscriber.sendLine("go:%f" % (start_time + subscriber.vars['time_offset']))
+            if subscriber.persistent:
+                subscriber.sendCommand("go:%f:persistent:%s" % (start_time + subscriber.vars['time_offset'],
+                                                                ':'.join(subscriber.features)))
+            else:
+                subscriber.sendCommand("go:%f" % (start_time + subscriber.vars['time_offset']))
 
         d = task.deferLater(reactor, 5, lambda: self._logger.info("Done, disconnecting all clients."))
         d.addCallback(lambda _: self.disconnectAll())
@@ -289,10 +872,89 @@ class ExperimentServiceFactory(Factory):
 
         def _disconnectAll():
             for subscriber in self.connections_ready:
-                yield subscriber.transport.loseConnection()
+                if not subscriber.persistent:
+                    yield subscriber.transport.loseConnection()
         task.cooperate(_disconnectAll())
 
+    def reachBarrier(self, proto, name):
+        self._logger.debug("Subscriber %s reached barrier %s", proto.id, name)
+        self._barriers.setdefault(name, []).append(proto)
+        self._checkBarrier(name)
+
+    def _checkBarrier(self, name):
+        if name in self._barriers_reached:
+            return
+
+        expected = self.countSubscribers([subscriber for subscriber in self.connections_ready if subscriber.persistent
+                                          and 'barrier' in subscriber.caps])
+        if self.countSubscribers(self._barriers[name]) >= expected:
+            self._barriers_reached.add(name)
+            self.onBarrierReached(name)
+
+    def onBarrierReached(self, name):
+        self._logger.info("All subscribers reached barrier %s, releasing them in %f secs.", name,
+                          self.barrier_release_delay)
+        self.releaseBarrier(name, time() + self.barrier_release_delay)
+
+    def releaseBarrier(self, name, release_time):
+        self._barriers_reached.discard(name)
+        for subscriber in self._barriers.pop(name, []):
+            if subscriber.connected:
+                subscriber.sendCommand("release:%s:%f" % (name, release_time + subscriber.vars['time_offset']))
+
+    def addMetrics(self, reports):
+        for peer_id, metrics in reports.iteritems():
+            peer_metrics = self._metrics.setdefault(peer_id, {})
+            for name, value in metrics.iteritems():
+                if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                    peer_metrics[name] = peer_metrics.get(name, 0) + value
+                else:
+                    peer_metrics[name] = value
+
+        if not self._metrics_looping_call:
+            self._metrics_looping_call = task.LoopingCall(self.flushMetrics)
+            self._metrics_looping_call.start(self.metrics_interval, now=False)
+
+    def flushMetrics(self):
+        if not self.metrics_file:
+            return
+
+        counters = {}
+        peertypes = {}
+        for peer_id, peer_metrics in self._metrics.iteritems():
+            peertype = str(peer_metrics.get('peertype', '-'))
+            for name, value in peer_metrics.iteritems():
+                if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                    counters.setdefault(name, []).append(value)
+                    peertypes.setdefault(name, {}).setdefault(peertype, []).append(value)
+
+        # Write it to a temporary file first so readers never see half a summary.
+        h_summary = open(self.metrics_file + '.tmp', 'w')
+        print >> h_summary, "# Live metrics of %d peers at %.1f" % (len(self._metrics), time())
+        print >> h_summary, "# name peers sum mean min p50 p90 p99 max"
+        for name in sorted(counters):
+            values = sorted(counters[name])
+            percentile = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+            print >> h_summary, name, len(values), sum(values), float(sum(values)) / len(values), values[0], \
+                percentile(0.5), percentile(0.9), percentile(0.99), values[-1]
+
+        all_peertypes = sorted(set(peertype for by_peertype in peertypes.itervalues() for peertype in by_peertype))
+        if len(all_peertypes) > 1:
+            print >> h_summary, "# mean per peertype"
+            print >> h_summary, "# name", " ".join(all_peertypes)
+            for name in sorted(peertypes):
+                means = []
+                for peertype in all_peertypes:
+                    values = peertypes[name].get(peertype)
+                    means.append(str(float(sum(values)) / len(values)) if values else '?')
+                print >> h_summary, name, " ".join(means)
+        h_summary.close()
+        rename(self.metrics_file + '.tmp', self.metrics_file)
+
     def unregisterConnection(self, proto):
+        if not self._ids_pushed and proto in self.connections_made:
+            # The subscriber will reconnect (e.g. falling back to the line protocol), don't count it twice.
+            self.connections_made.remove(proto)
         if proto in self.connections_ready:
             self.connections_ready.remove(proto)
         if proto in self.vars_received:
@@ -302,7 +964,28 @@ class ExperimentServiceFactory(Factory):
 
         self._logger.debug("Connection cleanly unregistered.")
 
+        for name, waiting in self._barriers.items():
+            # Don't let the others wait for a subscriber that is gone.
+            if proto in waiting:
+                waiting.remove(proto)
+            self._checkBarrier(name)
+
+        if self._experiment_started and not self.hasPersistentConnections():
+            self._logger.info("All the persistent connections are closed, shutting down sync server.")
+            if self._metrics_looping_call and self._metrics_looping_call.running:
+                self._metrics_looping_call.stop()
+                self.flushMetrics()
+            reactor.callLater(0, stopReactor)
+
+    def hasPersistentConnections(self):
+        return any(subscriber.persistent for subscriber in self.connections_ready)
+
     def onExperimentStarted(self, _):
+        self._experiment_started = True
+        if self.hasPersistentConnections():
+            self._logger.info("Experiment started, keeping the persistent connections open.")
+            return
+
         self._logger.info("Experiment started, shutting down sync server.")
         reactor.callLater(0, stopReactor)
 
@@ -317,46 +1000,282 @@ class ExperimentServiceFactory(Factory):
         reactor.exitCode = 1
         reactor.callLater(0, stopReactor)
 
-    def lineLengthExceeded(self, line):
-        self._logger.error("Line length exceeded, %d bytes remain.", len(line))
+#
+# Relay
+#
+
+
+class ExperimentRelayFactory(ExperimentServiceFactory):
+
+    """
+    Sync relay meant to be run on every node running experiment instances.
+
+    It speaks the same protocol as ExperimentServiceFactory to the local instances, so existing clients work
+    unchanged, and registers itself with the upstream experiment server (or another relay) as a single subscriber
+    standing for all of them. This way the upstream server only has to handle one connection per node and the vars
+    and the go signal get propagated down the tree.
+    """
+
+    def __init__(self, expected_subscribers):
+        ExperimentServiceFactory.__init__(self, expected_subscribers, 0)
+
+        self.upstream = None
+        self.upstream_factory = ExperimentRelayUpstreamFactory(self)
+        self._first_id = None
+        self._go_received = False
+
+    def connectUpstream(self, host, port):
+        self._logger.info("Connecting to upstream experiment server %s:%d", host, port)
+        reactor.connectTCP(host, port, self.upstream_factory)
+
+    def setUpstream(self, upstream):
+        self.upstream = upstream
+
+    def setUpstreamId(self, first_id):
+        self._first_id = first_id
+        if self._ids_pushed:
+            self.pushIdToSubscribers()
+
+    def pushIdToSubscribers(self):
+        # We can't hand out any ids until the upstream server has assigned us a block.
+        if self._first_id is None:
+            self._logger.info("All local subscribers connected, waiting for the upstream server to assign the ids.")
+            self.cancelSetupTimeout()
+        else:
+            self.resetSetupTimeout()
+            ExperimentServiceFactory.pushIdToSubscribers(self, self._first_id)
+
+    def pushInfoToSubscribers(self):
+        self._logger.info("All local subscribers are ready, sending their data upstream.")
+        # The upstream server is waiting for the rest of the nodes, so we can't time out now.
+        self.cancelSetupTimeout()
+        self.upstream.sendSubscribersInfo(self.connections_ready)
+
+    def pushUpstreamVars(self, document):
+        if any('query' in subscriber.caps for subscriber in self.connections_ready):
+            # We will be the one answering the lookups of our local subscribers.
+            self.setPeerVars(document.vars)
+
+        self.resetSetupTimeout()
+        self._logger.info("Forwarding the vars doc to the local subscribers.")
+        self.pushVarsToSubscribers(document)
+
+    def startExperiment(self):
+        self.upstream.sendCommand("vars_received")
+
+    def setUpstreamGo(self, start_time, features=()):
+        self._go_received = True
+        # Offer the local subscribers whatever the upstream server offers us.
+        self.barriers = 'barrier' in features
+        self.metrics = 'metrics' in features
+        self.giveGoSignal(start_time)
+
+    def flushMetrics(self):
+        # Batch the changes reported by the local subscribers and send them upstream together.
+        if self._metrics and self.upstream.connected:
+            self.upstream.sendCommand("peermetrics:%s" % json.dumps(self._metrics))
+        self._metrics = {}
+
+    def onBarrierReached(self, name):
+        self._logger.debug("All local subscribers reached barrier %s", name)
+        self.upstream.sendCommand("barrier:%s" % name)
+
+    def onUpstreamLost(self, reason):
+        if not self._go_received:
+            self._logger.error("Lost the connection with the upstream server before the experiment started: %s",
+                               reason.getErrorMessage())
+            reactor.exitCode = 1
+            reactor.callLater(0, stopReactor)
+
+
+class ExperimentRelayUpstream(SyncProtocol):
+
+    def __init__(self, relay):
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.relay = relay
+        self.state = "hello"
+        self.server_hello = ()
+
+    def connectionMade(self):
+        self._logger.debug("Connected to the upstream experiment server")
+        self.relay.setUpstream(self)
+        self.sendTicket()
+
+    def sendSubscribersInfo(self, subscribers):
+        # Instances connecting trough the loopback interface need to be reachable by the other nodes too.
+        relay_host = self.transport.getHost().host
+        for subscriber in subscribers:
+            subscriber_vars = subscriber.vars.copy()
+            subscriber_host = subscriber.transport.getPeer().host
+            subscriber_vars['host'] = relay_host if subscriber_host.startswith('127.') else subscriber_host
+            self.sendFrame(FRAME_PEER, pack([subscriber.id, subscriber_vars]))
+        self.sendCommand("ready")
+
+    #
+    # Protocol state handlers
+    #
+
+    def proto_hello(self, line):
+        self.server_hello = set(line.strip().split(':', 1)[1].split(',')) if line.startswith(SERVER_HELLO + ':') else ()
+        if 'binary' not in self.server_hello:
+            # Relays and the root server are always deployed together, so there is no need for a fallback here.
+            self._logger.error("The upstream server doesn't speak the binary protocol, closing connection")
+            return "done"
+
+        self.sendLine(BINARY_HELLO)
+        return "binary_hello"
+
+    def proto_binary_hello(self, line):
+        if line != BINARY_HELLO:
+            self._logger.error("Unexpected answer to the binary protocol hello: %s", line)
+            return "done"
+
+        self.startBinaryMode()
+        self.sendCommand("time:%f" % time())
+        self.sendCommand("caps:%s" % ','.join(cap for cap in ('ntp', 'barrier', 'metrics') if cap in self.server_hello))
+        self.sendCommand("relay:%d" % self.relay.expected_subscribers)
+        return "id"
+
+    def lineReceived(self, line):
+        if line.startswith('ping:'):
+            self.sendCommand("pong:%s:%f" % (line.strip().split(':')[1], time()))
+        elif line.startswith('retry:'):
+            self.handleRetry(line)
+        else:
+            SyncProtocol.lineReceived(self, line)
+
+    def proto_id(self, line):
+        maybe_id, id = line.strip().split(':', 1)
+        if maybe_id == "id":
+            self._logger.debug('Got first id: "%s" assigned', id)
+            self.relay.setUpstreamId(int(id))
+            return "all_vars"
+        else:
+            self._logger.error("Received an unexpected string from the server, closing connection")
+            return "done"
+
+    def frame_vars(self, payload):
+        if self.state != "all_vars":
+            self._logger.error("Unexpected vars frame received in state %s, closing connection", self.state)
+            return "done"
+
+        # Pass the packed doc along as is, it will only be unpacked if a local subscriber needs it.
+        self.relay.pushUpstreamVars(VarsDocument(packed=payload))
+        return "go"
+
+    def proto_go(self, line):
+        if line.strip().startswith("go:"):
+            go_args = line.strip().split(":")
+            self.relay.setUpstreamGo(float(go_args[1]), go_args[2:])
+            return "running" if 'persistent' in go_args[2:] else "done"
+        self._logger.error('Unexpected command received "%s"', line)
+        return "done"
+
+    def proto_running(self, line):
+        if line.startswith("release:"):
+            name, release_time = line.strip().split(':', 1)[1].rsplit(':', 1)
+            self.relay.releaseBarrier(name, float(release_time))
+        else:
+            self._logger.error('Unexpected command received "%s" while running the experiment', line)
+        return "running"
+
+
+class ExperimentRelayUpstreamFactory(SyncClientFactory):
+
+    def __init__(self, relay):
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.relay = relay
+
+    def buildProtocol(self, address):
+        # Once connected, there is no way to resume the sync process if the connection drops.
+        self.stopTrying()
+        p = ExperimentRelayUpstream(self.relay)
+        p.factory = self
+        return p
+
+    def clientConnectionFailed(self, connector, reason):
+        self._logger.error("Failed to connect to the upstream experiment server (will retry in a while), error was: %s",
+                           reason.getErrorMessage())
+        ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        self._logger.info("The connection with the upstream experiment server was lost with reason: %s",
+                          reason.getErrorMessage())
+        if not self.reconnectIfAsked(connector):
+            self.relay.onUpstreamLost(reason)
+
 #
 # Client side
 #
 
 
-class ExperimentClient(LineReceiver):
-    # Allow for 4MB long lines (for the json stuff)
-    MAX_LENGTH = 2 ** 22
+class ExperimentClient(SyncProtocol):
+    # Look up the vars of other peers on demand instead of receiving everybody's.
+    query_mode = False
+    # Use the binary protocol if the server supports it.
+    binary_protocol = True
 
     def __init__(self, vars):
         self._logger = logging.getLogger(self.__class__.__name__)
 
-        self.state = "id"
+        self.state = "hello"
         self.my_id = None
         self.vars = vars
         self.all_vars = {}
+        # (host, port) -> peer id index of all_vars
+        self._peer_addresses = {}
         self.time_offset = None
+        self.time_offset_error = None
+        self.nr_peers = None
+        self._pending_peers = {}
+        self._pending_addresses = {}
+        self._early_id = None
+        self._vars_sent_d = None
+        # Features announced by the server in its hello line, None if it didn't send one.
+        self.server_hello = None
+        self.server_features = set()
+        self._pending_barriers = {}
+        self._reported_metrics = {}
 
     def connectionMade(self):
         self._logger.debug("Connected to the experiment server")
-        self.sendLine("time:%f" % time())
+        self.sendTicket()
+        # Wait for the server to tell us what it supports.
+        self.state = "hello"
+
+    def sendVars(self):
+        self.sendCommand("time:%f" % time())
+        caps = ['ntp', 'barrier', 'metrics'] if self.binary else ['zvars', 'ntp', 'barrier', 'metrics']
+        if self.query_mode:
+            caps.append('query')
+        # Only announce what the server said it understands, servers without a hello line get no caps at all.
+        caps = [cap for cap in caps if cap in (self.server_hello or ())]
+        if self.query_mode and 'query' not in caps:
+            self._logger.warning("The experiment server doesn't support the query mode, receiving all the vars.")
+            self.query_mode = False
+        if caps:
+            self.sendCommand("caps:%s" % ','.join(caps))
         for key, val in self.vars.iteritems():
-            self.sendLine("set:%s:%s" % (key, val))
+            self.sendVar(key, val)
 
-        d = deferToThread(self.onVarsSend)
+        self._vars_sent_d = deferToThread(self.onVarsSend)
         self.state = "id"
 
-    def lineReceived(self, line):
-        try:
-            pto = 'proto_' + self.state
-            statehandler = getattr(self, pto)
-        except AttributeError:
-            self._logger.error('Callback %s not found', self.state)
-            stopReactor()
+    def sendVar(self, key, value):
+        if self.binary:
+            self.sendFrame(FRAME_SET, pack([key, value]))
         else:
-            self.state = statehandler(line)
-            if self.state == 'done':
-                self.transport.loseConnection()
+            self.sendLine("set:%s:%s" % (key, value))
+
+    def share_var(self, key, value):
+        """
+        Sends an extra var to the experiment server, can be called from onVarsSend and onIdReceived to upload vars
+        as soon as they are available. Only the binary protocol can carry values containing newlines.
+        """
+        self.vars[key] = value
+        reactor.callFromThread(self.sendVar, key, value)
 
     def onVarsSend(self):
         self._logger.debug("onVarsSend: Call not implemented")
@@ -370,25 +1289,180 @@ class ExperimentClient(LineReceiver):
     def startExperiment(self):
         self._logger.debug("startExperiment: Call not implemented")
 
-    def get_peer_id(self, ip, port):
+    def lineReceived(self, line):
+        if line.startswith('ping:'):
+            # Answer right away, any delay here ends up in the clock offset error.
+            self.sendCommand("pong:%s:%f" % (line.strip().split(':')[1], time()))
+
+        elif line.startswith('retry:'):
+            self.handleRetry(line)
+
+        # Lookup replies can arrive at any point after we have sent the ready command.
+        elif self.query_mode and line.startswith(('peer:', 'addr:')):
+            self._onLookupReply(line)
+        else:
+            SyncProtocol.lineReceived(self, line)
+
+    def connectionLost(self, reason=connectionDone):
+        for deferreds in self._pending_peers.values() + self._pending_addresses.values():
+            for d in deferreds:
+                d.callback(None)
+        self._pending_peers = {}
+        self._pending_addresses = {}
+        for deferreds in self._pending_barriers.values():
+            for d in deferreds:
+                d.callback(None)
+        self._pending_barriers = {}
+        SyncProtocol.connectionLost(self, reason)
+
+    def get_required_peers(self):
+        """
+        Returns the ids of the peers whose vars should be available before the experiment starts when running in
+        query mode, so the get_peer_* methods can be used on them right away.
+        """
+        return []
+
+    def fetch_peer(self, peer_id):
+        """
+        Returns a Deferred that will fire with the vars of peer_id (or None if it doesn't exist), looking them up
+        in the experiment server if we don't have them yet.
+        """
+        peer_id = str(peer_id)
+        if peer_id in self.all_vars or not self.query_mode:
+            return succeed(self.all_vars.get(peer_id))
+
+        d = Deferred()
+        if peer_id not in self._pending_peers:
+            self._pending_peers[peer_id] = []
+            self.sendCommand("get:%s" % peer_id)
+        self._pending_peers[peer_id].append(d)
+        return d
+
+    def fetch_peer_id(self, ip, port):
+        """
+        Returns a Deferred that will fire with the id of the peer listening on ip:port (or None if there is none).
+        """
         port = int(port)
-        for peer_id, peer_dict in self.all_vars.iteritems():
-            if peer_dict['host'] == ip and int(peer_dict['port']) == port:
-                return peer_id
+        peer_id = self.get_peer_id(ip, port, log_missing=not self.query_mode)
+        if peer_id or not self.query_mode:
+            return succeed(peer_id)
+
+        d = Deferred()
+        if (ip, port) not in self._pending_addresses:
+            self._pending_addresses[(ip, port)] = []
+            self.sendCommand("who:%s:%d" % (ip, port))
+        self._pending_addresses[(ip, port)].append(d)
+        return d
+
+    def barrier(self, name):
+        """
+        Returns a Deferred that will fire once all the peers have reached the barrier with the local time at which
+        they should all continue. It fires right away with None if the experiment server doesn't offer barriers.
+        """
+        if 'barrier' not in self.server_features or not self.connected:
+            self._logger.warning("The experiment server doesn't offer barriers, not waiting on %s", name)
+            return succeed(None)
+
+        d = Deferred()
+        if name not in self._pending_barriers:
+            self._pending_barriers[name] = []
+            self.sendCommand("barrier:%s" % name)
+        self._pending_barriers[name].append(d)
+        return d
+
+    def report_metrics(self, metrics):
+        """
+        Reports the current value of some metrics to the live aggregation of the experiment server, if it offers it.
+        Only the changes since the last report are sent, numbers are treated as counters and anything else as labels.
+        """
+        if 'metrics' not in self.server_features or not self.connected:
+            return
+
+        changes = {}
+        for name, value in metrics.iteritems():
+            previous = self._reported_metrics.get(name)
+            if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                if value != (previous or 0):
+                    changes[name] = value - (previous or 0)
+            elif value != previous:
+                changes[name] = value
+        self._reported_metrics = dict(metrics)
+
+        if changes:
+            self.sendCommand("metrics:%s" % json.dumps(changes))
+
+    def _onLookupReply(self, line):
+        if line.startswith('peer:'):
+            _, peer_id, json_vars = line.strip().split(':', 2)
+            self._onPeerReply(peer_id, json.loads(json_vars))
+        else:
+            _, ip, port, peer_id = line.strip().split(':')
+            for d in self._pending_addresses.pop((ip, int(port)), []):
+                d.callback(peer_id or None)
 
-        self._logger.error("Could not get_peer_id for %s:%s", ip, port)
+    def _onPeerReply(self, peer_id, peer_vars):
+        if peer_vars is not None:
+            self.all_vars[peer_id] = peer_vars
+            self._index_peer(peer_id, peer_vars)
+        for d in self._pending_peers.pop(peer_id, []):
+            d.callback(peer_vars)
+
+    def _index_peer(self, peer_id, peer_vars):
+        self._peer_addresses[(peer_vars['host'], int(peer_vars['port']))] = peer_id
+
+    def get_peer_id(self, ip, port, log_missing=True):
+        peer_id = self._peer_addresses.get((ip, int(port)))
+        if peer_id is not None:
+            return peer_id
+
+        if log_missing:
+            self._logger.error("Could not get_peer_id for %s:%s", ip, port)
 
     def get_peer_ip_port_by_id(self, peer_id):
         if str(peer_id) in self.all_vars:
             return self.all_vars[str(peer_id)]['host'], self.all_vars[str(peer_id)]['port']
 
     def get_peers(self):
+        if self.nr_peers is not None:
+            # In query mode we only know about the peers we have looked up, but the ids are consecutive.
+            return [str(peer_id) for peer_id in xrange(1, self.nr_peers + 1)]
         return self.all_vars.keys()
 
     #
     # Protocol state handlers
     #
 
+    def proto_hello(self, line):
+        if line.startswith(SERVER_HELLO + ':'):
+            self.server_hello = set(line.strip().split(':', 1)[1].split(','))
+            if self.binary_protocol and 'binary' in self.server_hello:
+                self.sendLine(BINARY_HELLO)
+                return "binary_hello"
+            self.sendVars()
+            return "id"
+
+        # Servers without the hello line don't talk before handing out the ids.
+        self._logger.info("The experiment server didn't announce any features, using the line protocol.")
+        self.sendVars()
+        return self.proto_id(line)
+
+    def proto_binary_hello(self, line):
+        if line.startswith("id:"):
+            # The server pushes the ids as soon as everybody is connected, possibly before reading our hello.
+            self._early_id = line
+            return "binary_hello"
+
+        if line != BINARY_HELLO:
+            self._logger.warning("Unexpected answer to the binary protocol hello: %s", line)
+            return "done"
+
+        self._logger.debug("Using the binary protocol")
+        self.startBinaryMode()
+        self.sendVars()
+        if self._early_id:
+            return self.proto_id(self._early_id)
+        return "id"
+
     def proto_id(self, line):
         # We should get a line such as:
         # id:SOMETHING
@@ -396,35 +1470,86 @@ class ExperimentClient(LineReceiver):
         if maybe_id == "id":
             self.my_id = id
             self._logger.debug('Got id: "%s" assigned', id)
-            d = deferToThread(self.onIdReceived)
-            d.addCallback(lambda _: self.sendLine("ready"))
+            # The id can arrive right after sending our vars, onVarsSend has to be done first.
+            d = self._vars_sent_d.addCallback(lambda _: deferToThread(self.onIdReceived))
+            d.addCallback(lambda _: self.sendCommand("ready"))
             return "all_vars"
         else:
             self._logger.error("Received an unexpected string from the server, closing connection")
             return "done"
 
     def proto_all_vars(self, line):
+        if line.startswith("zvars:"):
+            self.receiveFrame(int(line.strip().split(':')[1]), self._onCompressedVars)
+            return "all_vars"
+
+        elif line.startswith("peers:"):
+            self.nr_peers = int(line.strip().split(':')[1])
+            return "all_vars"
+
+        return self._onAllVars(json.loads(line))
+
+    def _onCompressedVars(self, frame):
+        return self._onAllVars(json.loads(zlib.decompress(frame)))
+
+    def frame_vars(self, payload):
+        if self.state != "all_vars":
+            self._logger.error("Unexpected vars frame received in state %s, closing connection", self.state)
+            return "done"
+        return self._onAllVars(unpack(zlib.decompress(payload)))
+
+    def frame_peer(self, payload):
+        peer_id, peer_vars = unpack(payload)
+        self._onPeerReply(peer_id, peer_vars)
+        return self.state
+
+    def _onAllVars(self, all_vars):
         self._logger.debug("Got experiment variables")
 
-        self.all_vars = json.loads(line)
+        self.all_vars = all_vars
+        self._peer_addresses = {}
+        for peer_id, peer_vars in self.all_vars.iteritems():
+            self._index_peer(peer_id, peer_vars)
         self.time_offset = self.all_vars[self.my_id]["time_offset"]
-        self.onAllVarsReceived()
+        self.time_offset_error = self.all_vars[self.my_id].get("time_offset_error")
 
-        self.sendLine("vars_received")
+        if self.query_mode:
+            d = gatherResults([self.fetch_peer(peer_id) for peer_id in self.get_required_peers()])
+            d.addCallback(lambda _: self._onRequiredPeersReceived())
+        else:
+            self._onRequiredPeersReceived()
         return "go"
 
+    def _onRequiredPeersReceived(self):
+        self.onAllVarsReceived()
+        self.sendCommand("vars_received")
+
     def proto_go(self, line):
         self._logger.debug("Got GO signal")
         if line.strip().startswith("go:"):
-            start_delay = max(0, float(line.strip().split(":")[1]) - time())
+            go_args = line.strip().split(":")
+            start_delay = max(0, float(go_args[1]) - time())
             self._logger.info("Starting the experiment in %f secs.", start_delay)
             reactor.callLater(start_delay, self.startExperiment)
             self.factory.stopTrying()
+            if 'persistent' in go_args[2:]:
+                # Keep the connection open to keep talking to the server during the experiment.
+                self.server_features = set(go_args[3:])
+                return "running"
             self.transport.loseConnection()
 
+    def proto_running(self, line):
+        if line.startswith("release:"):
+            name, release_time = line.strip().split(':', 1)[1].rsplit(':', 1)
+            self._logger.debug("Barrier %s released at %s", name, release_time)
+            for d in self._pending_barriers.pop(name, []):
+                d.callback(float(release_time))
+        else:
+            self._logger.error('Unexpected command received "%s" while running the experiment', line)
+        return "running"
 
-class ExperimentClientFactory(ReconnectingClientFactory):
-    maxDelay = 10
+
+class ExperimentClientFactory(SyncClientFactory):
 
     def __init__(self, vars, protocol=ExperimentClient):
         self._logger = logging.getLogger(self.__class__.__name__)
@@ -445,6 +1570,7 @@ class ExperimentClientFactory(ReconnectingClientFactory):
     def clientConnectionLost(self, connector, reason):
         self._logger.info("The connection with the experiment server was lost with reason: %s",
                           reason.getErrorMessage())
+        self.reconnectIfAsked(connector)
 
 #
 # Aux stuff
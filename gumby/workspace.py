@@ -0,0 +1,279 @@
+# workspace.py ---
+#
+# Filename: workspace.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 22:03:51 2026 (+0200)
+
+# Commentary:
+#
+# Incremental synchronization of the experiment workspace to the head nodes.
+#
+# For every head node a manifest of what has been shipped to it is kept locally: the size, modification time,
+# mode and SHA-1 of the contents of every file of the workspace, and the mode of every directory. Files whose size
+# and modification time didn't change aren't read again, so only the tree walk is needed to know what changed since
+# the last run. Only the changed files and directories (and the list of deleted ones) are shipped, as a single
+# compressed tar stream piped to the head node through SSH, and nothing at all is shipped if the workspace didn't
+# change.
+#
+# The digest of the manifest is also stored in the remote workspace (REMOTE_MARKER) and checked before shipping
+# anything. If the remote workspace has been wiped, recreated or synchronized by other means, the marker is gone or
+# different and the whole workspace is shipped again. Files edited in place on the head node aren't detected,
+# removing the manifest (or setting incremental_workspace_sync to false once) makes the next run ship everything.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import json
+import logging
+import tarfile
+from cStringIO import StringIO
+from fnmatch import fnmatch
+from hashlib import md5, sha1
+from os import lstat, makedirs, path, readlink, remove, rename, walk
+from pipes import quote
+from stat import S_ISLNK, S_ISREG, S_IMODE
+from tempfile import TemporaryFile
+
+# Same exclusions as the rsync based synchronization, matched against every path component.
+EXCLUDES = ('.git*', '.svn', 'local', 'output')
+MANIFEST_DIR = '.gumby_manifests'
+DELETED_LIST = '.gumby_deleted'
+REMOTE_MARKER = '.gumby_manifest'
+# Exit code of the remote command when the remote workspace isn't the one described by the manifest.
+STALE_EXIT_CODE = 75
+# DIGEST of the directories, only their mode matters.
+DIRECTORY = 'dir'
+
+
+def _is_excluded(name):
+    return name in (MANIFEST_DIR, REMOTE_MARKER) or any(fnmatch(name, pattern) for pattern in EXCLUDES)
+
+
+def _shell_path(remote_path):
+    # Quoted for the remote shell, but a leading ~ or $HOME is still expanded like rsync did.
+    for home in ('~', '$HOME'):
+        if remote_path == home:
+            return '"$HOME"'
+        if remote_path.startswith(home + '/'):
+            rest = remote_path[len(home) + 1:]
+            return '"$HOME"/' + (quote(rest) if rest else '')
+    return quote(remote_path)
+
+
+def manifest_digest(manifest):
+    return sha1(json.dumps(manifest, sort_keys=True)).hexdigest()
+
+
+def content_digest(manifest):
+    """
+    Returns a digest of the paths, modes and contents in the manifest, which unlike manifest_digest() doesn't change
+    when the files are only touched.
+    """
+    return manifest_digest(dict((relpath, entry[2:]) for relpath, entry in manifest.iteritems()))
+
+
+def _digest(filename, st):
+    if S_ISLNK(st.st_mode):
+        return 'link:' + readlink(filename)
+    checksum = sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), ''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def scan_workspace(root, previous=None):
+    """
+    Returns the manifest of the workspace, {RELPATH: [SIZE, MTIME, MODE, DIGEST]}.
+
+    Files with the same size and modification time as in the previous manifest keep their digest without being
+    read. Symlinks are stored as such, their DIGEST being the link target. Directories are stored too, so the empty
+    ones are created and the removed ones deleted.
+    """
+    previous = previous or {}
+    manifest = {}
+    for dirpath, dirnames, filenames in walk(root):
+        # walk() lists the symlinks to directories as directories, but doesn't follow them.
+        names = filenames + [name for name in dirnames if path.islink(path.join(dirpath, name))]
+        dirnames[:] = sorted(name for name in dirnames
+                             if not _is_excluded(name) and not path.islink(path.join(dirpath, name)))
+        for name in dirnames:
+            filename = path.join(dirpath, name)
+            manifest[path.relpath(filename, root)] = [0, 0, S_IMODE(lstat(filename).st_mode), DIRECTORY]
+
+        for name in names:
+            if _is_excluded(name):
+                continue
+            filename = path.join(dirpath, name)
+            relpath = path.relpath(filename, root)
+            st = lstat(filename)
+            if not S_ISREG(st.st_mode) and not S_ISLNK(st.st_mode):
+                continue
+
+            known = previous.get(relpath)
+            if known and known[:2] == [st.st_size, st.st_mtime] and not S_ISLNK(st.st_mode):
+                digest = known[3]
+            else:
+                digest = _digest(filename, st)
+            manifest[relpath] = [st.st_size, st.st_mtime, S_IMODE(st.st_mode) if S_ISREG(st.st_mode) else 0, digest]
+    return manifest
+
+
+def diff_manifests(old, new):
+    """
+    Returns the (CHANGED, DELETED) sorted lists of paths, changed including the new ones.
+    """
+    changed = sorted(relpath for relpath, entry in new.iteritems()
+                     if relpath not in old or old[relpath][2:] != entry[2:])
+    deleted = sorted(relpath for relpath in old if relpath not in new)
+    return changed, deleted
+
+
+def write_archive(root, changed, deleted, fileobj):
+    """
+    Writes a gzipped tar stream with the changed files and, if any, the list of deleted ones into fileobj.
+    """
+    with tarfile.open(fileobj=fileobj, mode='w|gz') as tar:
+        for relpath in changed:
+            tar.add(path.join(root, relpath), arcname=relpath, recursive=False)
+        if deleted:
+            data = '\0'.join(deleted)
+            info = tarfile.TarInfo(DELETED_LIST)
+            info.size = len(data)
+            tar.addfile(info, StringIO(data))
+
+
+class WorkspaceSync(object):
+
+    """
+    Computes and ships the changes of a local workspace to a remote directory on a host.
+
+    Usage:
+        sync = WorkspaceSync(workspace_dir, host, remote_dir)
+        if sync.prepare(scan_workspace(workspace_dir, sync.previous)):
+            ...pipe sync.archive to: ssh host sync.remote_command...
+        ...and once the remote command succeeded:
+        sync.commit()
+        ...or if it exited with STALE_EXIT_CODE, ship everything:
+        sync.forget()
+        sync.prepare(manifest)
+
+    previous is the manifest of what has been shipped to the host, None if unknown.
+    """
+
+    def __init__(self, workspace_dir, host, remote_dir):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.workspace_dir = workspace_dir
+        self.host = host
+        self.remote_dir = remote_dir
+        self.manifest_filename = path.join(workspace_dir, MANIFEST_DIR,
+                                           "%s-%s.json" % (host, md5(remote_dir).hexdigest()[:8]))
+
+        self.previous = self._load()
+        self.manifest = None
+        self.changed = self.deleted = ()
+        self.archive = None
+        self.remote_command = None
+
+    def _load(self):
+        try:
+            with open(self.manifest_filename) as f:
+                manifest = json.load(f)
+        except (EnvironmentError, ValueError):
+            return None
+        # Back to byte strings, like the paths walk() gives.
+        return dict((relpath.encode('utf-8'), entry[:3] + [entry[3].encode('utf-8')])
+                    for relpath, entry in manifest.iteritems())
+
+    def prepare(self, manifest):
+        """
+        Compares the current manifest of the workspace with what has been shipped and, if anything has to be shipped,
+        writes the archive to a temporary file and returns True. Either way remote_command has to be run on the host
+        afterwards, it also clears the output of the previous run.
+        """
+        self.manifest = manifest
+
+        # The command goes through the remote shell.
+        remote_dir = _shell_path(self.remote_dir)
+        marker = quote(REMOTE_MARKER)
+        if self.previous is None:
+            self.changed, self.deleted = sorted(self.manifest), []
+            # Nothing is known about the remote workspace, start from scratch as rsync --delete would do.
+            prologue = "rm -rf %s && mkdir -p %s && cd %s" % (remote_dir, remote_dir, remote_dir)
+        else:
+            self.changed, self.deleted = diff_manifests(self.previous, self.manifest)
+            # Make sure the remote workspace is still the one we shipped before only sending the changes.
+            prologue = ("mkdir -p %s && cd %s && { [ \"$(cat %s 2>/dev/null)\" = %s ] || exit %d; } && "
+                        "rm -rf output local" % (remote_dir, remote_dir, marker, manifest_digest(self.previous),
+                                                 STALE_EXIT_CODE))
+        epilogue = "echo %s > %s" % (manifest_digest(self.manifest), marker)
+
+        if not self.changed and not self.deleted:
+            self._logger.info("Workspace unchanged on %s, nothing to ship", self.host)
+            self.remote_command = "%s && %s" % (prologue, epilogue)
+            return False
+
+        self._logger.info("Shipping %d changed files and %d deletions to %s", len(self.changed), len(self.deleted),
+                          self.host)
+        self.archive = TemporaryFile()
+        write_archive(self.workspace_dir, self.changed, self.deleted, self.archive)
+        self.archive.seek(0)
+        # Removed directories go with whatever was left in them, as rsync --delete would do.
+        deleted_list = quote(DELETED_LIST)
+        self.remote_command = ("%s && tar -xzf - && if [ -f %s ]; then xargs -0 rm -rf -- < %s; rm -f %s; fi && %s" %
+                               (prologue, deleted_list, deleted_list, deleted_list, epilogue))
+        return True
+
+    def commit(self):
+        """
+        Stores the manifest once the changes have been shipped successfully.
+        """
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+        manifest_dir = path.dirname(self.manifest_filename)
+        if not path.exists(manifest_dir):
+            makedirs(manifest_dir)
+        tmp_filename = self.manifest_filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.manifest, f)
+        rename(tmp_filename, self.manifest_filename)
+
+    def forget(self):
+        """
+        Removes the manifest, the next synchronization will ship the whole workspace.
+        """
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+        self.previous = None
+        if path.exists(self.manifest_filename):
+            remove(self.manifest_filename)
+
+#
+# workspace.py ends here
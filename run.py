@@ -39,6 +39,7 @@
 
 import logging
 import sys
+from optparse import OptionParser
 from os import environ, getpgid, getpid, getppid, kill, setpgrp
 from os.path import dirname, exists
 from signal import SIGKILL, SIGTERM, signal
@@ -79,8 +80,18 @@ _terminating = False
 
 if __name__ == '__main__':
     sys.path.append(dirname(__file__))
-    if len(sys.argv) == 2:
-        conf_path = sys.argv[1]
+    parser = OptionParser(usage="usage: %prog [options] EXPERIMENT_CONFIG")
+    parser.add_option("--resume-from", metavar="STEP",
+                      help="Reuse the output of the previous run and run the experiment from STEP on, e.g. "
+                           "post_process. The steps before it must have completed with the same configuration")
+    parser.add_option("--only", metavar="STEP[,STEP...]",
+                      help="Reuse the output of the previous run and only run the given steps")
+    (options, args) = parser.parse_args()
+    if options.resume_from and options.only:
+        parser.error("--resume-from and --only are mutually exclusive")
+
+    if len(args) == 1:
+        conf_path = args[0]
         if not exists(conf_path):
             print "Error: The specified configuration file doesn't exist."
             exit(1)
@@ -91,7 +102,11 @@ if __name__ == '__main__':
         signal(SIGTERM, _termTrap)
 
         exp_runner = ExperimentRunner(conf_path)
-        exp_runner.run()
+        try:
+            exp_runner.run(options.resume_from, options.only.split(',') if options.only else None)
+        except ValueError, e:
+            print "Error:", e
+            exit(1)
 
         reactor.exitCode = 0
         reactor.run()
@@ -115,7 +130,7 @@ if __name__ == '__main__':
 
         exit(reactor.exitCode)
     else:
-        print "Usage:\n%s EXPERIMENT_CONFIG" % sys.argv[0]
+        parser.print_usage()
 
 #
 # run.py ends here
@@ -62,16 +62,42 @@ cd "$OUTPUT_DIR"
 
 CMDFILE=$(mktemp --tmpdir=/local/$USER/ process_guard_XXXXXXXXXXXXX_$USER)
 
+# If requested, run a sync relay on this node so the experiment server only needs to handle one connection per node.
+if [ ! -z "$SYNC_RELAY_PORT" ]; then
+    echo "Starting sync relay on port $SYNC_RELAY_PORT for $PROCESSES_IN_THIS_NODE local instances"
+    experiment_relay.py > "$OUTPUT_DIR/experiment_relay.log" 2>&1 &
+    export SYNC_HOST=127.0.0.1
+    export SYNC_PORT=$SYNC_RELAY_PORT
+fi
+
 # @CONF_OPTION DAS4_NODE_COMMAND: The command that will be repeatedly launched in the worker nodes of the cluster. (required)
 for INSTANCE in $(seq 1 1 $PROCESSES_IN_THIS_NODE); do
     echo "$DAS4_NODE_COMMAND" >> $CMDFILE
 done
 
+# Keep sending the data generated so far to the head node, so gumby can collect it while the experiment runs and
+# the final rsync only has to send what changed since the last round. Logs only grow, so just send their new tails.
+# Only if enabled with the output_collect_interval gumby config option (exported as OUTPUT_COLLECT_INTERVAL), it's
+# disabled by default.
+if [ "${OUTPUT_COLLECT_INTERVAL:-0}" -gt 0 ]; then
+    (while sleep $OUTPUT_COLLECT_INTERVAL; do
+        rsync -a --append-verify --exclude="sqlite/" "$OUTPUT_DIR/" "$OUTPUT_DIR_URI/$(hostname)/" 2>&1 ||:
+    done) &
+    OUTPUT_SYNC_PID=$!
+fi
+
 # @CONF_OPTION DAS4_NODE_TIMEOUT: Time in seconds to wait for the sub-processes to run before killing them. (required)
 (process_guard.py -f $CMDFILE -t $DAS4_NODE_TIMEOUT -o $OUTPUT_DIR -m $OUTPUT_DIR  -i 5 2>&1 | tee process_guard.log) ||:
 
 rm $CMDFILE
 
+if [ ! -z "$OUTPUT_SYNC_PID" ]; then
+    # Stop an ongoing rsync too, the final one will send everything anyway.
+    pkill -P $OUTPUT_SYNC_PID 2>/dev/null ||:
+    kill $OUTPUT_SYNC_PID 2>/dev/null ||:
+    wait $OUTPUT_SYNC_PID 2>/dev/null ||:
+fi
+
 # Now, lets send the generated data back to the head node
 rsync -a --delete-before --exclude="sqlite/" "$OUTPUT_DIR/" "$OUTPUT_DIR_URI/$(hostname)/" 2>&1
 
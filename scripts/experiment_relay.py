@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# experiment_relay.py ---
+#
+# Filename: experiment_relay.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 11:02:40 2026 (+0200)
+
+# Commentary:
+#
+# %*% Experiment sync relay.
+#
+# Aggregates all the experiment instances running in a node and registers them with the
+# experiment server as a single subscriber, so the server only has to deal with one
+# connection per node. The instances connect to the relay exactly as they would connect
+# to the experiment server. See gumby/sync.py for the details.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from os import environ
+
+from gumby.sync import ExperimentRelayFactory
+from gumby.log import setupLogging
+
+from twisted.internet import reactor
+
+# @CONF_OPTION SYNC_RELAY_PORT: Start a sync relay listening on this port on every node and make the instances connect to it instead of directly to the experiment server. (default is disabled)
+# @CONF_OPTION SYNC_RELAY_SUBSCRIBERS_AMOUNT: Number of local instances the sync relay should wait for. (default is PROCESSES_IN_THIS_NODE)
+
+if __name__ == '__main__':
+    setupLogging()
+    if 'SYNC_RELAY_SUBSCRIBERS_AMOUNT' in environ:
+        expected_subscribers = int(environ['SYNC_RELAY_SUBSCRIBERS_AMOUNT'])
+    else:
+        expected_subscribers = int(environ['PROCESSES_IN_THIS_NODE'])
+
+    relay_port = int(environ['SYNC_RELAY_PORT'])
+
+    reactor.exitCode = 0
+    relay = ExperimentRelayFactory(expected_subscribers)
+    reactor.listenTCP(relay_port, relay)
+    relay.connectUpstream(environ['SYNC_HOST'], int(environ['SYNC_PORT']))
+    reactor.run()
+    exit(reactor.exitCode)
+
+#
+# experiment_relay.py ends here
@@ -60,6 +60,7 @@
 # Code:
 
 from os import environ
+import sys
 
 from gumby.sync import ExperimentServiceFactory
 from gumby.log import setupLogging
@@ -70,6 +71,13 @@ from twisted.internet import reactor
 # @CONF_OPTION SYNC_EXPERIMENT_START_DELAY: Delay the synchronized start of the experiment by this amount of seconds when giving the start signal.
 # @CONF_OPTION SYNC_EXPERIMENT_START_DELAY: The default value should be OK for a few thousand instances. (float, default 5)
 # @CONF_OPTION SYNC_PORT: Port where we should listen on. (required)
+# @CONF_OPTION SYNC_ADMISSION_RATE: Maximum number of new sync clients admitted per second, the rest is told when to reconnect, and the instances connect right away instead of waiting a random time. (float, default 0: disabled)
+# @CONF_OPTION SYNC_ADMISSION_BURST: Number of sync clients that can be admitted at once before the rate limit kicks in. (default is SYNC_ADMISSION_RATE)
+# @CONF_OPTION SYNC_BARRIERS: Keep the sync server running during the experiment so the instances can synchronize on named barriers ("barrier <name>" scenario lines). (default is False)
+# @CONF_OPTION SYNC_BARRIER_RELEASE_DELAY: Seconds between the last instance reaching a barrier and the synchronized release of all of them. (float, default 1)
+# @CONF_OPTION SYNC_METRICS_FILE: If set, keep the sync server running during the experiment to aggregate the live metrics reported by the instances and write a summary to this file periodically. (default is disabled)
+# @CONF_OPTION SYNC_METRICS_INTERVAL: Seconds between updates of SYNC_METRICS_FILE. (float, default 10)
+# @CONF_OPTION SYNC_LISTEN_BACKLOG: Size of the listen queue of the sync server, connections overflowing it are retried by the kernel after seconds. (default 1024)
 
 if __name__ == '__main__':
     setupLogging()
@@ -80,9 +88,22 @@ if __name__ == '__main__':
 
     experiment_start_delay = float(environ.get('SYNC_EXPERIMENT_START_DELAY', 5))
     server_port = int(environ['SYNC_PORT'])
+    admission_rate = float(environ.get('SYNC_ADMISSION_RATE', 0))
+    admission_burst = int(environ.get('SYNC_ADMISSION_BURST', 0)) or None
+    listen_backlog = int(environ.get('SYNC_LISTEN_BACKLOG', 1024))
 
     reactor.exitCode = 0
-    reactor.listenTCP(server_port, ExperimentServiceFactory(expected_subscribers, experiment_start_delay))
+    factory = ExperimentServiceFactory(expected_subscribers, experiment_start_delay, admission_rate, admission_burst)
+    factory.barriers = environ.get('SYNC_BARRIERS', 'False').lower() in ("yes", "true", "t", "1")
+    factory.barrier_release_delay = float(environ.get('SYNC_BARRIER_RELEASE_DELAY', 1))
+    if environ.get('SYNC_METRICS_FILE'):
+        factory.metrics = True
+        factory.metrics_file = environ['SYNC_METRICS_FILE']
+        factory.metrics_interval = float(environ.get('SYNC_METRICS_INTERVAL', 10))
+    reactor.listenTCP(server_port, factory, backlog=listen_backlog)
+    # The runner waits for this line (EXPERIMENT_SERVER_READY_LINE in gumby/runner.py) to start the instances.
+    print "Experiment server listening on port %d" % server_port
+    sys.stdout.flush()
     reactor.run()
     exit(reactor.exitCode)
 
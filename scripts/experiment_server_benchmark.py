@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# experiment_server_benchmark.py ---
+#
+# Filename: experiment_server_benchmark.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 17:02:44 2026 (+0200)
+
+# Commentary:
+#
+# Measures how the experiment sync server scales without having to reserve a cluster.
+#
+# Runs an ExperimentServiceFactory on the loopback interface and spawns a few client processes
+# simulating the requested amount of ExperimentClient instances against it. When the go signal
+# has been given, it reports the time spent on every phase of the sync protocol:
+#
+# * connect        -> Until all the subscribers are connected.
+# * id             -> Until the last id has been sent.
+# * ready          -> Until all the subscribers have sent ready.
+# * vars_pushed    -> Until the vars document has been written to all the subscribers.
+# * vars_received  -> Until all the subscribers have confirmed the reception of the vars.
+# * go             -> Until the go signal has been sent to all the subscribers.
+#
+# Together with the peak RSS and CPU time of the server and the client processes and the
+# amount of bytes sent and received by the server. Example:
+#
+# for N in 1000 5000 10000; do scripts/experiment_server_benchmark.py -o bench.json $N; done
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+from base64 import b64encode
+from collections import OrderedDict
+from optparse import OptionParser
+from time import time
+
+from twisted.internet import reactor
+from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from gumby.sync import ExperimentClient, ExperimentClientFactory, ExperimentServiceFactory, ExperimentServiceProto
+
+PHASES = ('connect', 'id', 'ready', 'vars_pushed', 'vars_received', 'go')
+
+
+def raiseFileLimit():
+    # Every simulated subscriber needs a file descriptor on both ends.
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+#
+# Server side
+#
+
+
+class BenchmarkServiceProto(ExperimentServiceProto):
+
+    def sendAndWaitForReady(self):
+        d = ExperimentServiceProto.sendAndWaitForReady(self)
+        self.factory.mark('id')
+        return d
+
+
+class BenchmarkServiceFactory(ExperimentServiceFactory):
+
+    def __init__(self, expected_subscribers, experiment_start_delay, admission_rate, admission_burst):
+        ExperimentServiceFactory.__init__(self, expected_subscribers, experiment_start_delay, admission_rate,
+                                          admission_burst)
+        self.phases = OrderedDict()
+
+    def mark(self, phase):
+        self.phases[phase] = time()
+
+    def buildProtocol(self, addr):
+        return BenchmarkServiceProto(self)
+
+    def pushIdToSubscribers(self, first_id=1):
+        self.mark('connect')
+        ExperimentServiceFactory.pushIdToSubscribers(self, first_id)
+
+    def pushInfoToSubscribers(self):
+        self.mark('ready')
+        ExperimentServiceFactory.pushInfoToSubscribers(self)
+
+    def pushVarsToSubscribers(self, document):
+        d = ExperimentServiceFactory.pushVarsToSubscribers(self, document)
+        d.addCallback(lambda _: self.mark('vars_pushed'))
+        return d
+
+    def startExperiment(self):
+        self.mark('vars_received')
+        ExperimentServiceFactory.startExperiment(self)
+
+    def giveGoSignal(self, start_time):
+        ExperimentServiceFactory.giveGoSignal(self, start_time)
+        self.mark('go')
+
+
+class CountingProtocol(ProtocolWrapper):
+
+    def write(self, data):
+        self.factory.bytes_sent += len(data)
+        ProtocolWrapper.write(self, data)
+
+    def writeSequence(self, data):
+        self.factory.bytes_sent += sum(len(chunk) for chunk in data)
+        ProtocolWrapper.writeSequence(self, data)
+
+    def dataReceived(self, data):
+        self.factory.bytes_received += len(data)
+        ProtocolWrapper.dataReceived(self, data)
+
+
+class CountingFactory(WrappingFactory):
+    protocol = CountingProtocol
+
+    def __init__(self, wrappedFactory):
+        WrappingFactory.__init__(self, wrappedFactory)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+#
+# Client side
+#
+
+
+class SimulatedClient(ExperimentClient):
+
+    def startExperiment(self):
+        self.factory.onStarted()
+
+
+class SimulatedClientFactory(ExperimentClientFactory):
+
+    def __init__(self, vars, protocol, on_started):
+        ExperimentClientFactory.__init__(self, vars, protocol)
+        self.onStarted = on_started
+
+
+def runClients(port, amount, vars_size, line_protocol, query_mode):
+    raiseFileLimit()
+
+    class Client(SimulatedClient):
+        binary_protocol = not line_protocol
+    Client.query_mode = query_mode
+
+    started = [0]
+
+    def onStarted():
+        started[0] += 1
+        if started[0] == amount:
+            reactor.callLater(0, reactor.stop)
+
+    for _ in xrange(amount):
+        factory = SimulatedClientFactory({'blob': b64encode(os.urandom(vars_size))}, Client, onStarted)
+        reactor.connectTCP('127.0.0.1', port, factory)
+
+    reactor.run()
+    return 0 if started[0] == amount else 1
+
+#
+# Benchmark driver
+#
+
+
+def runBenchmark(options, subscribers):
+    file_limit = raiseFileLimit()
+    if file_limit < subscribers + 100:
+        logging.warning("The open files limit (%d) is too low for %d subscribers.", file_limit, subscribers)
+
+    service = BenchmarkServiceFactory(subscribers, options.start_delay, options.admission_rate,
+                                      options.admission_burst)
+    counter = CountingFactory(service)
+    port = reactor.listenTCP(0, counter, backlog=options.backlog, interface='127.0.0.1').getHost().port
+
+    clients = []
+    per_process = [subscribers // options.processes + (1 if i < subscribers % options.processes else 0)
+                   for i in xrange(options.processes)]
+    for amount in per_process:
+        if amount:
+            cmd = [sys.executable, __file__, '--client', '--port', str(port), '--vars-size', str(options.vars_size)]
+            if options.line:
+                cmd.append('--line')
+            if options.query:
+                cmd.append('--query')
+            clients.append(subprocess.Popen(cmd + [str(amount)]))
+
+    started = time()
+    reactor.exitCode = 0
+    reactor.run()
+
+    clients_rss = clients_cpu = 0
+    clients_failed = 0
+    for client in clients:
+        _, status, usage = os.wait4(client.pid, 0)
+        clients_rss = max(clients_rss, usage.ru_maxrss)
+        clients_cpu += usage.ru_utime + usage.ru_stime
+        clients_failed += 1 if status else 0
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    result = OrderedDict([('subscribers', subscribers),
+                          ('processes', len(clients)),
+                          ('protocol', 'line' if options.line else 'binary'),
+                          ('query', options.query),
+                          ('vars_size', options.vars_size),
+                          ('admission_rate', options.admission_rate),
+                          ('phases', OrderedDict()),
+                          ('total', None),
+                          ('server_peak_rss_kb', usage.ru_maxrss),
+                          ('server_cpu', usage.ru_utime + usage.ru_stime),
+                          ('clients_peak_rss_kb', clients_rss),
+                          ('clients_cpu', clients_cpu),
+                          ('bytes_sent', counter.bytes_sent),
+                          ('bytes_received', counter.bytes_received),
+                          ('failed', bool(reactor.exitCode or clients_failed))])
+
+    previous = started
+    for phase in PHASES:
+        if phase in service.phases:
+            result['phases'][phase] = service.phases[phase] - previous
+            previous = service.phases[phase]
+    if 'go' in service.phases:
+        result['total'] = service.phases['go'] - started
+    return result
+
+
+def printResult(result):
+    print "Sync of %d subscribers (%s protocol%s, %d bytes of vars each):" % (
+        result['subscribers'], result['protocol'], ', query mode' if result['query'] else '', result['vars_size'])
+    for phase in PHASES:
+        if phase in result['phases']:
+            print "  %-15s %10.3f s" % (phase, result['phases'][phase])
+        else:
+            print "  %-15s %10s" % (phase, 'not reached')
+    if result['total'] is not None:
+        print "  %-15s %10.3f s" % ('total', result['total'])
+    print "  server peak RSS %d KB, CPU %.2f s" % (result['server_peak_rss_kb'], result['server_cpu'])
+    print "  clients peak RSS %d KB (per process), CPU %.2f s" % (result['clients_peak_rss_kb'], result['clients_cpu'])
+    print "  bytes sent %d, received %d" % (result['bytes_sent'], result['bytes_received'])
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] SUBSCRIBERS")
+    parser.add_option("-p", "--processes", type="int", default=4,
+                      help="Number of processes running the simulated clients (default: %default)")
+    parser.add_option("-s", "--vars-size", type="int", default=256,
+                      help="Amount of random bytes every client shares, base64 encoded (default: %default)")
+    parser.add_option("-d", "--start-delay", type="float", default=0,
+                      help="Experiment start delay given to the server (default: %default)")
+    parser.add_option("-b", "--backlog", type="int", default=1024,
+                      help="Listen backlog of the server (default: %default)")
+    parser.add_option("-a", "--admission-rate", type="float", default=500,
+                      help="Subscribers admitted per second by the server, 0 for unlimited (default: %default)")
+    parser.add_option("--admission-burst", type="int",
+                      help="Subscribers admitted at once by the server (default: the admission rate)")
+    parser.add_option("-l", "--line", action="store_true", default=False,
+                      help="Use the line protocol instead of the binary one")
+    parser.add_option("-q", "--query", action="store_true", default=False,
+                      help="Simulate clients running in query mode")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="Append the results as a JSON line to FILE to compare them with later runs")
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+                      help="Show the log messages of the sync server")
+    parser.add_option("--client", action="store_true", default=False, help="(internal) Run simulated clients")
+    parser.add_option("--port", type="int", help="(internal) Port of the server")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("Please specify the number of subscribers to simulate.")
+    subscribers = int(args[0])
+
+    logging.basicConfig(level=logging.INFO if options.verbose else logging.WARNING)
+
+    if options.client:
+        return runClients(options.port, subscribers, options.vars_size, options.line, options.query)
+
+    result = runBenchmark(options, subscribers)
+    printResult(result)
+    if options.output:
+        with open(options.output, 'a') as f:
+            print >> f, json.dumps(result)
+    return 1 if result['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+#
+# experiment_server_benchmark.py ends here
@@ -70,6 +70,30 @@ CONFIG_FILE_HEADER = '''\
 # Take into account that if you use a single node you still need to add a comma at the end.
 # head_nodes = node1,node2,node3
 #
+# Ship only the files that changed since the last run to the head nodes, instead of rsyncing the whole workspace.
+# A manifest of what has been shipped to every head node is kept in the .gumby_manifests dir of the workspace.
+# Defaults to true
+# incremental_workspace_sync =
+#
+# Seconds between the pulls of the output data from the head nodes while the experiment runs (and from the DAS4
+# worker nodes to their head node), so only a small delta is left to collect when it finishes. This adds network
+# and disk activity during the experiment, so it has to be enabled explicitly.
+# Defaults to 0 (disabled)
+# output_collect_interval =
+#
+# Directory (relative to the workspace) where to write the output of the commands run by gumby (one file per command
+# and stream) instead of logging every line of it. Useful for chatty remote commands.
+# Defaults to empty (log every line)
+# command_output_dir =
+#
+# When writing the output of the commands to command_output_dir, log one out of every this many lines (0 for none)...
+# Defaults to 100
+# command_output_sample =
+#
+# ...and the lines and bytes per second written every this many seconds (0 to disable).
+# Defaults to 60
+# command_output_report_interval =
+#
 # Command used to start a tracker in the background during the whole duration of the experiment.
 # If the tracker exits before the experiment finishes, the experiment will abort to avoid wasting time.
 # The tracker will be killed by gumby when the experiment finishes.
@@ -83,6 +107,15 @@ CONFIG_FILE_HEADER = '''\
 # Defaults to 7788
 # tracker_port =
 #
+# The experiment instances are started once the tracker printed a line containing this text.
+# Defaults to empty (give the tracker 1 second to start)
+# tracker_ready_line =
+#
+# Scenario file read by the instances (relative to the directory of the config file), exported as SCENARIO_FILE.
+# Its index is compiled before shipping the workspace, so every instance only reads its own lines.
+# Defaults to empty (the scenario of the experiment client, not compiled)
+# scenario_file =
+#
 # Command used to start the experiment synchronization server in case you need one, if the experiment sync server exits with status 0,
 # the experiment will _not_ be canceled.
 # experiment_server_cmd =
@@ -91,6 +124,15 @@ CONFIG_FILE_HEADER = '''\
 # Defaults to false
 # experiment_server_run_remote =
 #
+# The experiment instances are started once the experiment synchronization server printed a line containing this text.
+# Defaults to empty: wait for "Experiment server listening" if running experiment_server.py, give the server 1 second
+# to start otherwise
+# experiment_server_ready_line =
+#
+# Seconds to wait for the configured ready lines before starting the instances anyway.
+# Defaults to 30
+# ready_timeout =
+#
 # Command used to locally set up the all the stuff needed to set up the experiment (dependencies, compilations, etc.)
 # This will be executed in parallel with the remote counterparts (see below)
 # local_setup_cmd =
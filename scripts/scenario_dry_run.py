@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# scenario_dry_run.py ---
+#
+# Filename: scenario_dry_run.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 21:12:05 2026 (+0200)
+
+# Commentary:
+#
+# Simulates a whole scenario without running it, to know what load it will generate before reserving any nodes.
+#
+# The scenario is parsed once for all the peers. PEERSPECs are kept as intervals, so a line for {1-4000} costs the
+# same as a line for {1}. Repeated lines ("every"/"rate") and "load" lines are accounted for analytically (on average
+# for the Poisson ones), they are never expanded. Reports:
+#
+# * The amount of actions per callable and the peak amount of actions per time bucket.
+# * The hotspots: the time buckets with the most actions and what they consist of.
+# * The distribution of the actions between the peers.
+# * The amount of online peers over time, following the online/offline lines.
+#
+# With -o, the time-bucketed histograms are written to the given directory (load-profile.txt, online-peers.txt and
+# peer-actions.txt) to plot them. Example:
+#
+# scripts/scenario_dry_run.py -b 10 -o /tmp/profile experiments/dispersy/social_1000.scenario
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import os
+import sys
+from collections import Counter, defaultdict
+from math import ceil, floor
+from optparse import OptionParser
+from time import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from gumby.scenario import PeerSet, Repeat, ScenarioParser
+
+
+class ScenarioSimulator(ScenarioParser):
+
+    def __init__(self, filename, peers=None, bucket_size=1.0, online_actions=('online',),
+                 offline_actions=('offline',)):
+        ScenarioParser.__init__(self)
+        self.filename = filename
+        self.bucket_size = bucket_size
+        self.online_actions = set(online_actions)
+        self.offline_actions = set(offline_actions)
+
+        # (TIMESTAMP, LINENO, CALLABLE, REPEAT, YES_PEERS, NO_PEERS) of every valid line
+        self.lines = []
+        self.invalid_lines = 0
+        self.peers = self._parse_lines()
+        if peers:
+            self.peers = peers
+        self.all_peers = PeerSet([(1, self.peers)])
+
+        # bucket -> Counter(CALLABLE -> actions)
+        self.buckets = defaultdict(Counter)
+        self.actions = Counter()
+        self.peer_actions = [0] * (self.peers + 2)
+        self.online_peers = []
+
+    def _parse_lines(self):
+        # Returns the highest peer number found
+        peers = 0
+        for lineno, line in self._read_scenario(self.filename):
+            if not line:
+                continue
+            line, peerspec = self._split_peerspec(line)
+            try:
+                yes_peers, no_peers = self._parse_peerspec(peerspec)
+                tstmp, _, clb, args, repeat = self._parse_command(lineno, self._preprocess_line(line))
+                if clb == 'load':
+                    # Accounted for as a repetition of the callable it loads
+                    options, _ = self._parse_load_options(args[1:])
+                    clb = args[0]
+                    repeat = Repeat(tstmp, tstmp + options['duration'], 1.0 / options['rate'], options['poisson'])
+            except Exception, e:
+                print >> sys.stderr, "Ignoring invalid scenario line", lineno, line, str(e)
+                self.invalid_lines += 1
+                continue
+
+            self.lines.append((tstmp, lineno, clb, repeat, yes_peers, no_peers))
+            peers = max(peers, yes_peers.last or 0, no_peers.last or 0)
+        return peers
+
+    def peers_of(self, yes_peers, no_peers):
+        """
+        Returns the amount of peers a line applies to.
+        """
+        if yes_peers:
+            return len(yes_peers)
+        return self.peers - (len(no_peers) - len(no_peers.difference(self.all_peers)))
+
+    def simulate(self):
+        for tstmp, lineno, clb, repeat, yes_peers, no_peers in self.lines:
+            peers = self.peers_of(yes_peers, no_peers)
+            if not peers:
+                continue
+
+            if repeat is None:
+                self.buckets[int(floor(tstmp / self.bucket_size))][clb] += peers
+                repetitions = 1
+            else:
+                repetitions = self._add_repeat(repeat, clb, peers)
+            self.actions[clb] += peers * repetitions
+            self._add_peer_actions(yes_peers, no_peers, repetitions)
+
+        self._simulate_online()
+
+    def _add_repeat(self, repeat, clb, peers):
+        # Repetitions in every bucket: exact for the fixed intervals, the mean for the Poisson arrivals.
+        def repetitions_before(t):
+            if t <= repeat.begin:
+                return 0
+            t = min(t, repeat.end)
+            if repeat.poisson:
+                return (t - repeat.begin) / repeat.interval
+            return int(ceil((t - repeat.begin) / repeat.interval - 1e-9))
+
+        bucket = int(floor(repeat.begin / self.bucket_size))
+        while bucket * self.bucket_size < repeat.end:
+            repetitions = repetitions_before((bucket + 1) * self.bucket_size) - \
+                repetitions_before(bucket * self.bucket_size)
+            if repetitions:
+                self.buckets[bucket][clb] += peers * repetitions
+            bucket += 1
+        return repetitions_before(repeat.end)
+
+    def _add_peer_actions(self, yes_peers, no_peers, repetitions):
+        # Difference array over the peer numbers, the intervals are never expanded.
+        if yes_peers:
+            intervals = [(low, min(high, self.peers)) for low, high in yes_peers.intervals if low <= self.peers]
+            sign = 1
+        else:
+            self.peer_actions[1] += repetitions
+            self.peer_actions[self.peers + 1] -= repetitions
+            intervals = (no_peers.difference(no_peers.difference(self.all_peers))).intervals
+            sign = -1
+        for low, high in intervals:
+            self.peer_actions[low] += sign * repetitions
+            self.peer_actions[high + 1] -= sign * repetitions
+
+    def get_peer_actions(self):
+        """
+        Returns the amount of actions of every peer, indexed by peer number - 1.
+        """
+        counts = []
+        count = 0
+        for delta in self.peer_actions[1:self.peers + 1]:
+            count += delta
+            counts.append(count)
+        return counts
+
+    def _simulate_online(self):
+        # The only simulation needing per peer state, just for the online and offline lines.
+        changes = sorted((tstmp, lineno, clb in self.online_actions, yes_peers or self.all_peers.difference(no_peers))
+                         for tstmp, lineno, clb, repeat, yes_peers, no_peers in self.lines
+                         if repeat is None and clb in self.online_actions | self.offline_actions)
+        online = [False] * (self.peers + 1)
+        online_count = 0
+        for tstmp, _, go_online, peers in changes:
+            for peer in peers:
+                if peer <= self.peers and online[peer] != go_online:
+                    online[peer] = go_online
+                    online_count += 1 if go_online else -1
+            if self.online_peers and self.online_peers[-1][0] == tstmp:
+                self.online_peers[-1] = (tstmp, online_count)
+            else:
+                self.online_peers.append((tstmp, online_count))
+
+    def get_hotspots(self, amount):
+        """
+        Returns the amount (BUCKET_START, ACTIONS, Counter) tuples of the busiest time buckets.
+        """
+        busiest = sorted(self.buckets.iteritems(), key=lambda (bucket, actions): -sum(actions.itervalues()))[:amount]
+        return [(bucket * self.bucket_size, sum(actions.itervalues()), actions) for bucket, actions in busiest]
+
+    def write_profiles(self, output_dir):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        callables = sorted(self.actions)
+        with open(os.path.join(output_dir, "load-profile.txt"), 'w') as f:
+            print >> f, "# time total", " ".join(callables)
+            for bucket in sorted(self.buckets):
+                actions = self.buckets[bucket]
+                print >> f, format_count(bucket * self.bucket_size), format_count(sum(actions.itervalues())), \
+                    " ".join(format_count(actions.get(clb, 0)) for clb in callables)
+
+        with open(os.path.join(output_dir, "online-peers.txt"), 'w') as f:
+            print >> f, "# time online"
+            for tstmp, online_count in self.online_peers:
+                print >> f, tstmp, online_count
+
+        with open(os.path.join(output_dir, "peer-actions.txt"), 'w') as f:
+            print >> f, "# peer actions"
+            for peer, count in enumerate(self.get_peer_actions(), 1):
+                print >> f, peer, format_count(count)
+
+
+def format_count(count):
+    return "%d" % count if count == int(count) else "%.1f" % count
+
+
+def printReport(simulator, hotspots):
+    print "Scenario %s for %d peers, %d lines (%d invalid)" % (simulator.filename, simulator.peers,
+                                                             len(simulator.lines), simulator.invalid_lines)
+    total = sum(simulator.actions.itervalues())
+    print "Actions: %s" % format_count(total)
+    for clb, count in simulator.actions.most_common():
+        print "  %-30s %12s" % (clb, format_count(count))
+
+    if simulator.buckets:
+        first, last = min(simulator.buckets), max(simulator.buckets)
+        duration = (last - first + 1) * simulator.bucket_size
+        peak = max(sum(actions.itervalues()) for actions in simulator.buckets.itervalues())
+        print "Load: %.1f actions/s on average over %s secs, peak of %s actions in %s secs (%.1f actions/s)" % (
+            total / duration, format_count(duration), format_count(peak), format_count(simulator.bucket_size),
+            peak / simulator.bucket_size)
+
+    print "Hotspots:"
+    for start, count, actions in simulator.get_hotspots(hotspots):
+        print "  @%-10s %12s  %s" % (format_count(start), format_count(count),
+                                     ", ".join("%s %s" % (clb, format_count(n)) for clb, n in actions.most_common(3)))
+
+    counts = sorted(simulator.get_peer_actions())
+    if counts:
+        print "Actions per peer: min %s, median %s, p99 %s, max %s" % (
+            format_count(counts[0]), format_count(counts[len(counts) // 2]),
+            format_count(counts[min(len(counts) - 1, int(len(counts) * 0.99))]), format_count(counts[-1]))
+
+    if simulator.online_peers:
+        print "Online peers: max %d, at the end %d" % (max(count for _, count in simulator.online_peers),
+                                                       simulator.online_peers[-1][1])
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] SCENARIO")
+    parser.add_option("-p", "--peers", type="int",
+                      help="Number of peers running the scenario (default: the highest peer number in the scenario)")
+    parser.add_option("-b", "--bucket-size", type="float", default=1.0,
+                      help="Size of the time buckets in seconds (default: %default)")
+    parser.add_option("-t", "--hotspots", type="int", default=10,
+                      help="Number of busiest time buckets to show (default: %default)")
+    parser.add_option("-o", "--output-dir", metavar="DIR",
+                      help="Write the load profile, online peers and per peer actions to DIR")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("Please specify the scenario file.")
+
+    t1 = time()
+    simulator = ScenarioSimulator(args[0], options.peers, options.bucket_size)
+    simulator.simulate()
+    printReport(simulator, options.hotspots)
+    if options.output_dir:
+        simulator.write_profiles(options.output_dir)
+    print >> sys.stderr, "Took %.2f secs" % (time() - t1)
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+#
+# scenario_dry_run.py ends here